@@ -15,6 +15,7 @@ else:
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE") # Добавляем загрузку base_url для DeepSeek
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # Добавляем загрузку ключа OpenAI
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE") # None - стандартный адрес OpenAI (другой - например, локальная заглушка)
 PRIMARY_LLM_PROVIDER = os.getenv("PRIMARY_LLM_PROVIDER", "deepseek").lower() # По умолчанию deepseek
 
 # --- Model Names --- (Загружаем из .env с дефолтами)
@@ -23,7 +24,65 @@ OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "gpt-4.1-mini") # Испол
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.2")) # Добавлена температура
 
 # Настройки асинхронной обработки
-MAX_CONCURRENT_REQUESTS = 1 # Максимальное количество одновременных запросов к LLM
+# Начальный лимит одновременных запросов к LLM. Дальше лимит подстраивается (AIMD) в пределах
+# [LLM_MIN_CONCURRENCY, LLM_MAX_CONCURRENCY]: растет при быстрых ответах, падает при 429/5xx и росте задержки
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "4"))
+LLM_MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_LATENCY_TOLERANCE = float(os.getenv("LLM_LATENCY_TOLERANCE", "2.0")) # Во сколько раз задержка может превысить базовую
+
+# Повторные попытки и защита от деградировавшего провайдера
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4")) # Повторы при 429/5xx/таймаутах/сетевых ошибках
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0")) # Базовая задержка, удваивается с каждой попыткой (с джиттером)
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30")) # Максимальная задержка между попытками, с
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "120")) # Таймаут одной попытки, с
+LLM_REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", "300")) # Общий срок на запрос с учетом повторов, с
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "8")) # Ошибок подряд до размыкания цепи
+LLM_CIRCUIT_RECOVERY_SECONDS = float(os.getenv("LLM_CIRCUIT_RECOVERY_SECONDS", "30")) # Пауза перед пробным запросом
+
+# Резервный провайдер: переключение при ошибках основного и дублирование медленных запросов
+LLM_FAILOVER_ENABLED = os.getenv("LLM_FAILOVER_ENABLED", "false").lower() in ("1", "true", "yes")
+SECONDARY_LLM_PROVIDER = os.getenv("SECONDARY_LLM_PROVIDER", "openai" if PRIMARY_LLM_PROVIDER == "deepseek" else "deepseek").lower()
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95")) # Дублируем запрос, если основной отвечает дольше этого перцентиля
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")) # Замеров, после которых перцентиль считается надежным
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "30")) # Порог дублирования, пока замеров мало, с
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2")) # Нижняя граница порога дублирования, с
+
+# Сокращение справочников: в запрос попадают только культуры/операции/ПУ, подходящие к сокращениям из сообщения
+# (при ненадежном сопоставлении - полные списки). Справочники при этом уходят из кэшируемого префикса в часть с сообщением
+LLM_PRUNE_REFERENCES = os.getenv("LLM_PRUNE_REFERENCES", "false").lower() in ("1", "true", "yes")
+# Проверка извлеченных записей по справочникам и правилам правдоподобности чисел (app/llm_integration/validator.py).
+# Записи с ошибками отправляются на короткий повторный запрос вместе с сообщением
+RECORD_VALIDATION_ENABLED = os.getenv("RECORD_VALIDATION_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Потоковые ответы: записи разбираются по мере генерации, зависание обнаруживается по паузе между фрагментами
+LLM_STREAMING_ENABLED = os.getenv("LLM_STREAMING_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_STREAM_STALL_TIMEOUT = float(os.getenv("LLM_STREAM_STALL_TIMEOUT", "20")) # Макс. пауза между фрагментами ответа, с
+
+# Structured output: ответ в JSON-режиме (OpenAI - по JSON-схеме записей, DeepSeek - json_object).
+# Если провайдер не поддерживает response_format, клиент сам переключается на обычный ответ.
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+
+# Пакетный режим: несколько сообщений в одном запросе к LLM (1 - пакетный режим выключен)
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "1"))
+# Ограничение на размер пакетного промпта (в оценочных токенах): пакет закрывается раньше, если сообщения длинные
+LLM_BATCH_MAX_PROMPT_TOKENS = int(os.getenv("LLM_BATCH_MAX_PROMPT_TOKENS", "16000"))
+
+# Разбор типовых сообщений правилами (app/llm_integration/rule_parser.py) без запроса к LLM.
+# Сообщения, которые правила не разобрали полностью, как и раньше отправляются в LLM
+RULE_PARSER_ENABLED = os.getenv("RULE_PARSER_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Поиск повторов (пересланные и повторно отправленные отчеты): повтор не отправляется в LLM и не дублируется в отчете
+MESSAGE_DEDUP_ENABLED = os.getenv("MESSAGE_DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+MESSAGE_DEDUP_THRESHOLD = float(os.getenv("MESSAGE_DEDUP_THRESHOLD", "0.85")) # Минимальное сходство текста (Жаккар по шинглам)
+
+# Маршрутизация по сложности: простые сообщения - быстрой (дешевой) модели, сложные - основной.
+# Сообщения, с которыми быстрая модель не справилась, переотправляются основной модели
+LLM_ROUTING_ENABLED = os.getenv("LLM_ROUTING_ENABLED", "false").lower() in ("1", "true", "yes")
+FAST_LLM_PROVIDER = os.getenv("FAST_LLM_PROVIDER", PRIMARY_LLM_PROVIDER).lower()
+FAST_LLM_MODEL_NAME = os.getenv("FAST_LLM_MODEL_NAME", "gpt-4.1-nano" if FAST_LLM_PROVIDER == "openai" else DEEPSEEK_MODEL_NAME)
+LLM_ROUTING_COMPLEXITY_THRESHOLD = float(os.getenv("LLM_ROUTING_COMPLEXITY_THRESHOLD", "0.5")) # Оценка сложности 0..1, от нее - основная модель
 
 # --- Google Sheets Configuration ---
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
@@ -46,6 +105,48 @@ DEPARTMENTS_FILE_PATH = os.path.join(DATA_DIR, "departments.json")
 # --- Report Output Path ---
 REPORT_OUTPUT_PATH = os.getenv("REPORT_OUTPUT_PATH", os.path.join(BASE_DIR, "data", "reports", "processing_results.xlsx"))
 
+# --- Messages DB (SQLite) ---
+# Общее долгоживущее соединение с базой парсера (app/utils/message_store.py).
+# Парсер пишет в ту же базу параллельно: WAL позволяет читать, не блокируя его запись
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").upper()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper() # NORMAL в WAL-режиме не делает fsync на каждый коммит
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) # Ожидание блокировки вместо ошибки "database is locked"
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000")) # Кэш страниц соединения
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "128")) # Кэш подготовленных запросов соединения
+SQLITE_FETCH_PAGE_SIZE = int(os.getenv("SQLITE_FETCH_PAGE_SIZE", "500")) # Сообщений в одной странице при потоковом чтении
+
+# --- Streaming Pipeline ---
+# Потоковая обработка за дату (app/llm_integration/pipeline.py): сообщения читаются из БД страницами и проходят этапы
+# подготовки, запроса к LLM, извлечения с проверкой и записи в отчет через ограниченные очереди.
+# false - прежняя обработка: все сообщения читаются сразу и обрабатываются process_batch_async
+LLM_PIPELINE_ENABLED = os.getenv("LLM_PIPELINE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_PIPELINE_QUEUE_SIZE = int(os.getenv("LLM_PIPELINE_QUEUE_SIZE", "64")) # Размер очереди между этапами: при заполнении предыдущий этап ждет
+LLM_PIPELINE_WORKERS = int(os.getenv("LLM_PIPELINE_WORKERS", str(LLM_MAX_CONCURRENCY))) # Обработчиков этапов запроса и извлечения (одновременные запросы ограничивает лимитер клиента)
+
+# --- LLM Response Cache ---
+# Дисковый кэш извлеченных записей: повторная обработка тех же сообщений не отправляет запросы к LLM
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(BASE_DIR, "data", "cache", "llm_cache.sqlite"))
+LLM_CACHE_MAX_AGE_DAYS = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30")) # Записи старше удаляются
+LLM_CACHE_MAX_SIZE_MB = float(os.getenv("LLM_CACHE_MAX_SIZE_MB", "200")) # Лимит размера, сверх него удаляются давно не использованные
+
+# --- Bulk (Batch API) Jobs ---
+# Офлайн-обработка больших объемов (бэкфилл сезона) через пакетный API провайдера (app/llm_integration/bulk_jobs.py).
+# У DeepSeek пакетного API нет, поэтому по умолчанию задания отправляются в OpenAI
+LLM_BULK_PROVIDER = os.getenv("LLM_BULK_PROVIDER", "openai").lower()
+LLM_BULK_JOBS_DIR = os.getenv("LLM_BULK_JOBS_DIR", os.path.join(BASE_DIR, "data", "bulk_jobs")) # Состояние и файлы заданий
+LLM_BULK_POLL_INTERVAL = float(os.getenv("LLM_BULK_POLL_INTERVAL", "60")) # Период опроса статуса пакетов, с
+LLM_BULK_MAX_REQUESTS = int(os.getenv("LLM_BULK_MAX_REQUESTS", "50000")) # Запросов в одном пакете (лимит OpenAI - 50 000)
+LLM_BULK_MAX_FILE_MB = float(os.getenv("LLM_BULK_MAX_FILE_MB", "190")) # Размер файла пакета (лимит OpenAI - 200 МБ)
+
+# --- Ingestion Daemon ---
+# Непрерывная обработка (python -m app.main --daemon, app/ingest_daemon.py): новые строки базы парсера отслеживаются
+# по rowid и сразу отправляются в потоковую обработку, отчет за дату обновляется по мере сохранения результатов
+DAEMON_POLL_MIN_S = float(os.getenv("DAEMON_POLL_MIN_S", "0.5")) # Интервал проверки базы, пока сообщения поступают, с
+DAEMON_POLL_MAX_S = float(os.getenv("DAEMON_POLL_MAX_S", "10")) # Предел интервала без новых сообщений (интервал удваивается), с
+DAEMON_REPORT_INTERVAL_S = float(os.getenv("DAEMON_REPORT_INTERVAL_S", "10")) # Не чаще одного обновления отчета за дату, с
+DAEMON_UPLOAD_INTERVAL_S = float(os.getenv("DAEMON_UPLOAD_INTERVAL_S", "300")) # Не чаще одной загрузки отчета на Google Drive, с
+
 # --- Quality Test Output ---
 QUALITY_TEST_DIR = os.path.join(BASE_DIR, "data", "llm_quality_test") # Папка для результатов тестов
 
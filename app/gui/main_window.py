@@ -14,8 +14,10 @@ import asyncio
 import logging
 import subprocess
 import time
-from app.main import run_processing_for_date # Импортируем функцию бэкенда
+from app.main import DB_PATH # Путь к базе парсера
+from app.ingest_daemon import IngestionDaemon # Непрерывная обработка новых сообщений
 from app.config import BASE_DIR # Нужен для построения пути к отчету по умолчанию
+from app.utils import message_store, report_builder
 # --- Конец новых импортов ---
 
 # --- Очередь для связи потоков ---
@@ -24,12 +26,15 @@ processing_queue = queue.Queue()
 last_successful_report_path = None 
 # --- Глобальная переменная для процесса парсера ---
 parser_process = None
+# --- Демон обработки новых сообщений и его поток ---
+ingestion_daemon = None
+ingestion_thread = None
+queue_check_active = False # Идет ли опрос processing_queue (check_processing_queue)
 parser_cwd = os.path.join(BASE_DIR, "app", "parser") # Определяем рабочую директорию парсера
 # --- Конец глобальных переменных ---
 
 
 def on_load_messages():
-    global last_successful_report_path
     selected_date = date_picker.get_date()
     date_str = selected_date.strftime('%Y-%m-%d')
     google_drive_url = drive_url_entry.get().strip() # Получаем URL и убираем пробелы
@@ -48,9 +53,31 @@ def on_load_messages():
         return
     # --- Конец проверки ---
 
+    # Демон прежней даты останавливается и дожидается сохранения уже начатых сообщений - без блокировки окна.
+    # Только после этого запускается парсер и новая обработка
+    load_button.config(state="disabled")
+    if ingestion_daemon is not None:
+        ingestion_daemon.stop()
+        root.title("Агро-отчёты - Остановка прежней обработки...")
+    when_thread_done(ingestion_thread, lambda: start_processing(date_str, google_drive_url, whatsapp_target_name))
+
+def when_thread_done(thread, callback):
+    """Вызывает callback в потоке окна, когда поток thread завершится (опрос через root.after, окно не блокируется)."""
+    if thread is not None and thread.is_alive():
+        root.after(200, when_thread_done, thread, callback)
+    else:
+        callback()
+
+def start_processing(date_str: str, google_drive_url: str, whatsapp_target_name: str):
+    """Запускает парсер и демон обработки за дату (прежний демон к этому моменту остановлен)."""
+    global last_successful_report_path, ingestion_daemon, ingestion_thread
+    load_button.config(state="normal")
+    ingestion_daemon, ingestion_thread = None, None
+
     # Запускаем парсер, если он еще не запущен, передавая URL и название чата
     if not start_parser(google_drive_url, whatsapp_target_name): # Передаем URL и название, проверяем результат
         logging.warning("Парсер не был запущен (возможно, из-за ошибки), обработка не начнется.")
+        root.title("Агро-отчёты")
         return
 
     # Очищаем таблицу перед запуском
@@ -59,22 +86,21 @@ def on_load_messages():
     last_successful_report_path = None
     root.update_idletasks()
 
-    load_button.config(state=tk.DISABLED)
-    root.title(f"Агро-отчёты - Запуск парсера и ожидание ({date_str})...")
+    root.title(f"Агро-отчёты - Обработка новых сообщений ({date_str})...")
+
+    # Сообщения обрабатываются по мере того, как парсер их сохраняет, отчет за дату обновляется в таблице
+    ingestion_daemon = IngestionDaemon(DB_PATH, date_str=date_str, google_drive_folder_url=google_drive_url,
+                                       on_report=processing_queue.put)
 
     # Функция-обертка для запуска в потоке
-    def processing_worker(date_to_process, drive_url, result_queue): # Добавляем drive_url
+    def processing_worker(daemon, result_queue):
         try:
-            # Ждем 30 секунд, давая парсеру время получить сообщения
-            logging.info(f"Ожидание {30} секунд для сбора сообщений парсером...")
-            root.title(f"Агро-отчёты - Сбор сообщений ({date_str}, {30} сек.)...") # Обновляем статус
-            time.sleep(30)
-            logging.info("Ожидание завершено. Запуск обработки LLM...")
-            root.title(f"Агро-отчёты - Обработка LLM ({date_str})...") # Обновляем статус
-
-            # Передаем URL в функцию бэкенда
-            result = asyncio.run(run_processing_for_date(date_to_process, google_drive_folder_url=drive_url))
-            result_queue.put(result)
+            if asyncio.run(daemon.run()) is None:
+                result_queue.put({
+                    'success': False,
+                    'message': "Не удалось запустить обработку LLM (см. лог).",
+                    'report_path': None
+                })
         except Exception as e:
             result_queue.put({
                 'success': False, 
@@ -83,49 +109,29 @@ def on_load_messages():
                 'processed_count': 0
             })
 
-    # Передаем URL в поток
-    thread = threading.Thread(target=processing_worker, args=(date_str, google_drive_url, processing_queue))
-    thread.start()
-    check_processing_queue()
+    ingestion_thread = threading.Thread(target=processing_worker, args=(ingestion_daemon, processing_queue))
+    ingestion_thread.start()
+    if not queue_check_active:
+        check_processing_queue() # Иначе очередь еще проверяется с прежней обработки
 
 def check_processing_queue():
-    """Проверяет очередь результатов из потока обработки."""
-    global last_successful_report_path
+    """Проверяет очередь обновлений отчета из потока обработки, пока поток работает."""
+    global last_successful_report_path, queue_check_active
+    queue_check_active = True
     try:
         result = processing_queue.get_nowait() # Проверяем без блокировки
 
-        # Обработка завершена, разблокируем кнопку и убираем индикатор
-        load_button.config(state=tk.NORMAL)
-        root.title("Агро-отчёты") 
-
         # Показываем сообщение о результате
         if result['success']:
-            # messagebox.showinfo("Завершено", result['message']) # Используем статичное сообщение
-            messagebox.showinfo("Завершено", "Отчет сохранен локально и на гугл диск")
+            root.title(f"Агро-отчёты - Отчет обновлен {time.strftime('%H:%M:%S')}")
         else:
             messagebox.showerror("Ошибка обработки", result['message'])
+            root.after(200, check_processing_queue)
             return # Не пытаемся читать отчет при ошибке
 
         # Если успешно и есть путь к отчету, читаем и отображаем
         if result['success'] and result['report_path'] and os.path.exists(result['report_path']):
-            try:
-                last_successful_report_path = result['report_path'] # Сохраняем путь
-                logging.info(f"Чтение данных из отчета: {last_successful_report_path}")
-                df = pd.read_excel(last_successful_report_path)
-                # Заменяем NaN на пустые строки для корректного отображения
-                df = df.fillna('') 
-                # Преобразуем DataFrame в список списков/кортежей для Treeview
-                report_data_for_table = df.to_records(index=False).tolist()
-                update_table(report_data_for_table) # Отправляем в таблицу
-                save_button.pack(pady=5) # Показываем кнопку сохранения после успешной загрузки
-            except FileNotFoundError:
-                messagebox.showerror("Ошибка", f"Файл отчета не найден: {result['report_path']}")
-                last_successful_report_path = None
-                save_button.pack_forget() # Скрываем кнопку, если отчет не найден
-            except Exception as e:
-                messagebox.showerror("Ошибка чтения отчета", f"Не удалось прочитать Excel файл: {e}")
-                last_successful_report_path = None
-                save_button.pack_forget() # Скрываем кнопку при ошибке чтения
+            show_report(result['report_path'])
         elif result['success']:
              # Обработка успешна, но отчет не создан (например, не было сообщений)
              # Просто очищаем таблицу (уже сделано в on_load_messages)
@@ -134,10 +140,64 @@ def check_processing_queue():
              save_button.pack_forget() # Скрываем кнопку, если отчет не создан
         else: # Если result['success'] == False
             save_button.pack_forget() # Скрываем кнопку при ошибке обработки
+        root.after(200, check_processing_queue)
 
     except queue.Empty:
-        # Очередь пуста, проверяем снова через 200 мс
-        root.after(200, check_processing_queue)
+        # Очередь пуста, проверяем снова через 200 мс, пока обработка не остановлена
+        if ingestion_thread is not None and ingestion_thread.is_alive():
+            root.after(200, check_processing_queue)
+        else:
+            queue_check_active = False
+            root.title("Агро-отчёты")
+
+def show_report(report_path: str):
+    """Читает отчет Excel и показывает его в таблице."""
+    global last_successful_report_path
+    try:
+        last_successful_report_path = report_path # Сохраняем путь
+        logging.info(f"Чтение данных из отчета: {last_successful_report_path}")
+        df = pd.read_excel(last_successful_report_path)
+        # Заменяем NaN на пустые строки для корректного отображения
+        df = df.fillna('') 
+        # Преобразуем DataFrame в список списков/кортежей для Treeview
+        report_data_for_table = df.to_records(index=False).tolist()
+        update_table(report_data_for_table) # Отправляем в таблицу
+        save_button.pack(pady=5) # Показываем кнопку сохранения после успешной загрузки
+    except FileNotFoundError:
+        messagebox.showerror("Ошибка", f"Файл отчета не найден: {report_path}")
+        last_successful_report_path = None
+        save_button.pack_forget() # Скрываем кнопку, если отчет не найден
+    except Exception as e:
+        messagebox.showerror("Ошибка чтения отчета", f"Не удалось прочитать Excel файл: {e}")
+        last_successful_report_path = None
+        save_button.pack_forget() # Скрываем кнопку при ошибке чтения
+
+def load_report_filter_values():
+    """Заполняет списки подразделений и операций значениями из сохраненных записей за выбранную дату."""
+    date_str = date_picker.get_date().strftime('%Y-%m-%d')
+    try:
+        department_combo['values'] = [""] + message_store.fetch_report_values(DB_PATH, "department", date_str)
+        operation_combo['values'] = [""] + message_store.fetch_report_values(DB_PATH, "operation", date_str)
+    except Exception as e:
+        logging.error(f"Не удалось прочитать значения для фильтров отчета: {e}")
+
+def on_build_report_from_store():
+    """Строит отчет за выбранную дату из уже сохраненных результатов, без парсера и LLM."""
+    date_str = date_picker.get_date().strftime('%Y-%m-%d')
+    department = department_combo.get().strip() or None # Пусто - все подразделения
+    operation = operation_combo.get().strip() or None # Пусто - все операции
+    output_filename = report_builder.report_filename(date_str, department=department, operation=operation)
+    result = report_builder.build_report(DB_PATH, output_filename, date_str, department=department, operation=operation)
+    for row in report_table.get_children():
+        report_table.delete(row)
+    if not result['success']:
+        messagebox.showerror("Ошибка отчета", result['message'])
+        save_button.pack_forget()
+    elif result['report_path']:
+        show_report(result['report_path'])
+    else:
+        messagebox.showinfo("Нет данных", result['message'])
+        save_button.pack_forget()
 
 def update_table(reports_data):
     # Очищаем старые строки (на всякий случай, хотя делаем это и в on_load_messages)
@@ -187,7 +247,8 @@ def on_save_excel():
 
 def start_parser(google_drive_url: str, whatsapp_target: str) -> bool:
     """
-    Запускает парсер node.js, если он еще не запущен. Предварительно удаляет старую БД.
+    Запускает парсер node.js, если он еще не запущен. База сообщений сохраняется между запусками: в ней же
+    хранятся результаты обработки (отчеты из базы), а уже сохраненные сообщения парсер повторно не добавляет.
     Передает URL папки Google Drive и название WhatsApp чата/группы как аргументы командной строки.
     Возвращает True, если парсер запущен успешно, иначе False.
     """
@@ -195,21 +256,6 @@ def start_parser(google_drive_url: str, whatsapp_target: str) -> bool:
     if parser_process is None or parser_process.poll() is not None:
         logging.info("Запуск процесса парсера node.js...")
         try:
-            # --- Удаление старой базы данных --- 
-            db_path = os.path.join(parser_cwd, 'messages.db')
-            if os.path.exists(db_path):
-                logging.info(f"Удаление существующего файла базы данных: {db_path}")
-                try:
-                    os.remove(db_path)
-                    logging.info("Старая база данных успешно удалена.")
-                except OSError as e:
-                    logging.error(f"Не удалось удалить файл базы данных {db_path}: {e}")
-                    messagebox.showerror("Ошибка БД", f"Не удалось удалить старую базу данных:\n{e}\nПарсер не будет запущен.")
-                    return False # Не запускаем парсер, если не удалось удалить БД
-            else:
-                logging.info("Файл базы данных не найден, удаление не требуется.")
-            # --- Конец удаления --- 
-
             # Запускаем node index.js, передавая URL и название WhatsApp-цели
             parser_command = ['node', 'index.js', google_drive_url, whatsapp_target] # Добавляем URL и название
             logging.info(f"Запуск команды: {' '.join(parser_command)} в {parser_cwd}")
@@ -262,7 +308,16 @@ def on_closing():
     """Обработчик закрытия окна."""
     if messagebox.askokcancel("Выход", "Вы уверены, что хотите выйти? Процесс парсера будет остановлен."):
         stop_parser()
-        root.destroy()
+        root.protocol("WM_DELETE_WINDOW", lambda: None) # Повторное закрытие во время остановки игнорируем
+        if ingestion_daemon is not None:
+            # Демон сохраняет уже начатые сообщения и последний раз обновляет отчет; окно ждет его, не блокируясь
+            ingestion_daemon.stop()
+            root.title("Агро-отчёты - Завершение обработки...")
+        when_thread_done(ingestion_thread, close_window)
+
+def close_window():
+    message_store.close_connections() # При закрытии последнего соединения SQLite переносит WAL-журнал в базу
+    root.destroy()
 
 # Главное окно
 root = tk.Tk()
@@ -309,6 +364,21 @@ load_button.pack(side="left", padx=10)
 load_button.config(default=tk.ACTIVE) # Попробуем сделать ее кнопкой по умолчанию
 # --- Конец Кнопки Загрузки ---
 
+# --- Отчет из сохраненных результатов (срез по подразделению / операции) ---
+store_report_frame = ttk.Frame(top_frame)
+store_report_frame.pack(pady=5, padx=10, anchor='w')
+department_label = ttk.Label(store_report_frame, text="Подразделение:")
+department_label.pack(side="left", padx=5)
+department_combo = ttk.Combobox(store_report_frame, width=20, postcommand=load_report_filter_values)
+department_combo.pack(side="left")
+operation_label = ttk.Label(store_report_frame, text="Операция:")
+operation_label.pack(side="left", padx=5)
+operation_combo = ttk.Combobox(store_report_frame, width=30, postcommand=load_report_filter_values)
+operation_combo.pack(side="left")
+store_report_button = ttk.Button(store_report_frame, text="Отчет из базы", command=on_build_report_from_store)
+store_report_button.pack(side="left", padx=10)
+# --- Конец отчета из сохраненных результатов ---
+
 # Таблица
 columns = [
     "Дата", "Подразделение", "Операция", "Культура",
@@ -0,0 +1,178 @@
+# Непрерывная обработка: новые сообщения базы парсера сразу уходят в потоковую обработку
+# (app/llm_integration/pipeline.py), отчет за дату обновляется по мере сохранения результатов.
+#
+# Новые строки отслеживаются по отметке rowid: парсер только добавляет строки, rowid растет с каждой вставкой,
+# и каждый опрос читает лишь строки после отметки. Пока парсер ничего не пишет, PRAGMA data_version не меняется
+# и запрос к таблице не выполняется; интервал проверки удваивается от DAEMON_POLL_MIN_S до DAEMON_POLL_MAX_S
+# и сбрасывается, как только появляются сообщения.
+#
+# Текущая дата для правил, промпта, кэша и проверки записей - дата каждого сообщения (см. pipeline.py),
+# а не дата запуска демона: после полуночи сообщения нового дня разбираются и проверяются по своей дате.
+
+import asyncio
+import functools
+import logging
+import os
+import signal
+import threading
+import time
+
+from app import config
+from app.llm_integration.pipeline import process_stream_async, ExtractionStoreSink
+from app.utils import message_store, report_builder
+from app.utils.google_drive_uploader import upload_to_drive
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class IngestionDaemon:
+    """
+    Демон обработки: читает новые сообщения по отметке rowid, передает их в потоковую обработку
+    (запросы к LLM собираются в пакеты по мере поступления) и обновляет отчеты дат, по которым сохранены
+    новые результаты. Работает до stop() / stop_event (в консоли - Ctrl+C или SIGTERM).
+    """
+
+    def __init__(self, db_path: str, date_str: str | None = None, google_drive_folder_url: str | None = None,
+                 stop_event: threading.Event | None = None, on_report=None, max_idle_s: float | None = None):
+        """
+        Args:
+            db_path: Путь к базе парсера.
+            date_str: Обрабатывать только сообщения этой даты YYYY-MM-DD (None - все даты).
+            google_drive_folder_url: URL папки Google Drive для отчетов (None - только локальные отчеты).
+            stop_event: Событие остановки (для запуска из другого потока, например из GUI).
+            on_report: Вызывается с результатом каждого обновления отчета: словарь build_report и ключ 'date'.
+            max_idle_s: Остановиться, если новых сообщений нет столько секунд (None - работать до остановки).
+        """
+        self.db_path = db_path
+        self.date_str = date_str
+        self.google_drive_folder_url = google_drive_folder_url
+        self.stop_event = stop_event or threading.Event()
+        self.on_report = on_report
+        self.max_idle_s = max_idle_s
+        self.sink = ExtractionStoreSink(db_path)
+        self.high_water_mark = 0 # rowid последнего прочитанного сообщения
+        self.ingested = 0 # Передано в обработку
+        self._report_times = {} # Дата -> время последнего обновления отчета
+        self._upload_times = {} # Дата -> время последней загрузки на Google Drive
+        self._pending_uploads = {} # Дата -> путь к отчету, еще не загруженному после обновления
+        self._report_task = None # Фоновое обновление отчетов (опрос новых сообщений его не ждет)
+
+    def stop(self) -> None:
+        """Останавливает чтение новых сообщений; уже прочитанные обрабатываются до конца."""
+        self.stop_event.set()
+
+    async def _wait(self, seconds: float) -> None:
+        # Короткими интервалами, чтобы остановка не ждала полного интервала опроса
+        deadline = time.monotonic() + seconds
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(min(config.DAEMON_POLL_MIN_S, deadline - time.monotonic()))
+
+    async def messages(self):
+        """
+        Асинхронный источник для process_stream_async: новые необработанные сообщения по мере появления.
+
+        Yields:
+            Кортежи (id, text, дата сообщения YYYY-MM-DD).
+        """
+        interval = config.DAEMON_POLL_MIN_S
+        version = None
+        idle_since = time.monotonic()
+        loop = asyncio.get_running_loop()
+        while not self.stop_event.is_set():
+            # Запросы к SQLite - в пуле потоков: опрос не останавливает запросы к LLM и сохранение результатов
+            current_version = await loop.run_in_executor(None, message_store.data_version, self.db_path)
+            rows = []
+            if current_version != version:
+                version = current_version
+                rows = await loop.run_in_executor(
+                    None, message_store.fetch_new_messages, self.db_path, self.high_water_mark, self.date_str
+                )
+            if rows:
+                self.high_water_mark = rows[-1][0]
+                if len(rows) == config.SQLITE_FETCH_PAGE_SIZE:
+                    version = None # Страница заполнена - дочитываем, не дожидаясь новых записей парсера
+                logging.info(f"Новых сообщений: {len(rows)} (отметка rowid {self.high_water_mark}).")
+                for _, message_id, text, date in rows:
+                    self.ingested += 1
+                    yield message_id, text, date
+                interval = config.DAEMON_POLL_MIN_S
+                idle_since = time.monotonic()
+                continue
+
+            # Результат каждого сообщения сохраняется своей транзакцией - отчет из базы согласован и во время обработки.
+            # Отчет пишется в фоне: новые сообщения читаются и передаются в обработку, не дожидаясь файла
+            if self._report_task is None or self._report_task.done():
+                self._check_report_task()
+                self._report_task = asyncio.create_task(self._refresh_reports())
+            # Пока прочитанные сообщения обрабатываются, опрос частый: отчет обновится вскоре после сохранения
+            drained = self.sink.saved == self.ingested
+            if drained:
+                if self.max_idle_s is not None and time.monotonic() - idle_since >= self.max_idle_s:
+                    logging.info(f"Новых сообщений нет {self.max_idle_s:.0f} с, демон останавливается.")
+                    return
+            interval = min(interval * 2, config.DAEMON_POLL_MAX_S) if drained else config.DAEMON_POLL_MIN_S
+            await self._wait(interval)
+
+    def _check_report_task(self) -> None:
+        # Ошибка фонового обновления не останавливает демон, но попадает в лог
+        if self._report_task is not None and not self._report_task.cancelled() and self._report_task.exception():
+            logging.error(f"Ошибка при обновлении отчетов: {self._report_task.exception()}")
+
+    async def _refresh_reports(self, final: bool = False) -> None:
+        """Перестраивает отчеты дат с новыми результатами (не чаще DAEMON_REPORT_INTERVAL_S) и загружает их."""
+        now = time.monotonic()
+        loop = asyncio.get_running_loop()
+        for date in sorted(self.sink.updated_dates):
+            if not final and now - self._report_times.get(date, float("-inf")) < config.DAEMON_REPORT_INTERVAL_S:
+                continue
+            self.sink.updated_dates.discard(date)
+            self._report_times[date] = now
+            # Файл пишется в отдельном потоке: цикл событий тем временем продолжает обработку сообщений
+            report = await loop.run_in_executor(None, report_builder.build_report, self.db_path,
+                                                report_builder.report_filename(date), date)
+            if report['report_path']:
+                self._pending_uploads[date] = report['report_path']
+            if self.on_report is not None:
+                self.on_report(dict(report, date=date))
+
+        if not self.google_drive_folder_url:
+            return
+        for date, report_path in sorted(self._pending_uploads.items()):
+            # Файл на диске обновляется, а не создается заново: ссылка на отчет за день не меняется
+            if not final and now - self._upload_times.get(date, float("-inf")) < config.DAEMON_UPLOAD_INTERVAL_S:
+                continue
+            del self._pending_uploads[date]
+            self._upload_times[date] = now
+            try:
+                await loop.run_in_executor(None, functools.partial(
+                    upload_to_drive, report_path, os.path.basename(report_path), self.google_drive_folder_url,
+                    replace_existing=True
+                ))
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке отчета {report_path} на Google Drive: {e}")
+
+    async def run(self) -> dict | None:
+        """
+        Запускает демон и ждет его остановки.
+
+        Returns:
+            Статистика потоковой обработки (см. process_stream_async) или None при ошибке инициализации.
+        """
+        if threading.current_thread() is threading.main_thread():
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(sig, self.stop)
+                except NotImplementedError:
+                    pass # Windows: остановка по Ctrl+C прерывает обработку, оставшееся продолжится при следующем запуске
+        logging.info(f"--- Запуск непрерывной обработки ({self.date_str or 'все даты'}), база: {self.db_path} ---")
+        stats = await process_stream_async(self.messages(), self.sink)
+        if self._report_task is not None:
+            await asyncio.wait([self._report_task])
+            self._check_report_task()
+        if stats is not None:
+            # Последние результаты - в отчеты и на диск без ожидания интервалов
+            await self._refresh_reports(final=True)
+        logging.info(f"--- Непрерывная обработка остановлена. Обработано сообщений: {self.ingested} ---")
+        return stats
@@ -0,0 +1,488 @@
+# Офлайн-обработка больших объемов сообщений через пакетный API провайдера (Batch API в формате OpenAI).
+#
+# Бэкфилл сезона через интерактивный process_batch_async идет медленно и по полной цене. Пакетное
+# задание записывает все запросы в JSONL-файлы, отправляет их провайдеру (POST /files + POST /batches;
+# локальная заглушка app/utils/llm_stub_server.py реализует тот же контракт), опрашивает статус и
+# разбирает ответы через extract_json_list в ту же базу результатов и те же отчеты, что и обычная обработка.
+#
+# Каждый этап сохраняется в папке задания (config.LLM_BULK_JOBS_DIR/<имя задания>):
+#   plan.json            - сообщения задания, повторы и записи, полученные без LLM (правила, кэш)
+#   requests_NNN.jsonl   - запросы пакета NNN
+#   state.json           - этап задания и пакеты (id файлов и пакетов у провайдера, статусы)
+#   results_NNN.jsonl    - ответы провайдера (и errors_NNN.jsonl - запросы с ошибками)
+# Прерванный запуск с тем же именем задания продолжается с сохраненного этапа: файлы не загружаются
+# и пакеты не создаются повторно.
+
+import datetime
+import json
+import logging
+import os
+import time
+
+from app import config
+from app.llm_integration.client import TextGenerationClient, BaseLLMClient, JSON_OUTPUT_REPORTS
+from app.llm_integration.prompt_builder import (
+    load_mapping_file, build_extraction_prefix, build_message_prompt, build_pruned_extraction_prefix,
+    build_pruned_message_prompt
+)
+from app.llm_integration.extractor import extract_json_list, reset_parse_stats, get_parse_stats
+from app.llm_integration.cache import LLMResponseCache, build_prompt_fingerprint
+from app.llm_integration.rule_parser import RuleBasedParser
+from app.llm_integration.dedup import find_duplicates
+from app.llm_integration.reference_index import ReferenceIndex
+from app.llm_integration.validator import RecordValidator
+from app.llm_integration.processor import make_cache_key
+from app.llm_integration.constants import EXTRACTION_MESSAGE_TEMPLATE, STRUCTURED_OUTPUT_NOTE
+from app.utils import message_store, report_builder
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+BULK_ENDPOINT = "/v1/chat/completions"
+BULK_COMPLETION_WINDOW = "24h" # Единственное окно, которое принимает OpenAI
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Этапы задания
+JOB_PREPARED = "prepared" # Файлы запросов записаны
+JOB_SUBMITTED = "submitted" # Пакеты созданы у провайдера
+JOB_DOWNLOADED = "downloaded" # Пакеты завершены, результаты скачаны
+JOB_INGESTED = "ingested" # Ответы разобраны, отчеты сохранены
+
+
+def _custom_id(index: int) -> str:
+    return f"msg-{index}"
+
+
+def _index_from_custom_id(custom_id: str) -> int | None:
+    try:
+        return int(custom_id.split("-", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class BulkJob:
+    """Папка пакетного задания: план, состояние и файлы запросов/результатов (см. описание модуля)."""
+
+    def __init__(self, name: str, jobs_dir: str | None = None):
+        self.name = name
+        self.dir = os.path.join(jobs_dir or config.LLM_BULK_JOBS_DIR, name)
+        self.state = self._read("state.json") or {}
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.state)
+
+    @property
+    def stage(self) -> str | None:
+        return self.state.get("stage")
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.dir, filename)
+
+    def _read(self, filename: str) -> dict | None:
+        try:
+            with open(self.path(filename), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, filename: str, data: dict) -> None:
+        # Через временный файл: прерванная запись не портит сохраненное состояние
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = self.path(filename + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(filename))
+
+    def load_plan(self) -> dict:
+        return self._read("plan.json")
+
+    def save_plan(self, plan: dict) -> None:
+        self._write("plan.json", plan)
+
+    def save_state(self, **changes) -> None:
+        self.state.update(changes, updated_at=datetime.datetime.now().isoformat())
+        self._write("state.json", self.state)
+
+
+def _load_references() -> tuple[str, str, str]:
+    cultures_content = load_mapping_file(config.CULTURES_FILE_PATH)
+    operations_content = load_mapping_file(config.OPERATIONS_FILE_PATH)
+    with open(config.DEPARTMENTS_FILE_PATH, 'r', encoding='utf-8') as f:
+        departments_content = f.read()
+    return cultures_content, operations_content, departments_content
+
+
+def _open_cache(use_cache: bool) -> LLMResponseCache:
+    return LLMResponseCache(
+        config.LLM_CACHE_PATH,
+        max_age_days=config.LLM_CACHE_MAX_AGE_DAYS,
+        max_size_mb=config.LLM_CACHE_MAX_SIZE_MB,
+        enabled=use_cache and config.LLM_CACHE_ENABLED
+    )
+
+
+def prepare_bulk_job(job: BulkJob, messages: list[str], message_ids: list[str], message_dates: list[str],
+                     llm_client: BaseLLMClient, use_cache: bool = True) -> None:
+    """
+    Строит запросы задания и записывает их в JSONL-файлы пакетов.
+
+    Как и в process_batch_async, повторы (в пределах одной даты) и сообщения, разобранные правилами
+    или найденные в кэше, в LLM не отправляются. Текущая дата в промпте - дата сообщения, а не
+    дата запуска: сообщение без даты в тексте относится к дню, когда его прислали.
+
+    Args:
+        job: Новое (пустое) задание.
+        messages: Тексты сообщений.
+        message_ids: ID сообщений из БД.
+        message_dates: Даты сообщений YYYY-MM-DD (по ним же сообщения разбиваются на отчеты).
+        llm_client: Клиент провайдера пакетного API (модель и формат ответа берутся из него).
+        use_cache: Использовать дисковый кэш результатов.
+    """
+    cultures_content, operations_content, departments_content = _load_references()
+    reference_index = None
+    if config.LLM_PRUNE_REFERENCES:
+        reference_index = ReferenceIndex(cultures_content, operations_content, departments_content)
+        system_prompt = build_pruned_extraction_prefix()
+    else:
+        system_prompt = build_extraction_prefix(cultures_content, operations_content, departments_content)
+    prompt_fingerprint = build_prompt_fingerprint(
+        system_prompt, EXTRACTION_MESSAGE_TEMPLATE, cultures_content, operations_content, departments_content,
+        STRUCTURED_OUTPUT_NOTE if config.LLM_STRUCTURED_OUTPUT else ""
+    )
+    rule_parser = RuleBasedParser.from_contents(cultures_content, operations_content, departments_content)
+    cache = _open_cache(use_cache)
+
+    # Повторы ищутся внутри каждой даты: отчеты строятся по датам, как при обычной обработке
+    canonical = list(range(len(messages)))
+    similarity = [0.0] * len(messages)
+    if config.MESSAGE_DEDUP_ENABLED:
+        indices_by_date = {}
+        for i, date in enumerate(message_dates):
+            indices_by_date.setdefault(date, []).append(i)
+        for indices in indices_by_date.values():
+            date_canonical, date_similarity = find_duplicates([messages[i] for i in indices], config.MESSAGE_DEDUP_THRESHOLD)
+            for position, i in enumerate(indices):
+                canonical[i] = indices[date_canonical[position]]
+                similarity[i] = date_similarity[position]
+
+    precomputed = {} # Номер сообщения -> записи, полученные без LLM
+    cache_keys = {} # Номер сообщения -> ключ кэша (ответ сохраняется в кэш при разборе результатов)
+    parts = []
+    max_bytes = int(config.LLM_BULK_MAX_FILE_MB * 1024 * 1024)
+    request_file = None
+    json_output = JSON_OUTPUT_REPORTS if config.LLM_STRUCTURED_OUTPUT else None
+    try:
+        for i, message in enumerate(messages):
+            if canonical[i] != i:
+                continue
+            current_date = message_dates[i]
+            if config.RULE_PARSER_ENABLED:
+                records = rule_parser.parse(message, current_date)
+                if records is not None:
+                    precomputed[str(i)] = records
+                    continue
+            if cache.enabled:
+                cache_key = make_cache_key(message, llm_client, prompt_fingerprint, current_date)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    precomputed[str(i)] = cached
+                    continue
+                cache_keys[str(i)] = cache_key
+
+            if reference_index is not None:
+                prompt = build_pruned_message_prompt(message, reference_index.select(message), current_date)
+            else:
+                prompt = build_message_prompt(message, current_date)
+            if config.LLM_STRUCTURED_OUTPUT:
+                prompt += STRUCTURED_OUTPUT_NOTE
+            line = json.dumps({
+                "custom_id": _custom_id(i),
+                "method": "POST",
+                "url": BULK_ENDPOINT,
+                "body": llm_client.build_request_body(prompt, system_prompt, json_output),
+            }, ensure_ascii=False) + "\n"
+            line_bytes = len(line.encode('utf-8'))
+
+            # Новый пакет, если текущий достиг лимита провайдера по числу запросов или размеру файла
+            if not parts or parts[-1]["requests"] >= config.LLM_BULK_MAX_REQUESTS or parts[-1]["bytes"] + line_bytes > max_bytes:
+                if request_file is not None:
+                    request_file.close()
+                parts.append({"file": f"requests_{len(parts):03d}.jsonl", "requests": 0, "bytes": 0})
+                os.makedirs(job.dir, exist_ok=True)
+                request_file = open(job.path(parts[-1]["file"]), 'w', encoding='utf-8')
+            request_file.write(line)
+            parts[-1]["requests"] += 1
+            parts[-1]["bytes"] += line_bytes
+    finally:
+        if request_file is not None:
+            request_file.close()
+        cache.close()
+
+    job.save_plan({
+        "messages": [{"id": message_ids[i], "date": message_dates[i]} for i in range(len(messages))],
+        "canonical": canonical,
+        "similarity": [round(value, 3) for value in similarity],
+        "precomputed": precomputed,
+        "cache_keys": cache_keys,
+    })
+    job.save_state(
+        stage=JOB_PREPARED, provider=llm_client.provider, model_name=llm_client.model_name,
+        temperature=llm_client.temperature, created_at=datetime.datetime.now().isoformat(),
+        parts=parts
+    )
+    requests_total = sum(part["requests"] for part in parts)
+    logging.info(f"Пакетное задание '{job.name}': {len(messages)} сообщений, в LLM - {requests_total} запросов "
+                 f"в {len(parts)} пакетах, без LLM (правила/кэш) - {len(precomputed)}, "
+                 f"повторов - {sum(1 for i, c in enumerate(canonical) if c != i)}.")
+
+
+def submit_bulk_job(job: BulkJob, llm_client: BaseLLMClient) -> bool:
+    """
+    Загружает файлы запросов и создает пакеты. Id файла и пакета сохраняются сразу после
+    каждого вызова, поэтому при повторном запуске уже созданное не создается заново.
+
+    Returns:
+        True, если все пакеты созданы.
+    """
+    for number, part in enumerate(job.state["parts"]):
+        if part.get("batch_id"):
+            continue
+        try:
+            if not part.get("input_file_id"):
+                with open(job.path(part["file"]), 'rb') as f:
+                    uploaded = llm_client.client.files.create(file=(part["file"], f), purpose="batch")
+                part["input_file_id"] = uploaded.id
+                job.save_state(parts=job.state["parts"])
+                logging.info(f"Пакет {number + 1}/{len(job.state['parts'])}: файл {part['file']} загружен ({uploaded.id}).")
+            batch = llm_client.client.batches.create(
+                input_file_id=part["input_file_id"],
+                endpoint=BULK_ENDPOINT,
+                completion_window=BULK_COMPLETION_WINDOW,
+                metadata={"job": job.name, "part": str(number)}
+            )
+        except Exception as e:
+            logging.error(f"Не удалось отправить пакет {number + 1} задания '{job.name}' в {llm_client.display_name}: {e}")
+            return False
+        part["batch_id"] = batch.id
+        part["status"] = batch.status
+        job.save_state(parts=job.state["parts"])
+        logging.info(f"Пакет {number + 1}/{len(job.state['parts'])} создан: {batch.id} ({part['requests']} запросов).")
+    job.save_state(stage=JOB_SUBMITTED)
+    return True
+
+
+def _download_file(llm_client: BaseLLMClient, file_id: str, path: str) -> None:
+    content = llm_client.client.files.content(file_id).content
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def wait_for_bulk_job(job: BulkJob, llm_client: BaseLLMClient, poll_interval: float, wait: bool = True) -> bool:
+    """
+    Опрашивает статус пакетов до завершения и скачивает результаты.
+
+    Args:
+        wait: False - проверить статус один раз (задание можно продолжить позже тем же вызовом).
+
+    Returns:
+        True, если все пакеты завершены и результаты скачаны.
+    """
+    parts = job.state["parts"]
+    while True:
+        for number, part in enumerate(parts):
+            if part.get("status") in BATCH_TERMINAL_STATUSES:
+                continue
+            try:
+                batch = llm_client.client.batches.retrieve(part["batch_id"])
+            except Exception as e:
+                logging.warning(f"Не удалось получить статус пакета {part['batch_id']}: {e}")
+                continue
+            counts = getattr(batch, "request_counts", None)
+            part.update(
+                status=batch.status,
+                output_file_id=getattr(batch, "output_file_id", None),
+                error_file_id=getattr(batch, "error_file_id", None),
+                request_counts={"total": getattr(counts, "total", 0), "completed": getattr(counts, "completed", 0),
+                                "failed": getattr(counts, "failed", 0)} if counts else None
+            )
+            done = f", выполнено {part['request_counts']['completed']}/{part['request_counts']['total']}" if counts else ""
+            logging.info(f"Пакет {number + 1}/{len(parts)} ({part['batch_id']}): {batch.status}{done}.")
+        job.save_state(parts=parts)
+        if all(part.get("status") in BATCH_TERMINAL_STATUSES for part in parts):
+            break
+        if not wait:
+            return False
+        time.sleep(poll_interval)
+
+    for number, part in enumerate(parts):
+        if part["status"] != "completed":
+            logging.error(f"Пакет {number + 1} ({part['batch_id']}) завершился со статусом {part['status']}, "
+                          f"его сообщения останутся без данных.")
+        for key, prefix in (("output_file_id", "results"), ("error_file_id", "errors")):
+            filename = f"{prefix}_{number:03d}.jsonl"
+            if part.get(key) and not os.path.exists(job.path(filename)):
+                try:
+                    _download_file(llm_client, part[key], job.path(filename))
+                except Exception as e:
+                    logging.error(f"Не удалось скачать {filename} ({part[key]}): {e}")
+                    return False
+    job.save_state(stage=JOB_DOWNLOADED)
+    return True
+
+
+def ingest_bulk_job(job: BulkJob, db_path: str, report_path_for_date, use_cache: bool = True) -> dict:
+    """
+    Разбирает ответы пакетов через extract_json_list, сохраняет результат каждого сообщения в базу
+    (message_store.save_message_result, как потоковая обработка) и строит отчеты по датам из базы.
+
+    Args:
+        db_path: Путь к базе парсера.
+        report_path_for_date: Функция дата -> путь к файлу отчета.
+        use_cache: Сохранять извлеченные записи в дисковый кэш (повторная обработка не пойдет в LLM).
+
+    Returns:
+        Словарь дата -> {"report_path": путь или None, "message_ids": [...], "records": число записей,
+        "failed": число сообщений, обработка которых не удалась} для всех дат задания.
+        Неудачные сообщения остаются необработанными и попадут в следующий запуск.
+    """
+    plan = job.load_plan()
+    messages = plan["messages"]
+    canonical = plan["canonical"]
+    results = [None] * len(messages)
+    for index, records in plan["precomputed"].items():
+        results[int(index)] = records
+
+    validator = None
+    if config.RECORD_VALIDATION_ENABLED:
+        validator = RecordValidator.from_contents(*_load_references())
+    cache = _open_cache(use_cache)
+    reset_parse_stats()
+    usage = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    failed_requests = 0
+    try:
+        for number, part in enumerate(job.state["parts"]):
+            path = job.path(f"results_{number:03d}.jsonl")
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    i = _index_from_custom_id(result.get("custom_id"))
+                    response = result.get("response") or {}
+                    if i is None or i >= len(messages) or response.get("status_code") != 200:
+                        failed_requests += 1
+                        continue
+                    body = response.get("body") or {}
+                    body_usage = body.get("usage") or {}
+                    usage["prompt_tokens"] += body_usage.get("prompt_tokens") or 0
+                    usage["cached_tokens"] += (body_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+                    usage["completion_tokens"] += body_usage.get("completion_tokens") or 0
+                    try:
+                        content = body["choices"][0]["message"]["content"]
+                    except (KeyError, IndexError, TypeError):
+                        failed_requests += 1
+                        continue
+                    records = extract_json_list(content) if content else None
+                    if records is None:
+                        logging.warning(f"[Msg {i+1}] Не удалось извлечь JSON из ответа пакета:\n{content}")
+                        continue
+                    if validator is not None and records:
+                        # Повторный запрос в пакетном режиме не отправляется - ошибки только учитываются
+                        validator.find_invalid(records, messages[i]["date"])
+                    results[i] = records
+                    if cache.enabled and str(i) in plan["cache_keys"]:
+                        cache.set(plan["cache_keys"][str(i)], records)
+            errors_path = job.path(f"errors_{number:03d}.jsonl")
+            if os.path.exists(errors_path):
+                with open(errors_path, 'r', encoding='utf-8') as f:
+                    failed_requests += sum(1 for line in f if line.strip())
+    finally:
+        cache.close()
+
+    parse_stats = get_parse_stats()
+    logging.info(f"Ответы пакетов разобраны: {parse_stats['responses']} ответов, не удалось разобрать {parse_stats['failures']}, "
+                 f"восстановлено парсером {parse_stats['repaired']}, запросов с ошибкой {failed_requests}.")
+    if usage["prompt_tokens"]:
+        logging.info(f"Токены задания ({job.state['model_name']}): промпт {usage['prompt_tokens']} "
+                     f"(из кэша провайдера {usage['cached_tokens']}), ответ {usage['completion_tokens']}")
+    if validator is not None:
+        validator.log_summary()
+
+    # Результаты сообщений - в базу; повтор неудачного сообщения тоже считается неудачным и будет повторен
+    indices_by_date = {}
+    for i, message in enumerate(messages):
+        indices_by_date.setdefault(message["date"], []).append(i)
+        original = canonical[i]
+        if original != i and results[original] is not None:
+            message_store.save_message_result(db_path, message["id"], message["date"], duplicate_of=messages[original]["id"],
+                                              similarity=plan["similarity"][i])
+        else:
+            message_store.save_message_result(db_path, message["id"], message["date"], results[original])
+
+    reports = {}
+    for date, indices in sorted(indices_by_date.items()):
+        report = report_builder.build_report(db_path, report_path_for_date(date), date)
+        if not report['success']:
+            logging.error(f"Отчет пакетного задания за {date} не сохранен: {report['message']}")
+        reports[date] = {
+            "report_path": report['report_path'],
+            "message_ids": [messages[i]["id"] for i in indices],
+            "records": sum(len(results[i]) for i in indices if canonical[i] == i and results[i]),
+            "failed": sum(1 for i in indices if results[canonical[i]] is None),
+        }
+    job.save_state(stage=JOB_INGESTED, reports=reports, failed_requests=failed_requests)
+    return reports
+
+
+def run_bulk_job(job_name: str, messages: list[str] | None = None, message_ids: list[str] | None = None,
+                 message_dates: list[str] | None = None, db_path: str | None = None, report_path_for_date=None, wait: bool = True,
+                 poll_interval: float | None = None, use_cache: bool = True) -> dict | None:
+    """
+    Выполняет пакетное задание от начала или продолжает сохраненное с того же этапа.
+
+    Args:
+        job_name: Имя задания (папка в config.LLM_BULK_JOBS_DIR).
+        messages, message_ids, message_dates: Сообщения нового задания. Для уже созданного задания
+            не используются: задание продолжается со своим набором сообщений.
+        db_path: Путь к базе парсера (результаты сообщений сохраняются в нее, отчеты строятся из нее).
+        report_path_for_date: Функция дата -> путь к файлу отчета.
+        wait: False - не ждать завершения пакетов (повторный вызов продолжит задание).
+        poll_interval: Период опроса статуса, с (по умолчанию config.LLM_BULK_POLL_INTERVAL).
+        use_cache: Использовать дисковый кэш результатов.
+
+    Returns:
+        Отчеты по датам (см. ingest_bulk_job) или None, если задание еще не завершено или не удалось.
+    """
+    job = BulkJob(job_name)
+    try:
+        llm_client = TextGenerationClient(config.LLM_BULK_PROVIDER)
+    except Exception as e:
+        logging.error(f"Не удалось инициализировать клиента пакетного API ({config.LLM_BULK_PROVIDER}): {e}")
+        return None
+
+    if not job.exists:
+        if not messages:
+            logging.info(f"Пакетное задание '{job_name}': нет сообщений для обработки.")
+            return {}
+        prepare_bulk_job(job, messages, message_ids, message_dates, llm_client, use_cache=use_cache)
+    else:
+        logging.info(f"Продолжение пакетного задания '{job_name}' с этапа '{job.stage}'.")
+        if (job.state.get("provider"), job.state.get("model_name")) != (llm_client.provider, llm_client.model_name):
+            logging.warning(f"Задание создано для {job.state.get('provider')}/{job.state.get('model_name')}, "
+                            f"текущие настройки - {llm_client.provider}/{llm_client.model_name}.")
+
+    if job.stage == JOB_PREPARED and not submit_bulk_job(job, llm_client):
+        return None
+    if job.stage == JOB_SUBMITTED:
+        interval = poll_interval if poll_interval is not None else config.LLM_BULK_POLL_INTERVAL
+        if not wait_for_bulk_job(job, llm_client, interval, wait=wait):
+            logging.info(f"Пакетное задание '{job_name}' еще выполняется, продолжите его повторным запуском.")
+            return None
+    if job.stage == JOB_DOWNLOADED:
+        return ingest_bulk_job(job, db_path, report_path_for_date, use_cache=use_cache)
+    return job.state.get("reports", {})
@@ -0,0 +1,168 @@
+# Дисковый кэш результатов извлечения данных LLM (content-addressed)
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def build_prompt_fingerprint(prompt_template: str, *reference_contents: str) -> str:
+    """Вычисляет хэш шаблона промпта вместе с содержимым справочников.
+
+    Любое изменение промпта или файлов в data/mappings/ дает новый отпечаток,
+    поэтому старые записи кэша перестают совпадать автоматически.
+    """
+    digest = hashlib.sha256()
+    for part in (prompt_template, *reference_contents):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00') # Разделитель, чтобы "ab"+"c" не совпадало с "a"+"bc"
+    return digest.hexdigest()
+
+
+class LLMResponseCache:
+    """Кэш извлеченных записей на основе SQLite.
+
+    Ключ - хэш от текста сообщения, отпечатка промпта, провайдера, модели,
+    температуры и текущей даты (она подставляется в промпт для сообщений без даты).
+    Поддерживает вытеснение по возрасту и по суммарному размеру, а также счетчики попаданий.
+    """
+
+    def __init__(self, path: str, max_age_days: float = 30, max_size_mb: float = 200, enabled: bool = True):
+        self.path = path
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._conn = None
+        if not self.enabled:
+            logging.info("Кэш LLM отключен.")
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+            self._conn.commit()
+            self.evict()
+            logging.info(f"Кэш LLM открыт: {path}")
+        except sqlite3.Error as e:
+            # Кэш - оптимизация, а не обязательная часть: при ошибке работаем без него
+            logging.error(f"Не удалось открыть кэш LLM {path}: {e}. Работаем без кэша.")
+            self._conn = None
+            self.enabled = False
+
+    @staticmethod
+    def make_key(message: str, prompt_fingerprint: str, provider: str, model_name: str,
+                 temperature: float, current_date: str) -> str:
+        """Формирует ключ кэша для сообщения."""
+        payload = json.dumps(
+            [message, prompt_fingerprint, provider, model_name, temperature, current_date],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> list | None:
+        """Возвращает закэшированный список записей или None при промахе."""
+        if not self.enabled:
+            return None
+        try:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Ошибка чтения из кэша LLM: {e}")
+            self.misses += 1
+            return None
+
+    def set(self, key: str, records: list) -> None:
+        """Сохраняет список извлеченных записей в кэш."""
+        if not self.enabled:
+            return
+        try:
+            value = json.dumps(records, ensure_ascii=False)
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            self._conn.commit()
+            self.writes += 1
+            if self.writes % 100 == 0: # Периодически проверяем лимиты, не на каждой записи
+                self.evict()
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка записи в кэш LLM: {e}")
+
+    def evict(self) -> int:
+        """Удаляет устаревшие записи и самые давно использованные, если превышен лимит размера.
+
+        Returns:
+            Количество удаленных записей.
+        """
+        if not self.enabled:
+            return 0
+        removed = 0
+        try:
+            cursor = self._conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+            )
+            removed += cursor.rowcount
+            total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+            if total_size > self.max_size_bytes:
+                # Идем от самых старых по последнему обращению, пока не уложимся в лимит
+                to_delete = []
+                for key, size in self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access"):
+                    if total_size <= self.max_size_bytes:
+                        break
+                    to_delete.append((key,))
+                    total_size -= size
+                self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", to_delete)
+                removed += len(to_delete)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при очистке кэша LLM: {e}")
+        if removed:
+            self.evictions += removed
+            logging.info(f"Из кэша LLM удалено {removed} записей.")
+        return removed
+
+    def stats(self) -> dict:
+        """Возвращает счетчики работы кэша."""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def close(self) -> None:
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+        self.enabled = False
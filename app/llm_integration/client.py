@@ -1,22 +1,30 @@
 # Код для инициализации клиента LLM (DeepSeek/OpenAI) и отправки запросов 
-import os
 import logging
-import datetime # Добавил datetime для примера
+import time
 import asyncio # Добавлено
 import aiohttp # Добавлено
-from openai import OpenAI, APITimeoutError, APIConnectionError, RateLimitError, APIStatusError, AsyncOpenAI
-from abc import ABC, abstractmethod
+from openai import OpenAI, APIStatusError, AsyncOpenAI
+from abc import ABC
 
 try:
     from app import config
-    from app.llm_integration.constants import SYSTEM_ROLE_CONTENT # Импортируем константу
+    from app.llm_integration.constants import SYSTEM_ROLE_CONTENT, OPENAI_REPORT_SCHEMA # Импортируем константы
+    from app.llm_integration.concurrency import AdaptiveConcurrencyLimiter
+    from app.llm_integration.resilience import (
+        RetryPolicy, CircuitBreaker, LatencyTracker, classify_error, get_retry_after, is_overload_error, RETRYABLE_ERRORS
+    )
 except ImportError:
     # Если запуск происходит не из корня проекта, пробуем относительный импорт
     import config
+    from llm_integration.concurrency import AdaptiveConcurrencyLimiter
+    from llm_integration.resilience import (
+        RetryPolicy, CircuitBreaker, LatencyTracker, classify_error, get_retry_after, is_overload_error, RETRYABLE_ERRORS
+    )
     # Попытка импорта константы при запуске не из корня (может не сработать без __init__.py)
     try:
-        from llm_integration.constants import SYSTEM_ROLE_CONTENT
+        from llm_integration.constants import SYSTEM_ROLE_CONTENT, OPENAI_REPORT_SCHEMA
     except ImportError:
+        OPENAI_REPORT_SCHEMA = None
          # Запасной вариант, если импорт не сработал
         SYSTEM_ROLE_CONTENT = (
             "You are an AI assistant designed to extract structured data "
@@ -27,164 +35,613 @@ except ImportError:
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Ожидаемый вид JSON-ответа (параметр json_output в generate_response*)
+JSON_OUTPUT_REPORTS = "reports" # Объект {"reports": [записи]} - запрос по одному сообщению
+JSON_OUTPUT_BATCH = "batch" # Объект {id сообщения: [записи]} - пакетный запрос
+
+
+def _is_response_format_rejected(error: Exception) -> bool:
+    """Провайдер/модель не поддерживает переданный response_format."""
+    if not isinstance(error, APIStatusError) or error.status_code not in (400, 422):
+        return False
+    text = str(error).lower()
+    return "response_format" in text or "json_schema" in text or "json_object" in text
+
+
 class BaseLLMClient(ABC):
-    """Абстрактный базовый класс для клиентов LLM."""
+    """Абстрактный базовый класс для клиентов LLM.
+
+    Общая логика запросов (сборка сообщений, вызов chat.completions, учет токенов,
+    повторные попытки и circuit breaker) реализована здесь; наследники задают провайдера,
+    модель и создают self.client / self.async_client (с max_retries=0 - повторами управляет этот класс).
+    """
+    display_name = "LLM" # Имя провайдера для логов
+    supports_json_schema = False # Поддерживает ли провайдер response_format с JSON-схемой (иначе - json_object)
+
     def __init__(self):
         self.provider = "unknown"
         self.model_name = "unknown"
         self.temperature = config.LLM_TEMPERATURE # Сохраняем температуру из конфига
+        self.client = None
+        self.async_client = None
+        # Накопительная статистика токенов (в т.ч. закэшированных провайдером)
+        self.usage_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        # Ограничитель одновременных асинхронных запросов, адаптирующийся к задержкам и 429/5xx
+        self.concurrency_limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=config.MAX_CONCURRENT_REQUESTS,
+            min_limit=config.LLM_MIN_CONCURRENCY,
+            max_limit=config.LLM_MAX_CONCURRENCY,
+            latency_tolerance=config.LLM_LATENCY_TOLERANCE,
+            name=type(self).__name__
+        )
+        # Повторные попытки и размыкатель цепи при деградации провайдера
+        self.retry_policy = RetryPolicy(
+            max_retries=config.LLM_MAX_RETRIES,
+            base_delay=config.LLM_RETRY_BASE_DELAY,
+            max_delay=config.LLM_RETRY_MAX_DELAY
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=config.LLM_CIRCUIT_FAILURE_THRESHOLD,
+            recovery_timeout=config.LLM_CIRCUIT_RECOVERY_SECONDS,
+            name=type(self).__name__
+        )
+        self.request_timeout = config.LLM_REQUEST_TIMEOUT # Таймаут одной попытки, с
+        self.request_deadline = config.LLM_REQUEST_DEADLINE # Общий срок на запрос со всеми повторами, с
+        # Режим structured output; отключается автоматически, если провайдер отклонит response_format
+        self.structured_output = config.LLM_STRUCTURED_OUTPUT
+        self.stream_stall_timeout = config.LLM_STREAM_STALL_TIMEOUT # Макс. пауза между фрагментами потокового ответа, с
         logging.info(f"Инициализация LLM клиента для провайдера: {self.provider}")
 
-    @abstractmethod
-    def generate_response(self, prompt: str, temperature: float | None = None) -> str | None:
-        """Синхронно генерирует ответ от LLM."""
-        pass
+    @staticmethod
+    def _build_messages(prompt: str, system_prompt: str | None) -> list[dict]:
+        """Системное сообщение идет первым: это общий префикс, который провайдер может закэшировать."""
+        return [
+            {"role": "system", "content": system_prompt if system_prompt is not None else SYSTEM_ROLE_CONTENT},
+            {"role": "user", "content": prompt}
+        ]
 
-    @abstractmethod
-    async def generate_response_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None) -> str | None:
-        """Асинхронно генерирует ответ от LLM."""
-        pass
+    def _response_format(self, json_output: str | None) -> dict | None:
+        """response_format для запроса: JSON-схема, если провайдер ее поддерживает, иначе json_object."""
+        if not self.structured_output or json_output is None:
+            return None
+        if json_output == JSON_OUTPUT_REPORTS and self.supports_json_schema and OPENAI_REPORT_SCHEMA:
+            return {
+                "type": "json_schema",
+                "json_schema": {"name": "agro_reports", "strict": True, "schema": OPENAI_REPORT_SCHEMA}
+            }
+        return {"type": "json_object"}
 
+    def build_request_body(self, prompt: str, system_prompt: str | None = None, json_output: str | None = None) -> dict:
+        """Тело запроса chat.completions в формате API (для строк файла пакетного API, см. bulk_jobs.py)."""
+        body = {
+            "model": self.model_name,
+            "messages": self._build_messages(prompt, system_prompt),
+            "temperature": self.temperature,
+        }
+        response_format = self._response_format(json_output)
+        if response_format:
+            body["response_format"] = response_format
+        return body
 
-class DeepSeekClient(BaseLLMClient):
-    def __init__(self):
-        super().__init__() # Вызываем __init__ базового класса
-        self.provider = "deepseek"
-        self.model_name = config.DEEPSEEK_MODEL_NAME
-        self.client = None
-        self.async_client = None
-        try:
-            # Используем synchronous OpenAI client для DeepSeek совместимого API
-            self.client = OpenAI(api_key=config.DEEPSEEK_API_KEY, base_url=config.DEEPSEEK_API_BASE)
-            # Используем asynchronous OpenAI client
-            self.async_client = AsyncOpenAI(api_key=config.DEEPSEEK_API_KEY, base_url=config.DEEPSEEK_API_BASE)
-            logging.info(f"Клиент DeepSeek ({self.provider}) успешно инициализирован для модели: {self.model_name}")
-        except Exception as e:
-            logging.error(f"Ошибка инициализации клиента DeepSeek: {e}")
-            raise
+    def _disable_structured_output(self, error: Exception) -> None:
+        self.structured_output = False
+        logging.warning(f"{self.display_name} ({self.model_name}) не поддерживает response_format, "
+                        f"переходим на обычный текстовый ответ: {error}")
+
+    def _extract_cached_tokens(self, usage) -> int:
+        """Количество токенов промпта, взятых из кэша провайдера (формат OpenAI)."""
+        details = getattr(usage, "prompt_tokens_details", None)
+        return getattr(details, "cached_tokens", None) or 0
+
+    def _record_usage(self, chat_completion) -> None:
+        """Логирует и накапливает статистику токенов из ответа провайдера."""
+        usage = getattr(chat_completion, "usage", None)
+        self.usage_stats["requests"] += 1
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        cached_tokens = self._extract_cached_tokens(usage)
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        self.usage_stats["prompt_tokens"] += prompt_tokens
+        self.usage_stats["cached_tokens"] += cached_tokens
+        self.usage_stats["completion_tokens"] += completion_tokens
+        logging.info(f"Токены {self.display_name}: промпт {prompt_tokens} (из кэша {cached_tokens}), ответ {completion_tokens}")
 
-    def generate_response(self, prompt: str, temperature: float | None = None) -> str | None:
+    def _should_retry(self, error: Exception, attempt: int, remaining: float) -> float | None:
+        """Решает, повторять ли запрос после ошибки. Возвращает задержку перед повтором или None."""
+        error_class = classify_error(error)
+        if error_class not in RETRYABLE_ERRORS:
+            # Провайдер ответил (например, 400/401) - он доступен, цепь не размыкаем
+            self.circuit_breaker.record_success()
+            logging.error(f"Ошибка при вызове API {self.display_name} (без повтора, {error_class}): {error}")
+            return None
+        # Повторяемые ошибки говорят о состоянии провайдера - учитываем их в circuit breaker
+        self.circuit_breaker.record_failure()
+        if attempt + 1 >= self.retry_policy.max_attempts:
+            logging.error(f"Ошибка при вызове API {self.display_name} ({error_class}), попытки исчерпаны: {error}")
+            return None
+        if not self.circuit_breaker.allow_request():
+            logging.error(f"Ошибка при вызове API {self.display_name} ({error_class}), circuit breaker разомкнут: {error}")
+            return None
+        delay = self.retry_policy.compute_delay(attempt, get_retry_after(error))
+        if delay >= remaining:
+            logging.error(f"Ошибка при вызове API {self.display_name} ({error_class}), не укладываемся в срок запроса: {error}")
+            return None
+        logging.warning(f"Ошибка при вызове API {self.display_name} ({error_class}), повтор {attempt + 1}/{self.retry_policy.max_retries} "
+                        f"через {delay:.1f} с: {error}")
+        return delay
+
+    def generate_response(self, prompt: str, temperature: float | None = None, system_prompt: str | None = None,
+                          json_output: str | None = None) -> str | None:
+        """Синхронно генерирует ответ от LLM.
+
+        Args:
+            prompt: Текст пользовательского сообщения.
+            temperature: Температура (по умолчанию из конфига).
+            system_prompt: Системное сообщение (по умолчанию SYSTEM_ROLE_CONTENT).
+            json_output: JSON_OUTPUT_REPORTS / JSON_OUTPUT_BATCH - запросить JSON-ответ (structured output).
+        """
         if not self.client:
-            logging.error("Клиент DeepSeek не инициализирован.")
+            logging.error(f"Клиент {self.display_name} не инициализирован.")
+            return None
+        if not self.circuit_breaker.allow_request():
+            logging.error(f"Запрос к {self.display_name} отклонен: circuit breaker разомкнут.")
             return None
-        
+        probe = self.circuit_breaker.is_probe()
+        try:
+            return self._generate_response(prompt, temperature, system_prompt, json_output)
+        finally:
+            if probe:
+                # Пробный запрос, прерванный исключением, не должен оставлять цепь в half_open навсегда
+                self.circuit_breaker.release_probe()
+
+    def _generate_response(self, prompt: str, temperature: float | None, system_prompt: str | None,
+                           json_output: str | None) -> str | None:
+        """Попытки синхронного запроса (circuit breaker уже пропустил запрос в generate_response)."""
         temp_to_use = temperature if temperature is not None else self.temperature
-        logging.info(f"Отправка запроса к DeepSeek (модель: {self.model_name}, температура: {temp_to_use})...")
+        logging.info(f"Отправка запроса к {self.display_name} (модель: {self.model_name}, температура: {temp_to_use})...")
 
-        try:
-            chat_completion = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": SYSTEM_ROLE_CONTENT},
-                    {"role": "user", "content": prompt}
-                ],
-                model=self.model_name,
-                temperature=temp_to_use,
-            )
+        response_format = self._response_format(json_output)
+        extra_args = {"response_format": response_format} if response_format else {}
+        deadline = time.monotonic() + self.request_deadline
+        for attempt in range(self.retry_policy.max_attempts):
+            remaining = deadline - time.monotonic()
+            try:
+                chat_completion = self.client.chat.completions.create(
+                    messages=self._build_messages(prompt, system_prompt),
+                    model=self.model_name,
+                    temperature=temp_to_use,
+                    timeout=min(self.request_timeout, remaining),
+                    **extra_args
+                )
+            except Exception as e:
+                if response_format and _is_response_format_rejected(e):
+                    self._disable_structured_output(e)
+                    return self._generate_response(prompt, temperature, system_prompt, None)
+                delay = self._should_retry(e, attempt, remaining)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+                continue
+
+            self.circuit_breaker.record_success()
+            self._record_usage(chat_completion)
             response_content = chat_completion.choices[0].message.content
-            logging.info("Ответ от DeepSeek получен.")
+            logging.info(f"Ответ от {self.display_name} получен.")
             return response_content
-        except Exception as e:
-            logging.error(f"Ошибка при вызове API DeepSeek: {e}")
+        return None
+
+    async def generate_response_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None,
+                                      system_prompt: str | None = None, json_output: str | None = None) -> str | None:
+        """Асинхронно генерирует ответ от LLM.
+
+        Повторяет запрос при 429/5xx/таймаутах/сетевых ошибках с экспоненциальной задержкой
+        (уважая Retry-After), в пределах общего срока self.request_deadline.
+        AsyncOpenAI клиент использует свою внутреннюю сессию, поэтому session из aiohttp не используется.
+        json_output включает structured output (см. generate_response); если провайдер его
+        не поддерживает, запрос повторяется в обычном режиме.
+
+        Returns:
+            Текст ответа или None, если ответ получить не удалось.
+        """
+        if not self.async_client:
+            logging.error(f"Асинхронный клиент {self.display_name} не инициализирован.")
+            return None
+        if not self.circuit_breaker.allow_request():
+            logging.error(f"Запрос к {self.display_name} отклонен: circuit breaker разомкнут.")
             return None
+        probe = self.circuit_breaker.is_probe()
+        try:
+            return await self._generate_response_async(prompt, temperature, system_prompt, json_output)
+        finally:
+            if probe:
+                # Пробный запрос, отмененный (например, проигравший дублирующему в FailoverClient) или прерванный
+                # исключением, не дает результата - без этого цепь осталась бы в half_open навсегда
+                self.circuit_breaker.release_probe()
+
+    async def _generate_response_async(self, prompt: str, temperature: float | None, system_prompt: str | None,
+                                       json_output: str | None) -> str | None:
+        """Попытки асинхронного запроса (circuit breaker уже пропустил запрос в generate_response_async)."""
+        temp_to_use = temperature if temperature is not None else self.temperature
+        logging.info(f"Отправка асинхронного запроса к {self.display_name} (модель: {self.model_name}, температура: {temp_to_use})...")
+
+        response_format = self._response_format(json_output)
+        extra_args = {"response_format": response_format} if response_format else {}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_deadline
+        for attempt in range(self.retry_policy.max_attempts):
+            error = None
+            async with self.concurrency_limiter.slot() as slot:
+                remaining = deadline - loop.time()
+                try:
+                    # wait_for ограничивает и ожидание ответа, и время, которое SDK может потратить на соединение
+                    chat_completion = await asyncio.wait_for(
+                        self.async_client.chat.completions.create(
+                            messages=self._build_messages(prompt, system_prompt),
+                            model=self.model_name,
+                            temperature=temp_to_use,
+                            **extra_args
+                        ),
+                        timeout=max(0.0, min(self.request_timeout, remaining))
+                    )
+                    slot.succeeded = True
+                except Exception as e:
+                    slot.overloaded = is_overload_error(e)
+                    error = e
+
+            if error is None:
+                break
+            if response_format and _is_response_format_rejected(error):
+                self._disable_structured_output(error)
+                return await self._generate_response_async(prompt, temperature, system_prompt, None)
+            # Ждем вне слота лимитера, чтобы не занимать его во время паузы
+            delay = self._should_retry(error, attempt, deadline - loop.time())
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+        else:
+            return None
+
+        self.circuit_breaker.record_success()
+        self._record_usage(chat_completion)
+        response_content = chat_completion.choices[0].message.content
+        logging.info(f"Асинхронный ответ от {self.display_name} получен.")
+        return response_content
+
+    async def _read_stream(self, prompt: str, system_prompt: str | None, temperature: float, extra_args: dict,
+                           first_chunk_timeout: float, deadline: float, parts: list[str], on_chunk) -> object | None:
+        """Читает потоковый ответ во внешний список parts. Возвращает последний фрагмент с usage (если был).
+
+        До первого фрагмента ждем не дольше first_chunk_timeout, между фрагментами - не дольше
+        self.stream_stall_timeout: зависшая генерация обнаруживается сразу, а не по таймауту сокета.
+        """
+        loop = asyncio.get_running_loop()
+        stream = await asyncio.wait_for(
+            self.async_client.chat.completions.create(
+                messages=self._build_messages(prompt, system_prompt),
+                model=self.model_name,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                **extra_args
+            ),
+            timeout=first_chunk_timeout
+        )
+        usage_chunk = None
+        timeout = first_chunk_timeout
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError("Превышен общий срок потокового запроса")
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=min(timeout, remaining))
+                except StopAsyncIteration:
+                    break
+                timeout = self.stream_stall_timeout
+                if getattr(chunk, "usage", None):
+                    usage_chunk = chunk
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text = chunk.choices[0].delta.content
+                    parts.append(text)
+                    if on_chunk is not None:
+                        on_chunk(text)
+        finally:
+            await stream.close()
+        return usage_chunk
+
+    async def generate_response_stream_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None,
+                                             system_prompt: str | None = None, json_output: str | None = None,
+                                             on_chunk=None) -> str | None:
+        """Асинхронно генерирует ответ в потоковом режиме.
+
+        Каждый полученный фрагмент текста сразу передается в on_chunk (например, в
+        extractor.IncrementalRecordParser), поэтому записи разбираются параллельно с генерацией.
+        Запрос повторяется (как в generate_response_async) только пока не передано ни одного фрагмента;
+        если поток оборвался или завис после этого, возвращается None - вызывающий код сам решает,
+        повторять ли запрос обычным способом.
 
-    async def generate_response_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None) -> str | None:
-        # AsyncOpenAI клиент использует свою внутреннюю сессию, поэтому session из aiohttp не нужен
+        Args:
+            session: Не используется (AsyncOpenAI использует свою сессию), для единообразия интерфейса.
+            prompt: Текст пользовательского сообщения.
+            temperature: Температура (по умолчанию из конфига).
+            system_prompt: Системное сообщение (по умолчанию SYSTEM_ROLE_CONTENT).
+            json_output: JSON_OUTPUT_REPORTS / JSON_OUTPUT_BATCH - запросить JSON-ответ (structured output).
+            on_chunk: Функция, вызываемая с каждым фрагментом текста ответа.
+
+        Returns:
+            Полный текст ответа или None, если ответ получить не удалось.
+        """
         if not self.async_client:
-            logging.error("Асинхронный клиент DeepSeek не инициализирован.")
+            logging.error(f"Асинхронный клиент {self.display_name} не инициализирован.")
+            return None
+        if not self.circuit_breaker.allow_request():
+            logging.error(f"Запрос к {self.display_name} отклонен: circuit breaker разомкнут.")
             return None
+        probe = self.circuit_breaker.is_probe()
+        try:
+            return await self._generate_response_stream_async(prompt, temperature, system_prompt, json_output, on_chunk)
+        finally:
+            if probe:
+                self.circuit_breaker.release_probe() # См. generate_response_async
 
+    async def _generate_response_stream_async(self, prompt: str, temperature: float | None, system_prompt: str | None,
+                                              json_output: str | None, on_chunk) -> str | None:
+        """Попытки потокового запроса (circuit breaker уже пропустил запрос в generate_response_stream_async)."""
         temp_to_use = temperature if temperature is not None else self.temperature
-        logging.info(f"Отправка асинхронного запроса к DeepSeek (модель: {self.model_name}, температура: {temp_to_use})...")
+        logging.info(f"Отправка потокового запроса к {self.display_name} (модель: {self.model_name}, температура: {temp_to_use})...")
+
+        response_format = self._response_format(json_output)
+        extra_args = {"response_format": response_format} if response_format else {}
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.request_deadline
+        for attempt in range(self.retry_policy.max_attempts):
+            error = None
+            parts = []
+            async with self.concurrency_limiter.slot() as slot:
+                remaining = deadline - loop.time()
+                try:
+                    usage_chunk = await self._read_stream(
+                        prompt, system_prompt, temp_to_use, extra_args,
+                        max(0.0, min(self.request_timeout, remaining)), deadline, parts, on_chunk
+                    )
+                    slot.succeeded = True
+                except Exception as e:
+                    slot.overloaded = is_overload_error(e)
+                    error = e
+
+            if error is None:
+                break
+            if response_format and not parts and _is_response_format_rejected(error):
+                self._disable_structured_output(error)
+                return await self._generate_response_stream_async(prompt, temperature, system_prompt, None, on_chunk)
+            if parts:
+                # Часть ответа уже передана дальше - повтор внутри клиента дал бы дубли фрагментов
+                self.circuit_breaker.record_failure()
+                logging.error(f"Потоковый ответ {self.display_name} прервался после {len(parts)} фрагментов "
+                              f"({classify_error(error)}): {error!r}")
+                return None
+            delay = self._should_retry(error, attempt, deadline - loop.time())
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+        else:
+            return None
+
+        self.circuit_breaker.record_success()
+        self._record_usage(usage_chunk)
+        logging.info(f"Потоковый ответ от {self.display_name} получен ({len(parts)} фрагментов).")
+        return "".join(parts)
+
 
+class DeepSeekClient(BaseLLMClient):
+    display_name = "DeepSeek"
+
+    def __init__(self, model_name: str | None = None):
+        super().__init__() # Вызываем __init__ базового класса
+        self.provider = "deepseek"
+        self.model_name = model_name or config.DEEPSEEK_MODEL_NAME
         try:
-            chat_completion = await self.async_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": SYSTEM_ROLE_CONTENT},
-                    {"role": "user", "content": prompt}
-                ],
-                model=self.model_name,
-                temperature=temp_to_use,
-            )
-            response_content = chat_completion.choices[0].message.content
-            logging.info("Асинхронный ответ от DeepSeek получен.")
-            return response_content
+            # Используем synchronous OpenAI client для DeepSeek совместимого API
+            self.client = OpenAI(api_key=config.DEEPSEEK_API_KEY, base_url=config.DEEPSEEK_API_BASE, max_retries=0)
+            # Используем asynchronous OpenAI client
+            self.async_client = AsyncOpenAI(api_key=config.DEEPSEEK_API_KEY, base_url=config.DEEPSEEK_API_BASE, max_retries=0)
+            logging.info(f"Клиент DeepSeek ({self.provider}) успешно инициализирован для модели: {self.model_name}")
         except Exception as e:
-            logging.error(f"Ошибка при асинхронном вызове API DeepSeek: {e}")
-            return None
+            logging.error(f"Ошибка инициализации клиента DeepSeek: {e}")
+            raise
+
+    def _extract_cached_tokens(self, usage) -> int:
+        # DeepSeek сообщает попадания в кэш контекста отдельным полем
+        cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached_tokens is None and getattr(usage, "model_extra", None):
+            cached_tokens = usage.model_extra.get("prompt_cache_hit_tokens")
+        return cached_tokens or super()._extract_cached_tokens(usage)
 
 
 class OpenAIClient(BaseLLMClient):
-    def __init__(self):
+    display_name = "OpenAI"
+    supports_json_schema = True
+
+    def __init__(self, model_name: str | None = None):
         super().__init__() # Вызываем __init__ базового класса
         self.provider = "openai"
-        self.model_name = config.OPENAI_MODEL_NAME
-        self.client = None
-        self.async_client = None
+        self.model_name = model_name or config.OPENAI_MODEL_NAME
         try:
-            self.client = OpenAI(api_key=config.OPENAI_API_KEY)
-            self.async_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+            self.client = OpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_API_BASE, max_retries=0)
+            self.async_client = AsyncOpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_API_BASE, max_retries=0)
             logging.info(f"Клиент OpenAI ({self.provider}) успешно инициализирован для модели: {self.model_name}")
         except Exception as e:
             logging.error(f"Ошибка инициализации клиента OpenAI: {e}")
             raise
 
-    def generate_response(self, prompt: str, temperature: float | None = None) -> str | None:
-        if not self.client:
-            logging.error("Клиент OpenAI не инициализирован.")
-            return None
-        
-        temp_to_use = temperature if temperature is not None else self.temperature
-        logging.info(f"Отправка запроса к OpenAI (модель: {self.model_name}, температура: {temp_to_use})...")
+class FailoverClient:
+    """Составной клиент: основной и резервный провайдер.
 
-        try:
-            chat_completion = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": SYSTEM_ROLE_CONTENT},
-                    {"role": "user", "content": prompt}
-                ],
-                model=self.model_name,
-                temperature=temp_to_use,
-            )
-            response_content = chat_completion.choices[0].message.content
-            logging.info("Ответ от OpenAI получен.")
-            return response_content
-        except Exception as e:
-            logging.error(f"Ошибка при вызове API OpenAI: {e}")
-            return None
+    - Если основной провайдер вернул ошибку (или его circuit breaker разомкнут), запрос уходит резервному.
+    - Если основной отвечает дольше выученного перцентиля задержки (config.LLM_HEDGE_PERCENTILE),
+      параллельно отправляется дублирующий ("hedged") запрос резервному; берется первый успешный ответ,
+      второй запрос отменяется. Так один медленный провайдер не задерживает весь asyncio.gather.
 
-    async def generate_response_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None) -> str | None:
-        if not self.async_client:
-            logging.error("Асинхронный клиент OpenAI не инициализирован.")
-            return None
-        
-        temp_to_use = temperature if temperature is not None else self.temperature
-        logging.info(f"Отправка асинхронного запроса к OpenAI (модель: {self.model_name}, температура: {temp_to_use})...")
+    Интерфейс совпадает с BaseLLMClient, поэтому клиент можно передавать в processor.py вместо обычного.
+    """
+    display_name = "Failover"
+
+    def __init__(self, primary: BaseLLMClient, secondary: BaseLLMClient):
+        self.primary = primary
+        self.secondary = secondary
+        self.provider = f"{primary.provider}+{secondary.provider}"
+        self.model_name = f"{primary.model_name}+{secondary.model_name}"
+        self.temperature = primary.temperature
+        # Лимитер основного провайдера - для логов processor.py
+        self.concurrency_limiter = primary.concurrency_limiter
+        self.latency_trackers = {id(primary): LatencyTracker(), id(secondary): LatencyTracker()}
+        self.hedge_enabled = config.LLM_HEDGE_ENABLED
+        self.hedge_percentile = config.LLM_HEDGE_PERCENTILE
+        self.hedge_min_samples = config.LLM_HEDGE_MIN_SAMPLES
+        self.hedge_initial_delay = config.LLM_HEDGE_INITIAL_DELAY
+        self.hedge_min_delay = config.LLM_HEDGE_MIN_DELAY
+        self.failover_stats = {"failovers": 0, "hedges": 0, "hedges_won": 0}
+        logging.info(f"Клиент с резервированием: основной {primary.display_name} ({primary.model_name}), "
+                     f"резервный {secondary.display_name} ({secondary.model_name})")
+
+    @property
+    def usage_stats(self) -> dict:
+        """Суммарная статистика токенов обоих провайдеров."""
+        return {key: self.primary.usage_stats[key] + self.secondary.usage_stats[key] for key in self.primary.usage_stats}
+
+    def _ordered_clients(self) -> tuple[BaseLLMClient, BaseLLMClient]:
+        """
+        Основной провайдер первым, если его цепь примет запрос. Разомкнутая цепь и half_open с пробным
+        запросом в работе отклонили бы запрос сразу - тогда первым идет резервный.
+        """
+        if not self.primary.circuit_breaker.available and self.secondary.circuit_breaker.available:
+            return self.secondary, self.primary
+        return self.primary, self.secondary
+
+    def _hedge_delay(self, client: BaseLLMClient) -> float:
+        """Через сколько секунд без ответа отправлять дублирующий запрос."""
+        tracker = self.latency_trackers[id(client)]
+        if len(tracker) < self.hedge_min_samples:
+            return self.hedge_initial_delay
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    def generate_response(self, prompt: str, temperature: float | None = None, system_prompt: str | None = None,
+                          json_output: str | None = None) -> str | None:
+        """Синхронный запрос: только переключение на резервного провайдера при ошибке (без дублирования)."""
+        first, second = self._ordered_clients()
+        response = first.generate_response(prompt, temperature=temperature, system_prompt=system_prompt, json_output=json_output)
+        if response is not None:
+            return response
+        self.failover_stats["failovers"] += 1
+        logging.warning(f"{first.display_name} не ответил, переключаемся на {second.display_name}.")
+        return second.generate_response(prompt, temperature=temperature, system_prompt=system_prompt, json_output=json_output)
+
+    async def _timed_request(self, client: BaseLLMClient, session: aiohttp.ClientSession, prompt: str,
+                             temperature: float | None, system_prompt: str | None, json_output: str | None) -> str | None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        response = await client.generate_response_async(session, prompt, temperature=temperature,
+                                                        system_prompt=system_prompt, json_output=json_output)
+        if response is not None:
+            self.latency_trackers[id(client)].record(loop.time() - started)
+        return response
 
+    async def generate_response_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None,
+                                      system_prompt: str | None = None, json_output: str | None = None) -> str | None:
+        """Асинхронный запрос с переключением на резервного провайдера и дублированием медленных запросов.
+
+        Returns:
+            Текст первого успешного ответа или None, если не ответил ни один провайдер.
+        """
+        first, second = self._ordered_clients()
+        first_task = asyncio.create_task(self._timed_request(first, session, prompt, temperature, system_prompt, json_output))
+        tasks = {first_task}
+        hedge_delay = self._hedge_delay(first) if self.hedge_enabled else None
         try:
-            chat_completion = await self.async_client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": SYSTEM_ROLE_CONTENT},
-                    {"role": "user", "content": prompt}
-                ],
-                model=self.model_name,
-                temperature=temp_to_use,
-            )
-            response_content = chat_completion.choices[0].message.content
-            logging.info("Асинхронный ответ от OpenAI получен.")
-            return response_content
-        except Exception as e:
-            logging.error(f"Ошибка при асинхронном вызове API OpenAI: {e}")
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done:
+                response = first_task.result()
+                if response is not None:
+                    return response
+                # Основной провайдер вернул ошибку - переключаемся на резервного
+                self.failover_stats["failovers"] += 1
+                logging.warning(f"{first.display_name} не ответил, переключаемся на {second.display_name}.")
+                return await self._timed_request(second, session, prompt, temperature, system_prompt, json_output)
+
+            # Основной провайдер отвечает дольше обычного - дублируем запрос резервному
+            self.failover_stats["hedges"] += 1
+            logging.info(f"{first.display_name} не ответил за {hedge_delay:.1f} с, отправляем дублирующий запрос к {second.display_name}.")
+            second_task = asyncio.create_task(self._timed_request(second, session, prompt, temperature, system_prompt, json_output))
+            tasks.add(second_task)
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if response is not None:
+                        if task is second_task:
+                            self.failover_stats["hedges_won"] += 1
+                        return response
             return None
+        finally:
+            # Проигравший (или незавершенный при отмене) запрос отменяем и дожидаемся: отмененный пробный запрос
+            # освобождает circuit breaker своего провайдера до следующего выбора порядка клиентов
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def generate_response_stream_async(self, session: aiohttp.ClientSession, prompt: str, temperature: float | None = None,
+                                             system_prompt: str | None = None, json_output: str | None = None,
+                                             on_chunk=None) -> str | None:
+        """Потоковый запрос к доступному провайдеру (без дублирования: фрагменты двух потоков нельзя смешивать).
+
+        Переключение на резервного провайдера - через обычный generate_response_async, если поток не удался.
+        """
+        first, _ = self._ordered_clients()
+        return await first.generate_response_stream_async(session, prompt, temperature=temperature, system_prompt=system_prompt,
+                                                          json_output=json_output, on_chunk=on_chunk)
+
+    def log_summary(self) -> None:
+        stats = self.failover_stats
+        latency = self.latency_trackers[id(self.primary)].percentile(self.hedge_percentile)
+        latency_text = f", p{self.hedge_percentile * 100:.0f} задержки основного {latency:.1f} с" if latency is not None else ""
+        logging.info(f"Резервирование: переключений {stats['failovers']}, дублирующих запросов {stats['hedges']} "
+                     f"(выиграли {stats['hedges_won']}){latency_text}")
+
 
 # Фабричная функция для создания клиента
-def TextGenerationClient() -> BaseLLMClient:
-    provider = config.PRIMARY_LLM_PROVIDER
+def TextGenerationClient(provider: str | None = None, model_name: str | None = None) -> BaseLLMClient:
+    """Создает клиента LLM.
+
+    Args:
+        provider: "deepseek" или "openai" (по умолчанию config.PRIMARY_LLM_PROVIDER).
+        model_name: Модель (по умолчанию из конфига для выбранного провайдера).
+    """
+    if provider is None and config.LLM_FAILOVER_ENABLED:
+        return _build_failover_client()
+    provider = provider or config.PRIMARY_LLM_PROVIDER
     if provider == "deepseek":
-        return DeepSeekClient()
+        return DeepSeekClient(model_name)
     elif provider == "openai":
-        return OpenAIClient()
+        return OpenAIClient(model_name)
     else:
         raise ValueError(f"Неизвестный провайдер LLM: {provider}")
 
+
+def _build_failover_client() -> BaseLLMClient | FailoverClient:
+    """Основной клиент + резервный; если резервный создать не удалось - только основной."""
+    primary = TextGenerationClient(config.PRIMARY_LLM_PROVIDER)
+    if config.SECONDARY_LLM_PROVIDER == primary.provider:
+        logging.warning("Резервный провайдер совпадает с основным, резервирование отключено.")
+        return primary
+    try:
+        secondary = TextGenerationClient(config.SECONDARY_LLM_PROVIDER)
+    except Exception as e:
+        logging.error(f"Не удалось инициализировать резервного провайдера '{config.SECONDARY_LLM_PROVIDER}', "
+                      f"работаем только с основным: {e}")
+        return primary
+    return FailoverClient(primary, secondary)
+
     
 
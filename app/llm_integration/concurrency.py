@@ -0,0 +1,142 @@
+# Адаптивное ограничение количества одновременных запросов к LLM (AIMD)
+
+import asyncio
+import contextlib
+import logging
+import math
+import time
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class AdaptiveConcurrencyLimiter:
+    """Ограничитель одновременных запросов с лимитом, подстраивающимся под провайдера.
+
+    Работает как TCP congestion control (AIMD):
+    - каждый успешный быстрый ответ увеличивает лимит на increase_step / limit
+      (т.е. примерно на increase_step за "окно" из limit запросов);
+    - ответ 429/5xx или резкий рост задержки уменьшает лимит в decrease_factor раз,
+      не чаще одного раза за decrease_cooldown секунд (пачка одновременных 429 - один сигнал).
+
+    Задержка сравнивается с базовой: короткая скользящая средняя против медленной.
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int = 1, max_limit: int = 16,
+                 latency_tolerance: float = 2.0, increase_step: float = 1.0,
+                 decrease_factor: float = 0.5, decrease_cooldown: float = 2.0, name: str = "llm"):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self._limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_tolerance = latency_tolerance
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.name = name
+        self.in_flight = 0
+        self._condition = None # Создается лениво: лимитер может пережить несколько event loop (asyncio.run)
+        self._condition_loop = None
+        self._last_decrease = 0.0
+        self._fast_latency = None # Короткая скользящая средняя задержки
+        self._baseline_latency = None # Медленная скользящая средняя (базовая задержка)
+        self.successes = 0
+        self.overloads = 0
+        self.peak_in_flight = 0
+
+    @property
+    def current_limit(self) -> int:
+        """Текущий лимит одновременных запросов."""
+        return max(self.min_limit, math.floor(self._limit))
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._condition_loop is not loop:
+            self._condition = asyncio.Condition()
+            self._condition_loop = loop
+        return self._condition
+
+    async def acquire(self) -> None:
+        condition = self._get_condition()
+        async with condition:
+            while self.in_flight >= self.current_limit:
+                await condition.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def release(self, latency: float | None = None, overloaded: bool = False) -> None:
+        """Освобождает слот и обновляет лимит по результату запроса.
+
+        Args:
+            latency: Время выполнения запроса в секундах (None - запрос завершился ошибкой,
+                     не связанной с перегрузкой; лимит не меняется).
+            overloaded: Провайдер сигнализировал о перегрузке (429/5xx).
+        """
+        if overloaded:
+            self.on_overload()
+        elif latency is not None:
+            self.on_success(latency)
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all() # Лимит мог вырасти - будим всех ожидающих
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Контекстный менеджер на один запрос. Внутри можно выставить slot.overloaded = True."""
+        await self.acquire()
+        request_slot = _RequestSlot()
+        started = time.monotonic()
+        try:
+            yield request_slot
+        finally:
+            latency = time.monotonic() - started if request_slot.succeeded else None
+            await self.release(latency, overloaded=request_slot.overloaded)
+
+    def on_success(self, latency: float) -> None:
+        self.successes += 1
+        if self._fast_latency is None:
+            self._fast_latency = self._baseline_latency = latency
+        else:
+            self._fast_latency = 0.3 * latency + 0.7 * self._fast_latency
+            self._baseline_latency = 0.05 * latency + 0.95 * self._baseline_latency
+
+        if self._fast_latency > self._baseline_latency * self.latency_tolerance:
+            self._decrease(f"задержка выросла до {self._fast_latency:.1f} с (база {self._baseline_latency:.1f} с)")
+        else:
+            previous_limit = self.current_limit
+            self._limit = min(self.max_limit, self._limit + self.increase_step / self._limit)
+            if self.current_limit != previous_limit:
+                logging.info(f"[{self.name}] Лимит одновременных запросов увеличен: {previous_limit} -> {self.current_limit}")
+
+    def on_overload(self) -> None:
+        self.overloads += 1
+        self._decrease("провайдер сообщил о перегрузке (429/5xx)")
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        previous_limit = self.current_limit
+        self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+        logging.warning(f"[{self.name}] Лимит одновременных запросов уменьшен: {previous_limit} -> {self.current_limit} ({reason})")
+
+    def stats(self) -> dict:
+        """Текущее состояние лимитера (для логов и отчетов)."""
+        return {
+            "current_limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "baseline_latency": self._baseline_latency,
+        }
+
+
+class _RequestSlot:
+    """Результат одного запроса внутри AdaptiveConcurrencyLimiter.slot()."""
+    __slots__ = ("succeeded", "overloaded")
+
+    def __init__(self):
+        self.succeeded = False
+        self.overloaded = False
@@ -6,12 +6,11 @@ SYSTEM_ROLE_CONTENT = (
     "from agricultural reports according to specific instructions and format."
 )
 
-# Шаблон промпта для детального извлечения данных (используется в prompt_builder.py)
-DETAILED_EXTRACTION_PROMPT="""
-Проанализируй следующее сообщение с отчетом о сельскохозяйственных работах:
----
-{input_message}
----
+# Статические инструкции по извлечению, общие для одиночного и пакетного режимов.
+# Не содержат ничего, что зависит от сообщения или даты: вместе с системной ролью они
+# образуют побайтно одинаковый префикс, который DeepSeek/OpenAI кэшируют на своей стороне.
+EXTRACTION_INSTRUCTIONS="""
+Тебе будут присланы сообщения с отчетами о сельскохозяйственных работах (текст сообщения и текущая дата - в конце запроса).
 
 Используй следующие справочники для распознавания терминов и определения значений:
 
@@ -27,11 +26,11 @@ DETAILED_EXTRACTION_PROMPT="""
 ЗАДАЧА:
 1.  Найди **все** основные уникальные комбинации (Операция, Культура, Подразделение), представленные в отчете. **Не создавай** отдельные записи для строк, детализирующих данные по отдельным Отделениям (Отд) или оборудованию (например, Амазон, Пневмоход), если для той же комбинации Операция+Культура+Подразделение есть сводные данные по Производственному Участку (ПУ).
 2.  Для **каждой** такой основной комбинации извлеки связанные с ней числовые данные: "За день, га", "С начала операции, га", "Вал за день, ц", "Вал с начала, ц".
-3.  Определи **дату** отчета. Сначала попробуй найти дату в тексте сообщения (например, "25.07", "25 июля"). Если дата в тексте не найдена, используй текущую дату: {current_date}.
+3.  Определи **дату** отчета. Сначала попробуй найти дату в тексте сообщения (например, "25.07", "25 июля"). Если дата в тексте не найдена, используй текущую дату, указанную вместе с сообщением.
 4.  Верни результат СТРОГО в формате JSON-списка (`list`), где каждый элемент списка - это JSON-объект (`dict`), представляющий одну найденную основную комбинацию и её данные.
 
 ИНСТРУКЦИИ ПО ИЗВЛЕЧЕНИЮ ДЛЯ КАЖДОГО ОБЪЕКТА В СПИСКЕ:
-- "Дата": Дата отчета в формате YYYY-MM-DD (извлеченная из текста или текущая {current_date}).
+- "Дата": Дата отчета в формате YYYY-MM-DD (извлеченная из текста или текущая дата, указанная вместе с сообщением).
 - "Подразделение": Определи название подразделения для данной комбинации. Используй номер отделения (Отд), чтобы найти соответствующее подразделение в "СПИСКЕ ПОДРАЗДЕЛЕНИЙ". Если есть несколько "Отд", относящихся к одной записи, ориентируйся на первое или на общие данные по ПУ (Производственному участку), если они есть. Если номер отделения не указан или не найден, попробуй найти название подразделения явно в тексте рядом с операцией/культурой. Если определить не удается, используй null. Не включай ПУ или Отделение в название.
 - "Операция": Определи полное название полевой работы из "СПИСКА ОПЕРАЦИЙ", основываясь на тексте, связанном с этой комбинацией (например, "Предп культ" -> "Предпосевная культивация"). Если не указана или не распознана для этой комбинации, используй null.
 - "Культура": Определи полное название культуры из "СПИСКА КУЛЬТУР", основываясь на тексте, связанном с этой комбинацией (например, "оз пш" -> "Пшеница озимая"). Если культура не указана, не распознана, или этой культуры нет в словаре, используй null.
@@ -81,10 +80,10 @@ DETAILED_EXTRACTION_PROMPT="""
     "Вал за день, ц": float | int | null,
     "Вал с начала, ц": float | int | null
   }}
-  // ... и так далее для каждой найденной комбинации
 ]
+(и так далее - по одному объекту для каждой найденной комбинации)
 
-ПРИМЕР ОЖИДАЕМОГО ВЫВОДА для сообщения (с комментариями):
+ПРИМЕР ОЖИДАЕМОГО ВЫВОДА для сообщения:
 Обрати внимание, что отделения 18,19 являются частью ПУ "Кавказ" Подразделения "АОР",
 И поскольку культуры и операции у них одинаковые, то они объединяются в один элемент списка.
 Данные по отделению 18 выносятся отедельно, потому что там другая культура и это уже новая комбинация, а значит и новый элемент списка.
@@ -109,11 +108,11 @@ DETAILED_EXTRACTION_PROMPT="""
     "Подразделение": "АОР", 
     "Операция": "Пахота",
     "Культура": "Подсолнечник товарный",
-    "За день, га": 50,  
-    "С начала операции, га": 330, 
+    "За день, га": 55,
+    "С начала операции, га": 330,
     "Вал за день, ц": null,
     "Вал с начала, ц": null
-  }},
+  }}
 ]
 
 Обрати внимание, что в ответе берутся данные по пу, так как отделения 11,12,16,17 являются частью ПУ "Юг" Подразделения "АОР".
@@ -130,11 +129,11 @@ DETAILED_EXTRACTION_PROMPT="""
 [
   {{
     "Дата": "2025-03-10",
-    "Подразделение": "АОР", // ПУ "Юг" -> АОР
+    "Подразделение": "АОР",
     "Операция": "2-я подкормка",
-    "Культура": "Пшеница озимая товарная", // Изменено с null (озимых)
-    "За день, га": 1520,         // Изменено
-    "С начала операции, га": 2850, // Изменено
+    "Культура": "Пшеница озимая товарная",
+    "За день, га": 1520,
+    "С начала операции, га": 2850,
     "Вал за день, ц": null,
     "Вал с начала, ц": null
   }}
@@ -312,70 +311,130 @@ DETAILED_EXTRACTION_PROMPT="""
 ]
 """
 
+# Часть промпта, зависящая от сообщения. Всегда добавляется ПОСЛЕ статических инструкций
+EXTRACTION_MESSAGE_TEMPLATE="""
+ТЕКУЩАЯ ДАТА: {current_date}
+
+Проанализируй следующее сообщение с отчетом о сельскохозяйственных работах:
+---
+{input_message}
+---
+"""
+
+# Справочники, подобранные под конкретное сообщение (режим сокращения справочников, см. reference_index.py).
+# Ставится перед EXTRACTION_MESSAGE_TEMPLATE / BATCH_EXTRACTION_MESSAGE_TEMPLATE
+PRUNED_REFERENCES_TEMPLATE="""
+СПРАВОЧНИКИ ДЛЯ ЭТОГО ЗАПРОСА (только записи, которые могут относиться к сообщению):
+
+СПИСОК КУЛЬТУР:
+{cultures_content}
+
+СПИСОК ОПЕРАЦИЙ:
+{operations_content}
+
+СПИСОК ПОДРАЗДЕЛЕНИЙ:
+{departments_content}
+"""
+
+# Подставляется в EXTRACTION_INSTRUCTIONS вместо полных справочников в режиме сокращения
+PRUNED_REFERENCES_PLACEHOLDER = "(приводится вместе с сообщением)"
+
+# То же для пакетного режима: несколько сообщений в одном запросе (используется в processor.py)
+BATCH_EXTRACTION_MESSAGE_TEMPLATE="""
+ТЕКУЩАЯ ДАТА: {current_date}
+
+Проанализируй следующие сообщения с отчетами о сельскохозяйственных работах.
+Каждое сообщение начинается со строки-метки вида [MSG <id>]:
+---
+{input_messages}
+---
+
+Обрабатывай каждое сообщение НЕЗАВИСИМО от остальных по правилам выше.
+
+ФОРМАТ ОТВЕТА ДЛЯ НЕСКОЛЬКИХ СООБЩЕНИЙ (имеет приоритет над форматом выше):
+- Верни ОДИН JSON-объект (`dict`), ключи которого - id сообщений из меток [MSG <id>] (строки), а значения - JSON-списки записей для этого сообщения в формате, описанном выше.
+- Ключ должен быть у КАЖДОГО сообщения. Если сообщение не содержит данных о работах, его значение - пустой список `[]`.
+- Пример: {{"1": [{{"Дата": "2025-08-10", ...}}], "2": []}}
+- Возвращай ТОЛЬКО этот JSON-объект, без какого-либо дополнительного текста.
+"""
+
+# Короткий повторный запрос для записей, не прошедших проверку (см. validator.py).
+# Отправляется без EXTRACTION_INSTRUCTIONS: только сообщение, ошибочные записи и нужные справочники
+REASK_PROMPT_TEMPLATE="""
+Из сообщения с отчетом о сельскохозяйственных работах были извлечены записи, в которых найдены ошибки.
+Исправь ТОЛЬКО эти записи по тексту сообщения.
+
+Правила:
+- Числа вида "a/b" - это "За день, га" / "С начала операции, га". Если есть данные "По Пу", используются только они.
+- Вал в сообщениях указан в килограммах (если явно не указаны центнеры) - переведи в центнеры (раздели на 100).
+- "Операция", "Культура" и "Подразделение" - только полные названия из справочников ниже. Если значение действительно нельзя определить по сообщению, используй null.
+- "Дата" в формате YYYY-MM-DD; если в сообщении ее нет - текущая дата.
+{references}
+ТЕКУЩАЯ ДАТА: {current_date}
+
+СООБЩЕНИЕ:
+---
+{input_message}
+---
+
+ЗАПИСИ С ОШИБКАМИ (в поле "Ошибки" - что не так):
+{records}
+
+Верни ТОЛЬКО JSON-список исправленных записей в том же порядке, с теми же полями, что и в записях выше, но без поля "Ошибки".
+Если запись не соответствует никаким данным сообщения, не включай ее в список.
+"""
+
+# Полные шаблоны промптов (инструкции + сообщение) одной строкой (используется в prompt_builder.py)
+DETAILED_EXTRACTION_PROMPT = EXTRACTION_INSTRUCTIONS + EXTRACTION_MESSAGE_TEMPLATE
+
 
-# ДВА ФАЙЛА НИЖЕ НЕ ИСПОЛЬЗУЮТСЯ
+# Поля записи отчета в порядке вывода (используется в схеме ниже и в rule_parser.py)
+RECORD_FIELDS = [
+    "Дата", "Подразделение", "Операция", "Культура",
+    "За день, га", "С начала операции, га", "Вал за день, ц", "Вал с начала, ц"
+]
+
+# Тип и описание каждого поля для JSON-схемы
+RECORD_FIELD_SCHEMA = {
+    "Дата": ("string", "Дата отчета в формате YYYY-MM-DD."),
+    "Подразделение": ("string", "Название подразделения (без ПУ/Отделения)."),
+    "Операция": ("string", "Полное название полевой работы из справочника."),
+    "Культура": ("string", "Полное название культуры из справочника."),
+    "За день, га": ("number", "Количество гектар за день."), # Тип number включает integer
+    "С начала операции, га": ("number", "Общее количество гектар с начала операции."),
+    "Вал за день, ц": ("number", "Валовый сбор за день в центнерах."),
+    "Вал с начала, ц": ("number", "Валовый сбор с начала операции в центнерах."),
+}
+
+# JSON-схема ответа для structured output (OpenAI json_schema, strict): объект {"reports": [записи]}.
+# Корневой элемент - объект, так как провайдеры принимают в качестве схемы ответа только объект
 OPENAI_REPORT_SCHEMA = {
-  "type": "object",
-  "properties": {
-    "reports": {
-      "type": "array",
-      "description": "Список извлеченных отчетов по работам.",
-      "items": {
-        "type": "object",
-        "properties": {
-          "Дата": {
-            "type": ["string", "null"], # Используем массив типов
-            "description": "Дата отчета в формате YYYY-MM-DD."
-          },
-          "Подразделение": {
-            "type": ["string", "null"],
-            "description": "Название подразделения (без ПУ/Отделения)."
-          },
-          "Операция": {
-            "type": ["string", "null"],
-            "description": "Полное название полевой работы из справочника."
-          },
-          "Культура": {
-            "type": ["string", "null"],
-            "description": "Полное название культуры из справочника."
-          },
-          "За день, га": {
-            "type": ["number", "null"], # Тип number включает integer
-            "description": "Количество гектар за день."
-          },
-          "С начала операции, га": {
-            "type": ["number", "null"],
-            "description": "Общее количество гектар с начала операции."
-          },
-          "Вал за день, ц": {
-            "type": ["number", "null"],
-            "description": "Валовый сбор за день в центнерах."
-          },
-          "Вал с начала, ц": {
-            "type": ["number", "null"],
-            "description": "Валовый сбор с начала операции в центнерах."
-          }
-        },
-        "required": [
-          "Дата",
-          "Подразделение",
-          "Операция",
-          "Культура",
-          "За день, га",
-          "С начала операции, га",
-          "Вал за день, ц",
-          "Вал с начала, ц"
-        ],
-        "additionalProperties": False
-      }
-    }
-  },
-  "required": [
-    "reports"
-  ],
-  "additionalProperties": False
+    "type": "object",
+    "properties": {
+        "reports": {
+            "type": "array",
+            "description": "Список извлеченных отчетов по работам.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    field: {"type": [field_type, "null"], "description": description}
+                    for field, (field_type, description) in RECORD_FIELD_SCHEMA.items()
+                },
+                "required": RECORD_FIELDS,
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["reports"],
+    "additionalProperties": False
 }
 
+# Добавляется к запросу одного сообщения в режиме structured output (config.LLM_STRUCTURED_OUTPUT)
+STRUCTURED_OUTPUT_NOTE = """
+ФОРМАТ ОТВЕТА (имеет приоритет над форматом выше): верни JSON-объект вида {"reports": [...]}, где "reports" - JSON-список записей в формате, описанном выше. Если данных о работах нет, верни {"reports": []}.
+"""
+
+# ПРОМПТ НИЖЕ НЕ ИСПОЛЬЗУЕТСЯ
 # --- Промпт для извлечения отчетов по схеме через OpenAI ---
 OPENAI_SCHEMA_PROMPT = """
 Проанализируй следующее сообщение с отчетом о сельскохозяйственных работах:
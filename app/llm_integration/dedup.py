@@ -0,0 +1,134 @@
+# Поиск повторов сообщений (пересланные и повторно отправленные отчеты) до отправки в LLM
+#
+# Точные копии находятся по хэшу нормализованного текста, почти точные (другие пробелы,
+# эмодзи, подпись "Пересланное сообщение") - по MinHash/LSH на шинглах символов.
+# Важно: отчеты за разные дни часто отличаются только числами ("Отд 12 26/221" и "Отд 12 27/248"),
+# поэтому почти точным повтором считается только сообщение с той же последовательностью чисел.
+
+import hashlib
+import logging
+import random
+import re
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Служебные строки мессенджеров, которые не относятся к содержанию отчета
+FORWARD_NOISE_RE = re.compile(r"^\s*(?:пересланное сообщение|forwarded(?: message)?|переслано от .*)\s*$", re.IGNORECASE | re.MULTILINE)
+NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def normalize_for_dedup(text: str) -> str:
+    """Приводит текст к виду для сравнения: без регистра, эмодзи, служебных строк и лишних пробелов."""
+    text = FORWARD_NOISE_RE.sub(" ", text.lower().replace("ё", "е"))
+    text = re.sub(r"[^\w/.,%]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _shingles(text: str, size: int) -> set[str]:
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), "big")
+
+
+class NearDuplicateIndex:
+    """Инкрементальный индекс сообщений для поиска точных и почти точных повторов.
+
+    Кандидаты ищутся через LSH (bands полос по rows_per_band значений MinHash-сигнатуры),
+    затем подтверждаются точным коэффициентом Жаккара по шинглам (>= threshold).
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16, shingle_size: int = 5, seed: int = 42):
+        if num_perm % bands:
+            raise ValueError("num_perm должно делиться на bands без остатка")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = random.Random(seed) # Фиксированные перестановки - одинаковые сигнатуры между запусками
+        self._permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)
+        ]
+        self._exact = {} # хэш нормализованного текста -> ключ первого сообщения
+        self._buckets = {} # хэш (полоса, значения) -> список ключей
+        # ключ -> (нормализованный текст, числа). Шинглы кандидата строятся заново при сравнении:
+        # кандидатов мало, а хранить множества шинглов всех сообщений даты - ~15 КБ на сообщение
+        self._entries = {}
+
+    def _signature(self, shingles: set[str]) -> list[int]:
+        hashes = [_hash64(s) for s in shingles]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._permutations]
+
+    def add(self, key, text: str) -> tuple[object | None, float]:
+        """Добавляет сообщение в индекс.
+
+        Args:
+            key: Идентификатор сообщения (ID из БД или номер в списке).
+            text: Текст сообщения.
+
+        Returns:
+            (ключ исходного сообщения, сходство) если это повтор, иначе (None, 0.0).
+            Повторы в индекс не добавляются: все копии ссылаются на первое сообщение.
+        """
+        normalized = normalize_for_dedup(text)
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        if digest in self._exact:
+            return self._exact[digest], 1.0
+
+        shingles = _shingles(normalized, self.shingle_size)
+        numbers = tuple(NUMBER_RE.findall(normalized))
+        signature = self._signature(shingles)
+        band_keys = [
+            hash((band, tuple(signature[band * self.rows_per_band:(band + 1) * self.rows_per_band])))
+            for band in range(self.bands)
+        ]
+
+        best_key, best_similarity = None, 0.0
+        seen = set()
+        for band_key in band_keys:
+            for candidate in self._buckets.get(band_key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                candidate_text, candidate_numbers = self._entries[candidate]
+                if candidate_numbers != numbers:
+                    continue # Те же слова, но другие цифры - это другой отчет
+                candidate_shingles = _shingles(candidate_text, self.shingle_size)
+                similarity = len(shingles & candidate_shingles) / len(shingles | candidate_shingles)
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best_key, best_similarity = candidate, similarity
+        if best_key is not None:
+            return best_key, best_similarity
+
+        self._exact[digest] = key
+        self._entries[key] = (normalized, numbers)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, []).append(key)
+        return None, 0.0
+
+
+def find_duplicates(messages: list[str], threshold: float = 0.85) -> tuple[list[int], list[float]]:
+    """Находит повторы в списке сообщений.
+
+    Returns:
+        (canonical, similarity): для каждого сообщения - номер исходного сообщения (свой номер,
+        если это не повтор) и сходство с ним.
+    """
+    index = NearDuplicateIndex(threshold=threshold)
+    canonical = []
+    similarity = []
+    for i, message in enumerate(messages):
+        original, score = index.add(i, message)
+        canonical.append(i if original is None else original)
+        similarity.append(score)
+    duplicates = sum(1 for i, c in enumerate(canonical) if c != i)
+    if duplicates:
+        logging.info(f"Найдено повторов сообщений: {duplicates} из {len(messages)}.")
+    return canonical, similarity
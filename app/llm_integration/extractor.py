@@ -2,20 +2,70 @@
 
 import json
 import logging
-from typing import List, Dict, Any, Optional
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+
+try:
+    import orjson # Быстрый парсер JSON (необязательная зависимость)
+except ImportError:
+    orjson = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def _clean_and_parse_json(llm_response: str) -> Any:
-    """Вспомогательная функция для очистки и парсинга JSON строки."""
-    if not isinstance(llm_response, str):
-        logger.error(f"Ошибка: На вход ожидалась строка, получено {type(llm_response)}")
-        return None
-        
-    json_string = llm_response.strip()
-    
+# Исправления, которые может применить восстанавливающий парсер
+REPAIR_PROSE = "prose" # Текст до или после JSON
+REPAIR_COMMENTS = "comments" # Комментарии // и /* */
+REPAIR_TRAILING_COMMAS = "trailing_commas" # Запятая перед ] или }
+REPAIR_SINGLE_OBJECT = "single_object" # Один объект вместо списка
+REPAIR_TRUNCATED = "truncated" # Обрезанный ответ: неполный последний элемент отброшен
+
+_CLOSING_BRACKETS = {"[": "]", "{": "}"}
+
+# Счетчики разбора ответов LLM за прогон (доля ответов, которые не удалось разобрать)
+_parse_stats = {"responses": 0, "failures": 0, "repaired": 0, "repairs": Counter()}
+
+
+def reset_parse_stats() -> None:
+    """Обнуляет счетчики разбора ответов (в начале обработки пакета)."""
+    _parse_stats["responses"] = 0
+    _parse_stats["failures"] = 0
+    _parse_stats["repaired"] = 0
+    _parse_stats["repairs"] = Counter()
+
+
+def get_parse_stats() -> Dict[str, Any]:
+    """Возвращает количество разобранных ответов, ошибок разбора, долю ошибок
+    и количество ответов, восстановленных парсером (с разбивкой по видам исправлений)."""
+    responses = _parse_stats["responses"]
+    failures = _parse_stats["failures"]
+    return {
+        "responses": responses,
+        "failures": failures,
+        "failure_rate": failures / responses if responses else 0.0,
+        "repaired": _parse_stats["repaired"],
+        "repairs": dict(_parse_stats["repairs"]),
+    }
+
+
+def _count_parse(success: bool, repairs: List[str] | None = None) -> None:
+    _parse_stats["responses"] += 1
+    if not success:
+        _parse_stats["failures"] += 1
+    elif repairs:
+        _parse_stats["repaired"] += 1
+        _parse_stats["repairs"].update(repairs)
+
+
+def _loads(json_string: str) -> Any:
+    """json.loads через orjson, если он установлен (ошибки orjson - подкласс json.JSONDecodeError)."""
+    if orjson is not None:
+        return orjson.loads(json_string)
+    return json.loads(json_string)
+
+
+def _strip_code_fence(json_string: str) -> str:
     # Удаляем ```json и ```, если они есть
     if json_string.startswith("```json"):
         json_string = json_string[7:]
@@ -24,26 +74,150 @@ def _clean_and_parse_json(llm_response: str) -> Any:
     elif json_string.startswith("```"):
          if json_string.endswith("```"):
             json_string = json_string[3:-3]
+    return json_string.strip() # Повторный strip после удаления маркеров
+
 
-    json_string = json_string.strip() # Повторный strip после удаления маркеров
+def _repair_json_text(text: str) -> Tuple[Optional[str], List[str]]:
+    """Исправляет типовые дефекты JSON в ответе LLM за один проход по тексту.
 
+    Убирает текст до и после JSON, комментарии и висячие запятые (вне строк).
+    Если ответ обрезан, отбрасывает неполный последний элемент списка и закрывает скобки.
+
+    Returns:
+        (исправленный текст или None, если JSON в ответе не найден, список примененных исправлений).
+    """
+    starts = [pos for pos in (text.find("["), text.find("{")) if pos != -1]
+    if not starts:
+        return None, []
+    start = min(starts)
+    repairs = [REPAIR_PROSE] if text[:start].strip() else []
+
+    out = []
+    stack = [] # Открытые скобки
+    last_cut = None # (длина out, стек) - последняя граница полного элемента списка
+    in_string = escape = False
+    end = None
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif text.startswith("//", i) or text.startswith("/*", i):
+            if text.startswith("//", i):
+                comment_end = text.find("\n", i)
+                i = n if comment_end == -1 else comment_end
+            else:
+                comment_end = text.find("*/", i + 2)
+                i = n if comment_end == -1 else comment_end + 2
+            if REPAIR_COMMENTS not in repairs:
+                repairs.append(REPAIR_COMMENTS)
+            continue
+        elif ch in "[{":
+            stack.append(ch)
+            out.append(ch)
+        elif ch in "]}":
+            if not stack:
+                break
+            k = len(out) - 1
+            while k >= 0 and out[k].isspace():
+                k -= 1
+            if k >= 0 and out[k] == ",":
+                del out[k]
+                if REPAIR_TRAILING_COMMAS not in repairs:
+                    repairs.append(REPAIR_TRAILING_COMMAS)
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                end = i
+                break
+            if stack[-1] == "[":
+                last_cut = (len(out), tuple(stack))
+        elif ch == ",":
+            if stack and stack[-1] == "[":
+                last_cut = (len(out), tuple(stack))
+            out.append(ch)
+        else:
+            out.append(ch)
+        i += 1
+
+    if end is None:
+        # Ответ оборвался: оставляем только полные элементы списка
+        if last_cut is None:
+            return None, repairs
+        cut, cut_stack = last_cut
+        out = out[:cut]
+        out.extend(_CLOSING_BRACKETS[bracket] for bracket in reversed(cut_stack))
+        repairs.append(REPAIR_TRUNCATED)
+    elif text[end + 1:].strip() and REPAIR_PROSE not in repairs:
+        repairs.append(REPAIR_PROSE)
+    return "".join(out), repairs
+
+
+def parse_json_tolerant(llm_response: str) -> Tuple[Any, List[str]]:
+    """Разбирает JSON из ответа LLM, при необходимости восстанавливая его.
+
+    Сначала пробует разобрать ответ как есть (через orjson, если установлен), затем -
+    после исправления типовых дефектов: текст вокруг JSON, комментарии, висячие запятые,
+    обрезанный последний элемент.
+
+    Args:
+        llm_response: Текстовый ответ от LLM.
+
+    Returns:
+        (разобранные данные или None, список примененных исправлений).
+    """
+    json_string = _strip_code_fence(llm_response.strip())
     try:
-        parsed_data = json.loads(json_string)
-        return parsed_data
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка парсинга JSON: {e}")
-        logger.debug(f"Строка, которую не удалось распарсить: {json_string[:500]}...") # Логируем начало строки
-        return None
+        return _loads(json_string), []
+    except json.JSONDecodeError as first_error:
+        repaired, repairs = _repair_json_text(json_string)
+        if repaired is None:
+            logger.error(f"Ошибка парсинга JSON: {first_error}")
+            logger.debug(f"Строка, которую не удалось распарсить: {json_string[:500]}...") # Логируем начало строки
+            return None, repairs
+        try:
+            return _loads(repaired), repairs
+        except json.JSONDecodeError:
+            logger.error(f"Ошибка парсинга JSON (не помогло и восстановление): {first_error}")
+            logger.debug(f"Строка, которую не удалось распарсить: {json_string[:500]}...")
+            return None, repairs
+
+def _clean_and_parse_json(llm_response: str) -> Tuple[Any, List[str]]:
+    """Вспомогательная функция для очистки и парсинга JSON строки.
+
+    Returns:
+        (разобранные данные или None, список примененных исправлений).
+    """
+    if not isinstance(llm_response, str):
+        logger.error(f"Ошибка: На вход ожидалась строка, получено {type(llm_response)}")
+        return None, []
+
+    try:
+        parsed_data, repairs = parse_json_tolerant(llm_response)
     except Exception as e: # Ловим другие возможные ошибки при парсинге
         logger.error(f"Неожиданная ошибка при парсинге JSON: {e}")
-        logger.debug(f"Строка, вызвавшая ошибку: {json_string[:500]}...")
-        return None
+        logger.debug(f"Строка, вызвавшая ошибку: {llm_response[:500]}...")
+        return None, []
+    if parsed_data is not None and repairs:
+        logger.warning(f"JSON в ответе LLM восстановлен, исправления: {', '.join(repairs)}")
+    return parsed_data, repairs
 
 def extract_json_list(llm_response: str) -> Optional[List[Dict[str, Any]]]:
     """
     Извлекает JSON-список словарей из текстового ответа LLM.
 
-    Очищает ответ от маркеров ```json ... ``` и парсит его.
+    Очищает ответ от маркеров ```json ... ``` и парсит его, восстанавливая типовые дефекты
+    (см. parse_json_tolerant). Ответ в режиме structured output ({"reports": [...]})
+    разворачивается в список, одиночный объект-запись оборачивается в список.
     Проверяет, что результат является списком.
 
     Args:
@@ -52,15 +226,28 @@ def extract_json_list(llm_response: str) -> Optional[List[Dict[str, Any]]]:
     Returns:
         Список словарей или None в случае ошибки или если результат не список.
     """
-    parsed_data = _clean_and_parse_json(llm_response)
+    parsed_data, repairs = _clean_and_parse_json(llm_response)
     
     if parsed_data is None:
+        _count_parse(False)
         return None
 
+    if isinstance(parsed_data, dict):
+        if isinstance(parsed_data.get("reports"), list):
+            parsed_data = parsed_data["reports"]
+        elif parsed_data and not any(isinstance(value, (list, dict)) for value in parsed_data.values()):
+            # Одна запись без обертки в список
+            logger.warning("JSON в ответе LLM восстановлен, исправления: single_object")
+            parsed_data = [parsed_data]
+            repairs = repairs + [REPAIR_SINGLE_OBJECT]
+
     if not isinstance(parsed_data, list):
         logger.error(f"Ошибка: Ожидался JSON-список, но получен {type(parsed_data)}.")
         logger.debug(f"Данные: {parsed_data}")
+        _count_parse(False)
         return None
+
+    _count_parse(True, repairs)
     
     # Простая проверка, что элементы списка - словари (опционально, но полезно)
     if parsed_data and not all(isinstance(item, dict) for item in parsed_data):
@@ -68,4 +255,138 @@ def extract_json_list(llm_response: str) -> Optional[List[Dict[str, Any]]]:
         # Решаем, возвращать как есть или считать ошибкой. Пока возвращаем.
 
     logger.info(f"Успешно извлечен JSON-список с {len(parsed_data)} элементами.")
-    return parsed_data 
\ No newline at end of file
+    return parsed_data
+
+
+def extract_json_dict_by_id(llm_response: str, expected_ids: list[str]) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """
+    Разбирает ответ LLM на пакетный запрос: JSON-объект {id сообщения: [записи]}.
+
+    Args:
+        llm_response: Текстовый ответ от LLM.
+        expected_ids: Список id сообщений, отправленных в пакете.
+
+    Returns:
+        Словарь {id: список словарей} только для тех id, по которым получен корректный список,
+        или None, если ответ не удалось разобрать как JSON-объект.
+        Отсутствующие или некорректные id вызывающий код обрабатывает отдельно.
+    """
+    parsed_data, repairs = _clean_and_parse_json(llm_response)
+
+    if parsed_data is None:
+        _count_parse(False)
+        return None
+
+    if not isinstance(parsed_data, dict):
+        logger.error(f"Ошибка: Ожидался JSON-объект с ключами-id сообщений, но получен {type(parsed_data)}.")
+        logger.debug(f"Данные: {parsed_data}")
+        _count_parse(False)
+        return None
+
+    _count_parse(True, repairs)
+
+    if REPAIR_TRUNCATED in repairs and parsed_data:
+        # Ответ оборвался на последнем сообщении - его список может быть неполным, отправим его отдельно
+        parsed_data.pop(list(parsed_data)[-1])
+
+    results = {}
+    for msg_id in expected_ids:
+        value = parsed_data.get(msg_id)
+        if not isinstance(value, list):
+            logger.warning(f"В пакетном ответе нет корректного списка для сообщения id={msg_id}.")
+            continue
+        if value and not all(isinstance(item, dict) for item in value):
+            logger.warning(f"Предупреждение: Не все элементы списка для id={msg_id} являются словарями.")
+        results[msg_id] = value
+
+    logger.info(f"Из пакетного ответа извлечены данные для {len(results)} из {len(expected_ids)} сообщений.")
+    return results
+
+
+class IncrementalRecordParser:
+    """
+    Разбирает потоковый ответ LLM по мере поступления фрагментов.
+
+    Записи - JSON-объекты, лежащие непосредственно в первом JSON-списке ответа
+    ([{...}, {...}] или {"reports": [{...}, {...}]}). Каждая запись возвращается из feed()
+    сразу, как только закрывается ее фигурная скобка, не дожидаясь конца ответа.
+    Текст до JSON (например, ```json) пропускается.
+    """
+
+    def __init__(self):
+        self.records = [] # Все разобранные записи
+        self.skipped = 0 # Записи, которые не удалось разобрать даже после восстановления
+        self._text = ""
+        self._position = 0 # Сколько символов буфера уже просмотрено
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._list_depth = None # Глубина первого списка (после его открывающей скобки)
+        self._record_start = None
+        self._finished = False # Первый список закрыт
+        self._repairs = [] # Исправления, примененные при разборе записей
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Добавляет фрагмент ответа. Возвращает записи, завершенные в этом фрагменте."""
+        completed = []
+        if self._finished:
+            return completed
+        self._text += chunk
+        text = self._text
+        for i in range(self._position, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                if self._stack:
+                    self._in_string = True
+            elif ch in "[{":
+                if ch == "{" and self._list_depth is not None and len(self._stack) == self._list_depth:
+                    self._record_start = i
+                self._stack.append(ch)
+                if ch == "[" and self._list_depth is None:
+                    self._list_depth = len(self._stack)
+            elif ch in "]}" and self._stack:
+                self._stack.pop()
+                if self._list_depth is None:
+                    continue
+                if ch == "}" and self._record_start is not None and len(self._stack) == self._list_depth:
+                    record = self._parse_record(text[self._record_start:i + 1])
+                    self._record_start = None
+                    if record is not None:
+                        completed.append(record)
+                elif ch == "]" and len(self._stack) < self._list_depth:
+                    self._finished = True
+                    break
+        self._position = len(text)
+        self.records.extend(completed)
+        return completed
+
+    def _parse_record(self, fragment: str) -> Optional[Dict[str, Any]]:
+        try:
+            record = _loads(fragment)
+        except json.JSONDecodeError:
+            record, repairs = parse_json_tolerant(fragment)
+            self._repairs.extend(repairs)
+        if not isinstance(record, dict):
+            self.skipped += 1
+            return None
+        return record
+
+    def result(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Записи ответа, если первый список закрыт и все его записи разобраны - тогда полный ответ
+        повторно разбирать не нужно (учитывается в статистике разбора, как extract_json_list).
+        Иначе None: ответ оборван, часть записей не разобрана или список пуст (пустой список мог
+        оказаться не тем, что нужно, например, скобками в тексте до JSON) - ответ разбирается целиком.
+        """
+        if not self._finished or self.skipped or not self.records:
+            return None
+        _count_parse(True, self._repairs)
+        return list(self.records)
@@ -0,0 +1,418 @@
+# Потоковая обработка сообщений: этапы, связанные ограниченными очередями
+#
+# источник (страницы из БД) -> подготовка (повторы, правила, кэш, промпт) -> запросы к LLM ->
+# извлечение и проверка записей -> приемник (результаты в БД)
+#
+# В отличие от process_batch_async, сообщения не читаются все сразу и задачи не создаются заранее на
+# каждое сообщение: каждая очередь ограничена config.LLM_PIPELINE_QUEUE_SIZE, и если следующий этап не
+# успевает, предыдущий ждет. Память не растет с объемом (бэкфилл сезона), а записи попадают в
+# приемник по мере готовности, не дожидаясь последнего запроса. Приемник сохраняет результат каждого
+# сообщения в базу сразу, поэтому прерванная обработка продолжается с места остановки.
+# При потоковых ответах (config.LLM_STREAMING_ENABLED) записи разбираются и проверяются по мере генерации:
+# этап извлечения получает их готовыми и сразу переходит к повторному запросу ошибочных и к приемнику.
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+import aiohttp
+
+from app import config
+from app.llm_integration.client import JSON_OUTPUT_REPORTS, JSON_OUTPUT_BATCH
+from app.llm_integration.prompt_builder import (
+    build_message_prompt, build_batch_message_prompt, build_pruned_message_prompt, build_pruned_batch_message_prompt,
+    estimate_token_count
+)
+from app.llm_integration.extractor import extract_json_list, extract_json_dict_by_id, IncrementalRecordParser
+from app.llm_integration.dedup import NearDuplicateIndex
+from app.llm_integration.router import TIER_RULES, TIER_FAST, TIER_STRONG
+from app.llm_integration.constants import STRUCTURED_OUTPUT_NOTE
+from app.llm_integration.processor import (
+    ProcessingContext, prepare_processing_context, log_processing_summary, process_single_message_async,
+    make_cache_key, reask_invalid_records, stream_message_async
+)
+from app.utils import message_store
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_DONE = object() # Признак конца очереди: каждый обработчик этапа получает свой
+_DUPLICATE = object() # Результат сообщения-повтора: данные уже учтены у исходного сообщения
+PROGRESS_LOG_EVERY = 100 # Как часто приемник пишет в лог общий прогресс, сообщений
+
+
+@dataclass
+class _Message:
+    index: int # Номер сообщения в запуске
+    message_id: str
+    text: str
+    date: str # Дата сообщения YYYY-MM-DD (по ней сбрасывается поиск повторов)
+
+
+@dataclass
+class _Request:
+    messages: list[_Message] # Одно сообщение или пакет (config.LLM_BATCH_SIZE > 1)
+    tier: str
+    prompt: str
+    cache_keys: dict = field(default_factory=dict) # Номер сообщения -> ключ кэша
+
+    @property
+    def label(self) -> str:
+        if len(self.messages) == 1:
+            return f"[Msg {self.messages[0].index+1}]"
+        return f"[Batch {self.messages[0].index+1}-{self.messages[-1].index+1}]"
+
+
+class ExtractionStoreSink:
+    """
+    Приемник результатов: результат каждого сообщения сохраняется в базу парсера сразу после обработки
+    (записи и отметка processed_at - одной транзакцией, см. message_store.save_message_result).
+    После сбоя повторный запуск продолжает с необработанных сообщений, уже полученные ответы не теряются.
+    Методы синхронные (SQLite): process_stream_async вызывает их в пуле потоков, не блокируя цикл событий.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.saved = 0 # Сохранено результатов сообщений
+        self.updated_dates = set() # Даты, по которым сохранены результаты (для обновления отчетов)
+
+    def processed_messages(self, message_date: str) -> list[tuple]:
+        """Уже обработанные сообщения даты (id, text) - для поиска повторов среди них."""
+        return message_store.fetch_processed_messages(self.db_path, message_date)
+
+    def add_message(self, message_id: str, message_date: str, records: list | None) -> None:
+        """records: записи ([] - данных нет), None - обработка не удалась (сообщение повторится в следующий запуск)."""
+        message_store.save_message_result(self.db_path, message_id, message_date, records)
+        self._saved(message_date)
+
+    def add_duplicate(self, message_id: str, message_date: str, original_id: str, similarity: float) -> None:
+        message_store.save_message_result(self.db_path, message_id, message_date,
+                                          duplicate_of=original_id, similarity=similarity)
+        self._saved(message_date)
+
+    def _saved(self, message_date: str) -> None:
+        self.saved += 1
+        self.updated_dates.add(message_date)
+
+
+def _build_prompt(context: ProcessingContext, messages: list[_Message]) -> str:
+    """
+    Промпт для одного сообщения или пакета (как в process_single_message_async / process_message_batch_async).
+    Текущая дата в промпте - дата сообщений (в пакете она общая), а не дата запуска.
+    """
+    reference_index = context.reference_index
+    current_date = messages[0].date
+    if len(messages) == 1:
+        message = messages[0]
+        if reference_index is not None:
+            prompt = build_pruned_message_prompt(message.text, reference_index.select(message.text), current_date)
+        else:
+            prompt = build_message_prompt(message.text, current_date)
+        if config.LLM_STRUCTURED_OUTPUT:
+            prompt += STRUCTURED_OUTPUT_NOTE
+        return prompt
+    tagged_messages = [(str(message.index + 1), message.text) for message in messages]
+    if reference_index is not None:
+        # Справочники для пакета - объединение кандидатов по всем его сообщениям
+        references = reference_index.select("\n".join(text for _, text in tagged_messages))
+        return build_pruned_batch_message_prompt(tagged_messages, references, current_date)
+    return build_batch_message_prompt(tagged_messages, current_date)
+
+
+async def process_stream_async(source, sink: ExtractionStoreSink, use_cache: bool = True,
+                               context: ProcessingContext | None = None) -> dict | None:
+    """
+    Потоковая обработка сообщений (см. комментарий в начале модуля).
+
+    Args:
+        source: Итератор кортежей (id, текст, дата YYYY-MM-DD), например message_store.iter_unprocessed,
+                или асинхронный итератор (непрерывная обработка, см. app/ingest_daemon.py).
+                Читается по мере того, как этап подготовки освобождает место в очереди.
+        sink: Приемник результатов (ExtractionStoreSink): получает результат каждого сообщения по готовности.
+        use_cache: Использовать дисковый кэш результатов (как в process_batch_async).
+        context: Общий контекст нескольких одновременных обработок (клиенты, лимитер, справочники, кэш) -
+                 см. run_processing_for_range. Его готовит и закрывает вызывающий; по умолчанию создается свой.
+
+    Returns:
+        Статистика { 'messages', 'successful', 'empty', 'failed', 'duplicates', 'records' }
+        или None при критической ошибке инициализации. empty - данных в сообщении нет, failed - обработка
+        не удалась (сообщение остается необработанным).
+    """
+    owns_context = context is None
+    if owns_context:
+        context = prepare_processing_context(use_cache)
+        if context is None:
+            return None
+    logging.info("Начало ПОТОКОВОЙ обработки сообщений...")
+    clients = {TIER_FAST: context.fast_client, TIER_STRONG: context.llm_client}
+    workers = max(config.LLM_PIPELINE_WORKERS, 1)
+    intake = asyncio.Queue(config.LLM_PIPELINE_QUEUE_SIZE) # _Message
+    requests = asyncio.Queue(config.LLM_PIPELINE_QUEUE_SIZE) # _Request
+    responses = asyncio.Queue(config.LLM_PIPELINE_QUEUE_SIZE) # (_Request, ответ LLM, время запроса, записи потока)
+    results = asyncio.Queue(config.LLM_PIPELINE_QUEUE_SIZE) # (_Message, записи / None / (_DUPLICATE, исходное, сходство))
+    stats = {'messages': 0, 'successful': 0, 'empty': 0, 'failed': 0, 'duplicates': 0, 'records': 0}
+    loop = asyncio.get_running_loop()
+    batch_base_tokens = estimate_token_count(context.system_prompt + build_batch_message_prompt([], context.current_date))
+
+    async def produce():
+        if hasattr(source, "__aiter__"):
+            index = 0
+            async for message_id, text, date in source:
+                await intake.put(_Message(index, message_id, text, date))
+                index += 1
+        else:
+            # Синхронный источник читает SQLite - каждое следующее сообщение берется в пуле потоков,
+            # чтобы запрос страницы не останавливал запросы к LLM и остальные этапы
+            iterator = iter(source)
+            index = 0
+            while True:
+                item = await loop.run_in_executor(None, next, iterator, _DONE)
+                if item is _DONE:
+                    break
+                message_id, text, date = item
+                await intake.put(_Message(index, message_id, text, date))
+                index += 1
+        await intake.put(_DONE)
+
+    async def prepare():
+        """Повторы, правила и кэш - без LLM; остальное - в очередь запросов (по одному или пакетами)."""
+        dedup = NearDuplicateIndex(threshold=config.MESSAGE_DEDUP_THRESHOLD) if config.MESSAGE_DEDUP_ENABLED else None
+        dedup_date = None
+        pending = {TIER_FAST: [], TIER_STRONG: []} # Сообщения, ожидающие заполнения пакета
+        pending_tokens = {TIER_FAST: 0, TIER_STRONG: 0}
+        pending_keys = {TIER_FAST: {}, TIER_STRONG: {}}
+
+        async def flush(tier):
+            messages = pending[tier]
+            if not messages:
+                return
+            pending[tier], pending_tokens[tier], cache_keys, pending_keys[tier] = [], 0, pending_keys[tier], {}
+            try:
+                prompt = _build_prompt(context, messages)
+            except Exception as e:
+                logging.error(f"Ошибка при построении промпта для сообщений {messages[0].index+1}-{messages[-1].index+1}: {e}")
+                for message in messages:
+                    await results.put((message, None))
+                return
+            await requests.put(_Request(messages, tier, prompt, cache_keys))
+
+        while True:
+            message = await intake.get()
+            if message is _DONE:
+                break
+            if dedup is not None:
+                if message.date != dedup_date:
+                    # Отчеты строятся по датам: повторы ищутся внутри даты, индекс не растет весь сезон.
+                    # Сообщения даты, обработанные раньше (до сбоя или в прошлый запуск), тоже участвуют
+                    dedup, dedup_date = NearDuplicateIndex(threshold=config.MESSAGE_DEDUP_THRESHOLD), message.date
+                    processed = await loop.run_in_executor(None, sink.processed_messages, message.date)
+                    for processed_id, processed_text in processed:
+                        dedup.add(processed_id, processed_text)
+                original_id, similarity = dedup.add(message.message_id, message.text)
+                if original_id is not None:
+                    await results.put((message, (_DUPLICATE, original_id, round(similarity, 3))))
+                    continue
+
+            # Текущая дата для правил, кэша, промпта и проверки записей - дата сообщения: результат не зависит
+            # от дня запуска (период, непрерывная обработка после полуночи), ключ кэша стабилен
+            decision = context.router.route(message.text, message.date)
+            if decision.tier == TIER_RULES:
+                await results.put((message, decision.records))
+                continue
+            tier = decision.tier
+            cache_key = None
+            if context.cache.enabled:
+                cache_key = make_cache_key(message.text, clients[tier], context.prompt_fingerprint, message.date)
+                cached_data = context.cache.get(cache_key)
+                if cached_data == [] and tier == TIER_FAST:
+                    # Быстрая модель уже не нашла здесь данных - сразу к основной, как после ее ответа без записей
+                    context.router.record_escalation()
+                    tier = TIER_STRONG
+                    cache_key = make_cache_key(message.text, clients[tier], context.prompt_fingerprint, message.date)
+                    cached_data = context.cache.get(cache_key)
+                if cached_data is not None:
+                    logging.info(f"[Msg {message.index+1}] Результат взят из кэша ({len(cached_data)} записей).")
+                    await results.put((message, cached_data))
+                    continue
+
+            if pending[tier] and pending[tier][0].date != message.date:
+                await flush(tier) # В промпте пакета одна текущая дата
+            if config.LLM_BATCH_SIZE > 1:
+                # Пакет закрывается по размеру или бюджету токенов (как plan_batches)
+                message_tokens = estimate_token_count(message.text) + 5
+                if pending[tier] and (len(pending[tier]) >= config.LLM_BATCH_SIZE or
+                                      pending_tokens[tier] + message_tokens > config.LLM_BATCH_MAX_PROMPT_TOKENS - batch_base_tokens):
+                    await flush(tier)
+                pending_tokens[tier] += message_tokens
+            pending[tier].append(message)
+            if cache_key is not None:
+                pending_keys[tier][message.index] = cache_key
+            if config.LLM_BATCH_SIZE <= 1 or intake.empty():
+                # Новых сообщений сейчас нет - неполный пакет не ждет, чтобы LLM не простаивал
+                await flush(tier)
+        for tier in pending:
+            await flush(tier)
+
+    async def call_llm():
+        """Запросы к LLM: одновременных запросов не больше, чем разрешает адаптивный лимитер клиента."""
+        while True:
+            request = await requests.get()
+            if request is _DONE:
+                return
+            client = clients[request.tier]
+            started = loop.time()
+            response = None
+            streamed = None
+            try:
+                if len(request.messages) > 1:
+                    logging.info(f"{request.label} Отправка пакетного запроса к LLM ({len(request.messages)} сообщений)...")
+                    response = await client.generate_response_async(
+                        session, request.prompt, system_prompt=context.system_prompt,
+                        json_output=JSON_OUTPUT_BATCH if config.LLM_STRUCTURED_OUTPUT else None
+                    )
+                else:
+                    if config.LLM_STREAMING_ENABLED:
+                        message = request.messages[0]
+                        parser = IncrementalRecordParser()
+                        problems = [] # Ошибки каждой записи: записи проверяются, пока генерируются следующие
+
+                        def check_record(record):
+                            problems.append(context.validator.validate(record, message.date) if context.validator is not None else [])
+
+                        response = await stream_message_async(
+                            message.index, request.prompt, client, session, context.system_prompt, parser, check_record
+                        )
+                        if response is None:
+                            logging.warning(f"{request.label} Потоковый ответ не получен, повторяем запрос без потока.")
+                        else:
+                            records = parser.result()
+                            if records is not None:
+                                streamed = (records, [(i, record_problems) for i, record_problems in enumerate(problems) if record_problems])
+                    if response is None:
+                        response = await client.generate_response_async(
+                            session, request.prompt, system_prompt=context.system_prompt,
+                            json_output=JSON_OUTPUT_REPORTS if config.LLM_STRUCTURED_OUTPUT else None
+                        )
+            except Exception as e:
+                logging.error(f"{request.label} Ошибка запроса к LLM: {e}")
+            await responses.put((request, response, loop.time() - started, streamed))
+
+    async def process_single(message: _Message, tier: str) -> list | None:
+        try:
+            return await process_single_message_async(
+                message_index=message.index, message=message.text, llm_client=clients[tier], session=session,
+                system_prompt=context.system_prompt, current_date=message.date, cache=context.cache,
+                prompt_fingerprint=context.prompt_fingerprint, reference_index=context.reference_index,
+                validator=context.validator
+            )
+        except Exception as e:
+            logging.error(f"[Msg {message.index+1}] Ошибка при обработке сообщения: {e}")
+            return None
+
+    async def extract():
+        """Извлечение записей, проверка (с повторным запросом ошибочных), кэш и эскалация на основную модель."""
+        while True:
+            item = await responses.get()
+            if item is _DONE:
+                return
+            request, response, elapsed, streamed = item
+            client = clients[request.tier]
+            # Задержка - одна на запрос: пакет из нескольких сообщений - тоже один запрос к модели
+            context.router.record_latency(request.tier, elapsed)
+
+            if len(request.messages) > 1:
+                ids = [str(message.index + 1) for message in request.messages]
+                batch_data = extract_json_dict_by_id(response, ids) if response else None
+                if batch_data is None:
+                    logging.warning(f"{request.label} Пакетный запрос не удался, переходим к обработке по одному сообщению.")
+                extracted = [(message, batch_data.get(str(message.index + 1)) if batch_data else None) for message in request.messages]
+            elif streamed is not None:
+                # Записи потокового ответа уже разобраны и проверены по мере генерации
+                extracted = [(request.messages[0], streamed[0])]
+            else:
+                records = extract_json_list(response) if response else None
+                if response and records is None:
+                    logging.error(f"{request.label} Не удалось извлечь JSON из ответа LLM.")
+                extracted = [(request.messages[0], records)]
+
+            for message, records in extracted:
+                try:
+                    if records is None and len(request.messages) > 1:
+                        # Нет данных для сообщения в пакетном ответе - обрабатываем его отдельно
+                        records = await process_single(message, request.tier)
+                    elif records is not None:
+                        if records and context.validator is not None:
+                            records = await reask_invalid_records(
+                                message.index, message.text, records, context.validator, client, session, message.date,
+                                invalid=streamed[1] if streamed is not None else None
+                            )
+                        if message.index in request.cache_keys:
+                            context.cache.set(request.cache_keys[message.index], records)
+                    if not records and request.tier == TIER_FAST:
+                        # Быстрая модель не справилась - отдаем сообщение основной, точность важнее
+                        context.router.record_escalation()
+                        records = await process_single(message, TIER_STRONG)
+                except Exception as e:
+                    logging.error(f"[Msg {message.index+1}] Ошибка при извлечении записей: {e}")
+                    records = None
+                await results.put((message, records))
+
+    async def consume():
+        """Приемник: записи каждого сообщения передаются в sink сразу после получения."""
+        while True:
+            item = await results.get()
+            if item is _DONE:
+                return
+            message, records = item
+            stats['messages'] += 1
+            if isinstance(records, tuple) and records[0] is _DUPLICATE:
+                _, original_id, similarity = records
+                logging.info(f"[Msg {message.index+1}] Повтор сообщения {original_id}, данные не дублируются.")
+                await loop.run_in_executor(None, sink.add_duplicate, message.message_id, message.date, original_id, similarity)
+                stats['duplicates'] += 1
+                continue
+            await loop.run_in_executor(None, sink.add_message, message.message_id, message.date, records)
+            if records:
+                stats['successful'] += 1
+                stats['records'] += len(records)
+            elif records is None:
+                logging.warning(f"[Msg {message.index+1}] Обработка не удалась, сообщение будет повторено при следующем запуске.")
+                stats['failed'] += 1
+            else:
+                logging.warning(f"[Msg {message.index+1}] Сообщение обработано, но данные не извлечены.")
+                stats['empty'] += 1
+            if stats['messages'] % PROGRESS_LOG_EVERY == 0:
+                logging.info(f"Обработано {stats['messages']} сообщений, записей в отчете: {stats['records']}.")
+
+    async def run_stage(stage_workers, out_queue, out_consumers):
+        # Когда все обработчики этапа завершены, каждый обработчик следующего получает признак конца
+        await asyncio.gather(*stage_workers)
+        for _ in range(out_consumers):
+            await out_queue.put(_DONE)
+
+    connector = aiohttp.TCPConnector(limit_per_host=config.LLM_MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [
+            asyncio.create_task(produce(), name="Pipeline-source"),
+            asyncio.create_task(run_stage([prepare()], requests, workers), name="Pipeline-prepare"),
+            asyncio.create_task(run_stage([call_llm() for _ in range(workers)], responses, workers), name="Pipeline-llm"),
+            asyncio.create_task(run_stage([extract() for _ in range(workers)], results, 1), name="Pipeline-extract"),
+            asyncio.create_task(consume(), name="Pipeline-sink"),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Ошибка в одном этапе остановила бы остальные на заполненной очереди - отменяем все
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if owns_context:
+                log_processing_summary(context)
+            raise
+
+    if owns_context:
+        log_processing_summary(context)
+    logging.info(f"Потоковая обработка завершена. Сообщений: {stats['messages']}, успешно: {stats['successful']}, "
+                 f"нет данных: {stats['empty']}, ошибок: {stats['failed']}, повторов: {stats['duplicates']}, "
+                 f"разобрано правилами: {context.rule_parser.parsed_count}.")
+    return stats
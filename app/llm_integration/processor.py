@@ -6,44 +6,177 @@ import asyncio
 import aiohttp
 import itertools
 import json # Добавлено для llm_settings
+from dataclasses import dataclass
 
 from app import config
-from app.llm_integration.client import TextGenerationClient
-from app.llm_integration.prompt_builder import load_mapping_file, build_detailed_extraction_prompt
-from app.llm_integration.extractor import extract_json_list
-from app.llm_integration.constants import DETAILED_EXTRACTION_PROMPT # Добавлен импорт промпта
+from app.llm_integration.client import TextGenerationClient, BaseLLMClient, FailoverClient, JSON_OUTPUT_REPORTS, JSON_OUTPUT_BATCH
+from app.llm_integration.prompt_builder import (
+    load_mapping_file, build_extraction_prefix, build_message_prompt, build_batch_message_prompt,
+    build_pruned_extraction_prefix, build_pruned_message_prompt, build_pruned_batch_message_prompt, build_reask_prompt,
+    estimate_token_count, plan_batches
+)
+from app.llm_integration.extractor import (
+    extract_json_list, extract_json_dict_by_id, reset_parse_stats, get_parse_stats, IncrementalRecordParser
+)
+from app.llm_integration.cache import LLMResponseCache, build_prompt_fingerprint
+from app.llm_integration.rule_parser import RuleBasedParser
+from app.llm_integration.dedup import find_duplicates
+from app.llm_integration.reference_index import ReferenceIndex
+from app.llm_integration.validator import RecordValidator
+from app.llm_integration.router import MessageRouter, TIER_RULES, TIER_FAST, TIER_STRONG
+from app.llm_integration.constants import DETAILED_EXTRACTION_PROMPT, EXTRACTION_MESSAGE_TEMPLATE, STRUCTURED_OUTPUT_NOTE # Добавлен импорт промпта
 from app.utils.quality_test import save_quality_test_results # Добавлен импорт функции теста
 
 
 # Синхронные функции process_single_message и process_batch были удалены
 
 
+def make_cache_key(message: str, llm_client: TextGenerationClient, prompt_fingerprint: str, current_date: str) -> str:
+    """Ключ кэша для сообщения с учетом настроек текущего клиента LLM."""
+    return LLMResponseCache.make_key(
+        message, prompt_fingerprint, llm_client.provider, llm_client.model_name,
+        llm_client.temperature, current_date
+    )
+
+
+async def reask_invalid_records(
+    message_index: int,
+    message: str,
+    records: list,
+    validator: RecordValidator,
+    llm_client: TextGenerationClient,
+    session: aiohttp.ClientSession,
+    current_date: str,
+    invalid: list | None = None
+) -> list:
+    """
+    Проверяет записи сообщения и повторно запрашивает у LLM только записи с ошибками.
+    В повторный запрос уходят сообщение, ошибочные записи с описанием ошибок и только нужные справочники.
+    invalid - уже найденные ошибки [(номер записи, ошибки)], если записи проверены раньше (по мере
+    потоковой генерации); по умолчанию записи проверяются здесь.
+    Если повторный запрос не удался, возвращаются исходные записи.
+    """
+    if invalid is None:
+        invalid = validator.find_invalid(records, current_date)
+    else:
+        validator.checked_records += len(records)
+        validator.invalid_records += len(invalid)
+    if not invalid:
+        return records
+    problems = [problem for _, record_problems in invalid for problem in record_problems]
+    logging.warning(f"[Msg {message_index+1}] Записей с ошибками: {len(invalid)} из {len(records)} ({'; '.join(problems)}). "
+                    f"Отправляем повторный запрос только по ним...")
+    invalid_positions = {i for i, _ in invalid}
+    valid_records = [record for i, record in enumerate(records) if i not in invalid_positions]
+    invalid_records = [(records[i], record_problems) for i, record_problems in invalid if isinstance(records[i], dict)]
+    if not invalid_records:
+        return valid_records
+
+    prompt = build_reask_prompt(message, invalid_records, validator.reference_hints([record for record, _ in invalid_records]), current_date)
+    if config.LLM_STRUCTURED_OUTPUT:
+        prompt += STRUCTURED_OUTPUT_NOTE
+    validator.reasks += 1
+    llm_response = await llm_client.generate_response_async(
+        session, prompt, json_output=JSON_OUTPUT_REPORTS if config.LLM_STRUCTURED_OUTPUT else None
+    )
+    corrected = extract_json_list(llm_response) if llm_response else None
+    if corrected is None:
+        logging.error(f"[Msg {message_index+1}] Повторный запрос не удался, оставляем записи как есть.")
+        return records
+
+    corrected = [
+        {key: value for key, value in record.items() if key != "Ошибки"}
+        for record in corrected if isinstance(record, dict)
+    ]
+    fixed = sum(1 for record in corrected if not validator.validate(record, current_date))
+    validator.fixed_records += fixed
+    logging.info(f"[Msg {message_index+1}] Повторный запрос (~{estimate_token_count(prompt)} токенов): "
+                 f"получено {len(corrected)} записей вместо {len(invalid_records)}, без ошибок {fixed}.")
+    return valid_records + corrected
+
+
+async def stream_message_async(
+    message_index: int,
+    prompt: str,
+    llm_client: TextGenerationClient,
+    session: aiohttp.ClientSession,
+    system_prompt: str,
+    parser: IncrementalRecordParser | None = None,
+    on_record=None
+) -> str | None:
+    """
+    Отправляет запрос в потоковом режиме: зависший ответ обнаруживается по паузе между фрагментами
+    (config.LLM_STREAM_STALL_TIMEOUT), а не по общему таймауту. Записи разбираются по мере генерации
+    переданным parser: после ответа его результат (parser.result()) не нужно разбирать заново.
+    on_record вызывается для каждой записи сразу после ее разбора, пока генерируются следующие.
+    Возвращает полный текст ответа или None, если поток не удался (тогда вызывающий код
+    повторяет запрос обычным способом).
+    """
+    if parser is None:
+        parser = IncrementalRecordParser()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    def handle_chunk(text: str) -> None:
+        for record in parser.feed(text):
+            logging.info(f"[Msg {message_index+1}] Запись {len(parser.records)} получена через {loop.time() - started:.1f} с "
+                         f"({record.get('Операция')} / {record.get('Культура')}).")
+            if on_record is not None:
+                on_record(record)
+
+    return await llm_client.generate_response_stream_async(
+        session, prompt, system_prompt=system_prompt,
+        json_output=JSON_OUTPUT_REPORTS if config.LLM_STRUCTURED_OUTPUT else None,
+        on_chunk=handle_chunk
+    )
+
+
 async def process_single_message_async(
     message_index: int,
     message: str,
     llm_client: TextGenerationClient,
     session: aiohttp.ClientSession,
-    cultures_content: str,
-    operations_content: str,
-    departments_content: str,
+    system_prompt: str,
     current_date: str,
-    base_prompt: str # Добавлен параметр для передачи промпта
+    cache: LLMResponseCache | None = None,
+    prompt_fingerprint: str | None = None,
+    reference_index: ReferenceIndex | None = None,
+    validator: RecordValidator | None = None
 ) -> list | None:
     """
     Асинхронно обрабатывает одно сообщение.
-    Принимает инициализированный клиент, сессию и загруженные справочники.
+    Принимает инициализированный клиент, сессию и общий для всех сообщений системный промпт
+    (справочники и инструкции, см. build_extraction_prefix); текст сообщения добавляется после него.
+    Если передан cache, сначала ищет результат в кэше и сохраняет туда успешно извлеченные данные.
+    Если передан reference_index, в промпт добавляются только подходящие сообщению записи справочников
+    (system_prompt в этом случае - build_pruned_extraction_prefix()).
+    Если передан validator, записи с ошибками исправляются коротким повторным запросом (до записи в кэш).
+    При config.LLM_STREAMING_ENABLED ответ читается потоком (см. stream_message_async); если поток
+    оборвался, запрос повторяется обычным способом.
     Возвращает список извлеченных словарей или None в случае ошибки.
     """
+    cache_key = None
+    if cache is not None and cache.enabled and prompt_fingerprint:
+        cache_key = make_cache_key(message, llm_client, prompt_fingerprint, current_date)
+        cached_data = cache.get(cache_key)
+        if cached_data is not None:
+            logging.info(f"[Msg {message_index+1}] Результат взят из кэша ({len(cached_data)} записей).")
+            return cached_data
+
     logging.info(f"[Msg {message_index+1}] Построение промпта...")
     try:
-        # Используем переданный базовый промпт
-        prompt = base_prompt.format(
-            input_message=message,
-            cultures_content=cultures_content,
-            operations_content=operations_content,
-            departments_content=departments_content,
-            current_date=current_date
-        )
+        # Статический префикс передается системным сообщением, здесь - только часть с сообщением
+        if reference_index is not None:
+            references = reference_index.select(message)
+            prompt = build_pruned_message_prompt(message, references, current_date)
+            prompt_tokens = estimate_token_count(system_prompt + prompt)
+            logging.info(f"[Msg {message_index+1}] Промпт ~{prompt_tokens - references['tokens'] + reference_index.full_tokens} -> "
+                         f"~{prompt_tokens} токенов (справочники {'сокращены' if references['pruned'] else 'полные'}).")
+        else:
+            prompt = build_message_prompt(message, current_date)
+        if config.LLM_STRUCTURED_OUTPUT:
+            # В JSON-режиме ответ - объект, поэтому список записей просим обернуть в "reports"
+            prompt += STRUCTURED_OUTPUT_NOTE
         # logging.debug(f"[Msg {message_index+1}] Сгенерированный промпт:\n{prompt}")
         logging.info(f"[Msg {message_index+1}] Промпт успешно построен.")
     except Exception as e:
@@ -52,13 +185,33 @@ async def process_single_message_async(
 
     logging.info(f"[Msg {message_index+1}] Отправка асинхронного запроса к LLM...")
     # Передаем сформированный промпт
-    llm_response = await llm_client.generate_response_async(session, prompt)
+    llm_response = None
+    parser = None
+    if config.LLM_STREAMING_ENABLED:
+        parser = IncrementalRecordParser()
+        llm_response = await stream_message_async(message_index, prompt, llm_client, session, system_prompt, parser)
+        if llm_response is None:
+            parser = None
+            logging.warning(f"[Msg {message_index+1}] Потоковый ответ не получен, повторяем запрос без потока.")
+    if llm_response is None:
+        llm_response = await llm_client.generate_response_async(
+            session, prompt, system_prompt=system_prompt,
+            json_output=JSON_OUTPUT_REPORTS if config.LLM_STRUCTURED_OUTPUT else None
+        )
 
     if llm_response:
         logging.info(f"[Msg {message_index+1}] Ответ от LLM получен.")
         # logging.debug(f"[Msg {message_index+1}] Ответ LLM (сырой):\n{llm_response}")
         logging.info(f"[Msg {message_index+1}] Извлечение JSON из ответа...")
-        extracted_data = extract_json_list(llm_response)
+        extracted_data = parser.result() if parser is not None else None
+        if extracted_data is None:
+            extracted_data = extract_json_list(llm_response)
+        if extracted_data and validator is not None:
+            extracted_data = await reask_invalid_records(
+                message_index, message, extracted_data, validator, llm_client, session, current_date
+            )
+        if extracted_data is not None and cache_key is not None:
+            cache.set(cache_key, extracted_data)
         if extracted_data:
             logging.info(f"[Msg {message_index+1}] JSON успешно извлечен ({len(extracted_data)} записей).")
             return extracted_data
@@ -72,25 +225,292 @@ async def process_single_message_async(
         return None # Возвращаем None при ошибке
 
 
-async def process_batch_async(messages: list[str], output_filename: str = config.REPORT_OUTPUT_PATH, run_quality_test: bool = True) -> list | None:
+async def process_message_batch_async(
+    batch_indices: list[int],
+    messages: list[str],
+    llm_client: TextGenerationClient,
+    session: aiohttp.ClientSession,
+    system_prompt: str,
+    current_date: str,
+    cache: LLMResponseCache | None = None,
+    prompt_fingerprint: str | None = None,
+    reference_index: ReferenceIndex | None = None,
+    validator: RecordValidator | None = None
+) -> list:
     """
-    Асинхронно обрабатывает список сообщений.
+    Асинхронно обрабатывает пакет сообщений одним запросом к LLM.
+
+    Сообщения, уже найденные в кэше, в запрос не попадают. Сообщения, для которых
+    пакетный ответ не содержит корректного списка (или весь пакет завершился ошибкой),
+    обрабатываются повторно по одному через process_single_message_async.
+
+    Returns:
+        Список результатов в порядке batch_indices (список словарей или None для каждого сообщения).
+    """
+    batch_label = f"[Batch {batch_indices[0]+1}-{batch_indices[-1]+1}]"
+    results = {}
+    cache_keys = {}
+
+    # 1. Проверяем кэш по каждому сообщению
+    pending = []
+    for i in batch_indices:
+        if cache is not None and cache.enabled and prompt_fingerprint:
+            cache_keys[i] = make_cache_key(messages[i], llm_client, prompt_fingerprint, current_date)
+            cached_data = cache.get(cache_keys[i])
+            if cached_data is not None:
+                logging.info(f"[Msg {i+1}] Результат взят из кэша ({len(cached_data)} записей).")
+                results[i] = cached_data
+                continue
+        pending.append(i)
+
+    # 2. Один запрос на все оставшиеся сообщения пакета
+    fallback = list(pending)
+    if len(pending) > 1:
+        tagged_messages = [(str(i + 1), messages[i]) for i in pending]
+        try:
+            if reference_index is not None:
+                # Справочники для пакета - объединение кандидатов по всем его сообщениям
+                references = reference_index.select("\n".join(text for _, text in tagged_messages))
+                prompt = build_pruned_batch_message_prompt(tagged_messages, references, current_date)
+            else:
+                prompt = build_batch_message_prompt(tagged_messages, current_date)
+        except Exception as e:
+            logging.error(f"{batch_label} Ошибка при построении пакетного промпта: {e}")
+            prompt = None
+
+        if prompt:
+            logging.info(f"{batch_label} Отправка пакетного запроса к LLM ({len(pending)} сообщений)...")
+            llm_response = await llm_client.generate_response_async(
+                session, prompt, system_prompt=system_prompt,
+                json_output=JSON_OUTPUT_BATCH if config.LLM_STRUCTURED_OUTPUT else None
+            )
+            batch_data = extract_json_dict_by_id(llm_response, [msg_id for msg_id, _ in tagged_messages]) if llm_response else None
+            if batch_data is None:
+                logging.warning(f"{batch_label} Пакетный запрос не удался, переходим к обработке по одному сообщению.")
+            else:
+                fallback = [i for i in pending if batch_data.get(str(i + 1)) is None]
+                received = [i for i in pending if batch_data.get(str(i + 1)) is not None]
+                if validator is not None:
+                    checked = await asyncio.gather(*[
+                        reask_invalid_records(i, messages[i], batch_data[str(i + 1)], validator, llm_client, session, current_date)
+                        for i in received
+                    ])
+                    batch_data.update((str(i + 1), data) for i, data in zip(received, checked))
+                for i in received:
+                    extracted_data = batch_data[str(i + 1)]
+                    if i in cache_keys:
+                        cache.set(cache_keys[i], extracted_data)
+                    results[i] = extracted_data if extracted_data else None
+                if fallback:
+                    logging.warning(f"{batch_label} Нет данных для {len(fallback)} сообщений в пакетном ответе, обрабатываем их по одному.")
+
+    # 3. Запасной вариант: обработка по одному сообщению
+    if fallback:
+        single_results = await asyncio.gather(*[
+            process_single_message_async(
+                message_index=i,
+                message=messages[i],
+                llm_client=llm_client,
+                session=session,
+                system_prompt=system_prompt,
+                current_date=current_date,
+                cache=cache,
+                prompt_fingerprint=prompt_fingerprint,
+                reference_index=reference_index,
+                validator=validator
+            )
+            for i in fallback
+        ], return_exceptions=True)
+        results.update(zip(fallback, single_results))
+
+    return [results.get(i) for i in batch_indices]
+
+
+async def _run_llm_requests(
+    indices: list[int],
+    messages: list[str],
+    llm_client: TextGenerationClient,
+    session: aiohttp.ClientSession,
+    system_prompt: str,
+    current_date: str,
+    cache: LLMResponseCache | None,
+    prompt_fingerprint: str | None,
+    reference_index: ReferenceIndex | None = None,
+    validator: RecordValidator | None = None
+) -> tuple[dict, dict]:
+    """
+    Отправляет сообщения с номерами indices в LLM (пакетами или по одному, см. config.LLM_BATCH_SIZE).
+
+    Returns:
+        (результаты, задержки): словари по номеру сообщения - список записей / None / исключение
+        и время обработки в секундах (для пакета - время всего пакета).
+    """
+    results = {}
+    latencies = {}
+    loop = asyncio.get_running_loop()
+
+    async def timed(coro, task_indices):
+        started = loop.time()
+        try:
+            return await coro
+        finally:
+            for i in task_indices:
+                latencies[i] = loop.time() - started
+
+    tasks = []
+    if config.LLM_BATCH_SIZE > 1 and len(indices) > 1:
+        # Пакетный режим: размер пакета ограничен и количеством сообщений, и размером промпта
+        base_prompt_tokens = estimate_token_count(system_prompt + build_batch_message_prompt([], current_date))
+        batches = [
+            [indices[j] for j in batch]
+            for batch in plan_batches([messages[i] for i in indices], config.LLM_BATCH_SIZE,
+                                      config.LLM_BATCH_MAX_PROMPT_TOKENS, base_prompt_tokens)
+        ]
+        logging.info(f"Пакетный режим ({llm_client.model_name}): {len(indices)} сообщений разбиты на {len(batches)} пакетов "
+                     f"(до {config.LLM_BATCH_SIZE} сообщений, ~{base_prompt_tokens} токенов базового промпта).")
+        for batch_indices in batches:
+            coro = process_message_batch_async(
+                batch_indices=batch_indices,
+                messages=messages,
+                llm_client=llm_client,
+                session=session,
+                system_prompt=system_prompt,
+                current_date=current_date,
+                cache=cache,
+                prompt_fingerprint=prompt_fingerprint,
+                reference_index=reference_index,
+                validator=validator
+            )
+            tasks.append(asyncio.create_task(timed(coro, batch_indices), name=f"ProcessBatch-{batch_indices[0]+1}"))
+
+        logging.info(f"Запуск {len(tasks)} пакетных задач параллельно (лимит одновременных запросов: "
+                     f"{llm_client.concurrency_limiter.current_limit}, адаптивный до {config.LLM_MAX_CONCURRENCY})...")
+        batch_results = await asyncio.gather(*tasks, return_exceptions=True)
+        for batch_indices, batch_result in zip(batches, batch_results):
+            if isinstance(batch_result, Exception):
+                logging.error(f"Ошибка при обработке пакета сообщений {batch_indices[0]+1}-{batch_indices[-1]+1}: {batch_result}")
+                batch_result = [batch_result] * len(batch_indices)
+            results.update(zip(batch_indices, batch_result))
+    else:
+        logging.info(f"Создание {len(indices)} асинхронных задач для обработки сообщений ({llm_client.model_name})...")
+        for i in indices:
+            coro = process_single_message_async(
+                message_index=i,
+                message=messages[i],
+                llm_client=llm_client,
+                session=session,
+                system_prompt=system_prompt,
+                current_date=current_date,
+                cache=cache,
+                prompt_fingerprint=prompt_fingerprint,
+                reference_index=reference_index,
+                validator=validator
+            )
+            tasks.append(asyncio.create_task(timed(coro, [i]), name=f"ProcessMsg-{i+1}"))
+
+        logging.info(f"Запуск {len(tasks)} задач параллельно (лимит одновременных запросов: "
+                     f"{llm_client.concurrency_limiter.current_limit}, адаптивный до {config.LLM_MAX_CONCURRENCY})...")
+        results.update(zip(indices, await asyncio.gather(*tasks, return_exceptions=True)))
+    return results, latencies
+
+
+def save_results_to_excel(results_per_message: list, output_filename: str, duplicate_rows: list | None = None) -> bool:
+    """
+    Сохраняет записи в Excel: записи каждого сообщения подряд, между сообщениями - пустая строка.
 
     Args:
-        messages: Список строк сообщений для обработки.
-        output_filename: Путь к файлу Excel для сохранения результатов.
-                         По умолчанию используется значение из config.REPORT_OUTPUT_PATH.
-        run_quality_test: Флаг для запуска теста качества.
+        results_per_message: Записи по сообщениям (None - у сообщения нет данных, в отчет не попадает).
+        output_filename: Путь к файлу Excel.
+        duplicate_rows: Строки листа Duplicates (повторы сообщений), если есть.
 
     Returns:
-        Список всех извлеченных JSON-объектов (словарей) в случае успеха,
-        или None в случае критической ошибки на этапах инициализации или обработки.
-        Примечание: Пустой список [] возвращается, если обработка прошла успешно,
-        но LLM не извлек никаких данных ни из одного сообщения.
+        True, если файл сохранен; False, если данных нет или запись не удалась.
     """
-    total_messages = len(messages)
-    logging.info(f"Начало АСИНХРОННОЙ пакетной обработки {total_messages} сообщений...")
+    all_extracted_data = [record for message_result in results_per_message if message_result for record in message_result]
+    if not all_extracted_data:
+        logging.warning("Нет данных для сохранения в Excel.")
+        return False
+
+    record_count = len(all_extracted_data)
+    logging.info(f"Подготовка {record_count} извлеченных записей для сохранения в Excel...")
+    try:
+        # 1. Определяем полный набор колонок на основе всех данных
+        df_temp = pd.DataFrame(all_extracted_data)
+        all_columns = df_temp.columns
+        del df_temp # Освобождаем память
+
+        # 2. Создаем пустой DataFrame (одна строка с NaN) с нужными колонками
+        empty_df = pd.DataFrame([[None] * len(all_columns)], columns=all_columns)
+
+        # 3. Создаем список DataFrame'ов для объединения
+        dfs_to_concat = []
+        for message_result in results_per_message:
+            if message_result: # Если для этого сообщения были успешные результаты
+                df_message = pd.DataFrame(message_result)
+                # Переиндексируем, чтобы гарантировать наличие всех колонок и их порядок
+                df_message = df_message.reindex(columns=all_columns)
+                dfs_to_concat.append(df_message)
+                dfs_to_concat.append(empty_df) # Добавляем пустую строку ПОСЛЕ данных сообщения
+
+        # 4. Удаляем последнюю пустую строку, если она есть
+        if dfs_to_concat:
+            dfs_to_concat.pop()
+
+        # 5. Объединяем DataFrame'ы, если есть что объединять
+        if dfs_to_concat:
+            # Фильтруем список, убирая пустые DataFrame'ы перед конкатенацией
+            non_empty_dfs = [df for df in dfs_to_concat if not df.empty]
+            if non_empty_dfs: # Проверяем, остались ли DataFrame'ы после фильтрации
+              df_final = pd.concat(non_empty_dfs, ignore_index=True)
+            else:
+              df_final = pd.DataFrame(columns=all_columns) # Если все оказались пустыми
+        else:
+            # Если после фильтрации не осталось данных (маловероятно, если all_extracted_data не пусто, но для надежности)
+            df_final = pd.DataFrame(columns=all_columns) # Создаем пустой DataFrame с колонками
+
+        # Сохраняем результат
+        logging.info(f"Сохранение итогового DataFrame в Excel: {output_filename}...")
+        output_dir = os.path.dirname(output_filename)
+        os.makedirs(output_dir, exist_ok=True)
+
+        with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
+            df_final.to_excel(writer, sheet_name='Results', index=False, header=True)
+            if duplicate_rows:
+                pd.DataFrame(duplicate_rows).to_excel(writer, sheet_name='Duplicates', index=False, header=True)
+
+        logging.info(f"Результаты успешно сохранены в файл: {output_filename}")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при обработке данных и записи в Excel: {e}")
+        return False
+
+
+@dataclass
+class ProcessingContext:
+    """Общее для всех сообщений запуска: клиенты LLM, промпт, кэш, правила, проверка и маршрутизация."""
+    llm_client: BaseLLMClient | FailoverClient
+    fast_client: BaseLLMClient | FailoverClient | None
+    llm_settings: dict # Настройки и статистика запуска (для теста качества)
+    system_prompt: str
+    prompt_fingerprint: str
+    current_date: str # Дата запуска (process_batch_async); потоковая обработка берет дату каждого сообщения
+    cache: LLMResponseCache
+    reference_index: ReferenceIndex | None
+    rule_parser: RuleBasedParser
+    validator: RecordValidator | None
+    router: MessageRouter
+
+
+def prepare_processing_context(use_cache: bool = True) -> ProcessingContext | None:
+    """
+    Инициализирует все, что нужно для обработки сообщений (один раз на запуск).
+
+    Args:
+        use_cache: Использовать дисковый кэш результатов (см. process_batch_async).
 
+    Returns:
+        ProcessingContext или None при критической ошибке (клиент LLM или справочники).
+    """
     # 1. Инициализация LLM клиента (один раз)
     logging.info("Инициализация клиента LLM...")
     try:
@@ -105,14 +525,13 @@ async def process_batch_async(messages: list[str], output_filename: str = config
         logging.error(f"Критическая ошибка: Не удалось инициализировать клиента LLM: {e}")
         return None
 
-    # 2. Загрузка справочников и базового промпта (один раз)
+    # 2. Загрузка справочников (один раз)
     logging.info("Загрузка справочников и базового промпта...")
     try:
         cultures_content = load_mapping_file(config.CULTURES_FILE_PATH)
         operations_content = load_mapping_file(config.OPERATIONS_FILE_PATH)
         with open(config.DEPARTMENTS_FILE_PATH, 'r', encoding='utf-8') as f:
             departments_content = f.read()
-        base_prompt_template = DETAILED_EXTRACTION_PROMPT
         logging.info("Справочники и базовый промпт успешно загружены.")
     except FileNotFoundError as e:
         logging.error(f"Критическая ошибка: Файл справочника не найден - {e}")
@@ -124,32 +543,180 @@ async def process_batch_async(messages: list[str], output_filename: str = config
     current_date = datetime.date.today().strftime('%Y-%m-%d')
     logging.info(f"Текущая дата: {current_date}")
 
-    # 3. Создание задач для асинхронной обработки
-    tasks = []
-    connector = aiohttp.TCPConnector(limit_per_host=config.MAX_CONCURRENT_REQUESTS)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        logging.info(f"Создание {total_messages} асинхронных задач для обработки сообщений...")
-        for i, message in enumerate(messages):
-            task = asyncio.create_task(
-                process_single_message_async(
-                    message_index=i,
-                    message=message,
-                    llm_client=llm_client,
-                    session=session,
-                    cultures_content=cultures_content,
-                    operations_content=operations_content,
-                    departments_content=departments_content,
-                    current_date=current_date,
-                    base_prompt=base_prompt_template
-                ),
-                name=f"ProcessMsg-{i+1}"
-            )
-            tasks.append(task)
+    # Кэш результатов: отпечаток зависит от шаблона промпта и всех справочников
+    cache = LLMResponseCache(
+        config.LLM_CACHE_PATH,
+        max_age_days=config.LLM_CACHE_MAX_AGE_DAYS,
+        max_size_mb=config.LLM_CACHE_MAX_SIZE_MB,
+        enabled=use_cache and config.LLM_CACHE_ENABLED
+    )
+    # Статический префикс промпта строится один раз и побайтно одинаков для всех запросов запуска
+    reference_index = None
+    if config.LLM_PRUNE_REFERENCES:
+        # Справочники подбираются под каждое сообщение, в префиксе остаются только правила и примеры
+        reference_index = ReferenceIndex(cultures_content, operations_content, departments_content)
+        system_prompt = build_pruned_extraction_prefix()
+    else:
+        system_prompt = build_extraction_prefix(cultures_content, operations_content, departments_content)
+    prompt_fingerprint = build_prompt_fingerprint(
+        system_prompt, EXTRACTION_MESSAGE_TEMPLATE, cultures_content, operations_content, departments_content,
+        STRUCTURED_OUTPUT_NOTE if config.LLM_STRUCTURED_OUTPUT else ""
+    )
+    reset_parse_stats()
+
+    # Маршрутизация: типовые сообщения разбираются правилами, остальные - быстрой или основной моделью
+    fast_client = None
+    if config.LLM_ROUTING_ENABLED:
+        try:
+            fast_client = TextGenerationClient(config.FAST_LLM_PROVIDER, config.FAST_LLM_MODEL_NAME)
+            llm_settings["fast_model_name"] = fast_client.model_name
+        except Exception as e:
+            logging.error(f"Не удалось инициализировать быструю модель, все сообщения пойдут основной: {e}")
+    rule_parser = RuleBasedParser.from_contents(cultures_content, operations_content, departments_content)
+    validator = None
+    if config.RECORD_VALIDATION_ENABLED:
+        validator = RecordValidator.from_contents(cultures_content, operations_content, departments_content)
+    router = MessageRouter(
+        rule_parser,
+        complexity_threshold=config.LLM_ROUTING_COMPLEXITY_THRESHOLD,
+        use_rules=config.RULE_PARSER_ENABLED,
+        use_fast_tier=fast_client is not None
+    )
+    return ProcessingContext(
+        llm_client=llm_client, fast_client=fast_client, llm_settings=llm_settings,
+        system_prompt=system_prompt, prompt_fingerprint=prompt_fingerprint, current_date=current_date,
+        cache=cache, reference_index=reference_index, rule_parser=rule_parser, validator=validator, router=router
+    )
+
+
+def log_processing_summary(context: ProcessingContext) -> None:
+    """Выводит статистику запуска (маршрутизация, разбор ответов, лимитер, токены, кэш) и закрывает кэш."""
+    llm_client, fast_client, llm_settings = context.llm_client, context.fast_client, context.llm_settings
+    validator, cache = context.validator, context.cache
+    context.router.log_summary()
+    if context.reference_index is not None:
+        context.reference_index.log_summary()
+    if validator is not None:
+        validator.log_summary()
+        llm_settings["invalid_records"] = validator.invalid_records
+        llm_settings["reasked_messages"] = validator.reasks
+    if isinstance(llm_client, FailoverClient):
+        llm_client.log_summary()
+
+    parse_stats = get_parse_stats()
+    llm_settings["structured_output"] = config.LLM_STRUCTURED_OUTPUT
+    llm_settings["parse_failure_rate"] = round(parse_stats["failure_rate"], 4)
+    llm_settings["parse_repaired_responses"] = parse_stats["repaired"]
+    if parse_stats["responses"]:
+        logging.info(f"Разбор ответов LLM: {parse_stats['responses']} ответов, не удалось разобрать {parse_stats['failures']} "
+                     f"({parse_stats['failure_rate']:.1%}), восстановлено парсером {parse_stats['repaired']}"
+                     f"{' ' + str(parse_stats['repairs']) if parse_stats['repaired'] else ''}.")
+
+    limiter_stats = llm_client.concurrency_limiter.stats()
+    llm_settings["concurrency_limit"] = limiter_stats["current_limit"]
+    logging.info(f"Лимит одновременных запросов: итоговый {limiter_stats['current_limit']}, "
+                 f"пик одновременных {limiter_stats['peak_in_flight']}, сигналов перегрузки {limiter_stats['overloads']}")
+
+    for client in (fast_client, llm_client):
+        usage = client.usage_stats if client is not None else None
+        if usage and usage["prompt_tokens"]:
+            logging.info(f"Токены за запуск ({client.model_name}): промпт {usage['prompt_tokens']} (из кэша провайдера {usage['cached_tokens']}, "
+                         f"{usage['cached_tokens'] / usage['prompt_tokens']:.0%}), ответ {usage['completion_tokens']}")
+
+    cache_stats = cache.stats()
+    cache.close()
+    if cache_stats["enabled"]:
+        logging.info(f"Кэш LLM: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+                     f"доля попаданий {cache_stats['hit_rate']:.0%}")
+
 
-        # 4. Запуск и ожидание выполнения всех задач
-        logging.info(f"Запуск {len(tasks)} задач параллельно (макс. {config.MAX_CONCURRENT_REQUESTS} одновременных)...")
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+async def process_batch_async(messages: list[str], output_filename: str = config.REPORT_OUTPUT_PATH, run_quality_test: bool = True, use_cache: bool = True, message_ids: list | None = None) -> list | None:
+    """
+    Асинхронно обрабатывает список сообщений.
+
+    Args:
+        messages: Список строк сообщений для обработки.
+        output_filename: Путь к файлу Excel для сохранения результатов.
+                         По умолчанию используется значение из config.REPORT_OUTPUT_PATH.
+        run_quality_test: Флаг для запуска теста качества.
+        use_cache: Использовать дисковый кэш результатов (False - принудительно запросить LLM заново).
+                   Кэш также отключается через config.LLM_CACHE_ENABLED.
+        message_ids: ID сообщений из БД (для листа повторов в отчете). По умолчанию - номера сообщений.
+
+    Returns:
+        Список всех извлеченных JSON-объектов (словарей) в случае успеха,
+        или None в случае критической ошибки на этапах инициализации или обработки.
+        Примечание: Пустой список [] возвращается, если обработка прошла успешно,
+        но LLM не извлек никаких данных ни из одного сообщения.
+    """
+    total_messages = len(messages)
+    logging.info(f"Начало АСИНХРОННОЙ пакетной обработки {total_messages} сообщений...")
+
+    context = prepare_processing_context(use_cache)
+    if context is None:
+        return None
+    llm_client, fast_client, llm_settings = context.llm_client, context.fast_client, context.llm_settings
+    system_prompt, prompt_fingerprint, current_date = context.system_prompt, context.prompt_fingerprint, context.current_date
+    cache, reference_index, validator = context.cache, context.reference_index, context.validator
+    rule_parser, router = context.rule_parser, context.router
+    results = [None] * total_messages
+
+    # Повторы (пересланные/переотправленные отчеты) в LLM не отправляются: результат берется у исходного сообщения
+    if message_ids is None:
+        message_ids = [str(i + 1) for i in range(total_messages)]
+    if config.MESSAGE_DEDUP_ENABLED:
+        canonical, similarity = find_duplicates(messages, config.MESSAGE_DEDUP_THRESHOLD)
+    else:
+        canonical, similarity = list(range(total_messages)), [0.0] * total_messages
+    duplicate_rows = [
+        {"ID сообщения": message_ids[i], "Повтор сообщения": message_ids[c], "Сходство": round(similarity[i], 3)}
+        for i, c in enumerate(canonical) if c != i
+    ]
+    llm_settings["duplicate_messages"] = len(duplicate_rows)
+
+    tier_indices = {TIER_FAST: [], TIER_STRONG: []}
+    for i, message in enumerate(messages):
+        if canonical[i] != i:
+            continue
+        decision = router.route(message, current_date)
+        if decision.tier == TIER_RULES:
+            results[i] = decision.records
+            continue
+        tier_indices[decision.tier].append(i)
+        if fast_client is not None:
+            logging.info(f"[Msg {i+1}] Сложность {decision.score:.2f} -> {decision.tier}")
+    llm_settings["rule_parsed_messages"] = rule_parser.parsed_count
+    logging.info(f"Разобрано правилами без LLM: {rule_parser.parsed_count} из {total_messages} сообщений, "
+                 f"быстрой модели: {len(tier_indices[TIER_FAST])}, основной: {len(tier_indices[TIER_STRONG])}.")
+
+    # 3. Запуск запросов к LLM по уровням
+    # Реальное ограничение параллелизма - адаптивный лимитер клиента (llm_client.concurrency_limiter),
+    # AsyncOpenAI не использует эту aiohttp-сессию
+    connector = aiohttp.TCPConnector(limit_per_host=config.LLM_MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        request_args = dict(
+            messages=messages, session=session, system_prompt=system_prompt,
+            current_date=current_date, cache=cache, prompt_fingerprint=prompt_fingerprint,
+            reference_index=reference_index, validator=validator
+        )
+        strong_indices = list(tier_indices[TIER_STRONG])
+        if tier_indices[TIER_FAST]:
+            fast_results, fast_latencies = await _run_llm_requests(tier_indices[TIER_FAST], llm_client=fast_client, **request_args)
+            for i, result in fast_results.items():
+                router.record_latency(TIER_FAST, fast_latencies[i])
+                if isinstance(result, Exception) or not result:
+                    # Быстрая модель не справилась - отдаем сообщение основной, точность важнее
+                    router.record_escalation()
+                    strong_indices.append(i)
+                else:
+                    results[i] = result
+        if strong_indices:
+            strong_results, strong_latencies = await _run_llm_requests(sorted(strong_indices), llm_client=llm_client, **request_args)
+            for i, result in strong_results.items():
+                router.record_latency(TIER_STRONG, strong_latencies[i])
+                results[i] = result
         logging.info("Все асинхронные задачи завершены.")
+    log_processing_summary(context)
 
     # 5. Обработка результатов
     all_extracted_data = []
@@ -158,6 +725,11 @@ async def process_batch_async(messages: list[str], output_filename: str = config
     successful_results_per_message = []
 
     for i, result in enumerate(results):
+        if canonical[i] != i:
+            # Повтор: данные уже учтены у исходного сообщения, в отчет не дублируем
+            logging.info(f"Сообщение {i+1} - повтор сообщения {canonical[i]+1}, данные не дублируются.")
+            successful_results_per_message.append(None)
+            continue
         if isinstance(result, Exception):
             logging.error(f"Ошибка при обработке сообщения {i+1}: {result}")
             failed_count += 1
@@ -174,65 +746,10 @@ async def process_batch_async(messages: list[str], output_filename: str = config
             successful_results_per_message.append(result)
             successful_count += 1
 
-    logging.info(f"Обработка завершена. Успешно: {successful_count}, Неудачно/Нет данных: {failed_count}")
+    logging.info(f"Обработка завершена. Успешно: {successful_count}, Неудачно/Нет данных: {failed_count}, Повторов: {len(duplicate_rows)}")
 
     # 6. Сохранение в Excel (если есть данные)
-    processing_successful = False # Флаг успешности сохранения в Excel
-    if all_extracted_data:
-        record_count = len(all_extracted_data)
-        logging.info(f"Подготовка {record_count} извлеченных записей для сохранения в Excel...")
-        try:
-            # 1. Определяем полный набор колонок на основе всех данных
-            df_temp = pd.DataFrame(all_extracted_data)
-            all_columns = df_temp.columns
-            del df_temp # Освобождаем память
-
-            # 2. Создаем пустой DataFrame (одна строка с NaN) с нужными колонками
-            empty_df = pd.DataFrame([[None] * len(all_columns)], columns=all_columns)
-
-            # 3. Создаем список DataFrame'ов для объединения
-            dfs_to_concat = []
-            for message_result in successful_results_per_message:
-                if message_result: # Если для этого сообщения были успешные результаты
-                    df_message = pd.DataFrame(message_result)
-                    # Переиндексируем, чтобы гарантировать наличие всех колонок и их порядок
-                    df_message = df_message.reindex(columns=all_columns)
-                    dfs_to_concat.append(df_message)
-                    dfs_to_concat.append(empty_df) # Добавляем пустую строку ПОСЛЕ данных сообщения
-
-            # 4. Удаляем последнюю пустую строку, если она есть
-            if dfs_to_concat:
-                dfs_to_concat.pop()
-
-            # 5. Объединяем DataFrame'ы, если есть что объединять
-            if dfs_to_concat:
-                # Фильтруем список, убирая пустые DataFrame'ы перед конкатенацией
-                non_empty_dfs = [df for df in dfs_to_concat if not df.empty]
-                if non_empty_dfs: # Проверяем, остались ли DataFrame'ы после фильтрации
-                  df_final = pd.concat(non_empty_dfs, ignore_index=True)
-                else:
-                  df_final = pd.DataFrame(columns=all_columns) # Если все оказались пустыми
-            else:
-                # Если после фильтрации не осталось данных (маловероятно, если all_extracted_data не пусто, но для надежности)
-                df_final = pd.DataFrame(columns=all_columns) # Создаем пустой DataFrame с колонками
-
-            # Сохраняем результат
-            logging.info(f"Сохранение итогового DataFrame в Excel: {output_filename}...")
-            output_dir = os.path.dirname(output_filename)
-            os.makedirs(output_dir, exist_ok=True)
-
-            with pd.ExcelWriter(output_filename, engine='openpyxl') as writer:
-                df_final.to_excel(writer, sheet_name='Results', index=False, header=True)
-
-            logging.info(f"Результаты успешно сохранены в файл: {output_filename}")
-            processing_successful = True # Устанавливаем флаг
-
-        except Exception as e:
-            logging.error(f"Ошибка при обработке данных и записи в Excel: {e}")
-            # processing_successful остается False
-    else:
-        logging.warning("Нет данных для сохранения в Excel.")
-        # processing_successful остается False
+    processing_successful = save_results_to_excel(successful_results_per_message, output_filename, duplicate_rows)
 
     # 7. Запуск теста качества (если Excel сохранен успешно и флаг run_quality_test)
     if processing_successful and run_quality_test:
@@ -253,7 +770,7 @@ async def process_batch_async(messages: list[str], output_filename: str = config
             benchmark_file_path=benchmark_file_path,
             processing_file_path=output_filename, # Используем актуальный output_filename
             output_dir_base=quality_test_output_dir,
-            prompt_text=base_prompt_template,
+            prompt_text=DETAILED_EXTRACTION_PROMPT,
             llm_settings=llm_settings,
             provider_name=llm_client.provider
         )
@@ -5,7 +5,14 @@ import os
 import json
 import datetime
 
-from .constants import DETAILED_EXTRACTION_PROMPT
+from .constants import (
+    SYSTEM_ROLE_CONTENT, EXTRACTION_INSTRUCTIONS, EXTRACTION_MESSAGE_TEMPLATE, BATCH_EXTRACTION_MESSAGE_TEMPLATE,
+    DETAILED_EXTRACTION_PROMPT, PRUNED_REFERENCES_TEMPLATE, PRUNED_REFERENCES_PLACEHOLDER,
+    REASK_PROMPT_TEMPLATE
+)
+
+# Грубая оценка: для русскоязычного текста токенайзеры DeepSeek/OpenAI дают ~3 символа на токен
+CHARS_PER_TOKEN = 3
 
 def load_mapping_file(file_path: str) -> str:
     """Загружает содержимое файла справочника.
@@ -66,3 +73,139 @@ def build_detailed_extraction_prompt(
         current_date=current_date
     )
 
+
+def build_extraction_prefix(
+    cultures_content: str,
+    operations_content: str,
+    departments_content: str
+) -> str:
+    """Формирует статическую часть промпта: системная роль, справочники, правила и примеры.
+
+    Результат не зависит от сообщения и даты, поэтому для всех запросов одного запуска
+    он побайтно одинаков и передается системным сообщением - провайдер кэширует этот префикс.
+
+    Returns:
+        Текст системного сообщения для LLM.
+    """
+    return SYSTEM_ROLE_CONTENT + "\n" + EXTRACTION_INSTRUCTIONS.format(
+        cultures_content=cultures_content,
+        operations_content=operations_content,
+        departments_content=departments_content
+    )
+
+
+def build_message_prompt(input_message: str, current_date: str | None = None) -> str:
+    """Формирует изменяемую часть промпта для одного сообщения (добавляется после префикса)."""
+    if current_date is None:
+        current_date = datetime.date.today().isoformat()
+    return EXTRACTION_MESSAGE_TEMPLATE.format(input_message=input_message, current_date=current_date)
+
+
+def build_pruned_extraction_prefix() -> str:
+    """Статическая часть промпта для режима сокращения справочников: правила и примеры без списков.
+
+    Справочники, подобранные под сообщение (ReferenceIndex.select), передаются в пользовательской части
+    через build_pruned_message_prompt / build_pruned_batch_message_prompt.
+    """
+    return SYSTEM_ROLE_CONTENT + "\n" + EXTRACTION_INSTRUCTIONS.format(
+        cultures_content=PRUNED_REFERENCES_PLACEHOLDER,
+        operations_content=PRUNED_REFERENCES_PLACEHOLDER,
+        departments_content=PRUNED_REFERENCES_PLACEHOLDER
+    )
+
+
+def _format_pruned_references(references: dict) -> str:
+    return PRUNED_REFERENCES_TEMPLATE.format(
+        cultures_content=references["cultures_content"],
+        operations_content=references["operations_content"],
+        departments_content=references["departments_content"]
+    )
+
+
+def build_pruned_message_prompt(input_message: str, references: dict, current_date: str | None = None) -> str:
+    """Изменяемая часть промпта для одного сообщения вместе с подобранными справочниками."""
+    return _format_pruned_references(references) + build_message_prompt(input_message, current_date)
+
+
+def build_pruned_batch_message_prompt(tagged_messages: list[tuple[str, str]], references: dict, current_date: str | None = None) -> str:
+    """Изменяемая часть промпта для пакета сообщений вместе с подобранными справочниками."""
+    return _format_pruned_references(references) + build_batch_message_prompt(tagged_messages, current_date)
+
+
+def _format_tagged_messages(tagged_messages: list[tuple[str, str]]) -> str:
+    return "\n\n".join(f"[MSG {msg_id}]\n{text.strip()}" for msg_id, text in tagged_messages)
+
+
+def build_batch_message_prompt(tagged_messages: list[tuple[str, str]], current_date: str | None = None) -> str:
+    """Формирует изменяемую часть промпта для пакета сообщений (пары (id, текст))."""
+    if current_date is None:
+        current_date = datetime.date.today().isoformat()
+    return BATCH_EXTRACTION_MESSAGE_TEMPLATE.format(
+        input_messages=_format_tagged_messages(tagged_messages),
+        current_date=current_date
+    )
+
+
+def estimate_token_count(text: str) -> int:
+    """Приблизительно оценивает количество токенов в тексте (без вызова токенайзера)."""
+    return -(-len(text) // CHARS_PER_TOKEN) # Округление вверх
+
+
+def build_reask_prompt(
+    input_message: str,
+    invalid_records: list[tuple[dict, list[str]]],
+    references: dict,
+    current_date: str | None = None
+) -> str:
+    """Формирует короткий повторный запрос для записей, не прошедших проверку.
+
+    Args:
+        input_message: Текст исходного сообщения.
+        invalid_records: Пары (запись, список ошибок).
+        references: Списки названий для промпта ("cultures", "operations", "departments");
+                    None - справочник не нужен (см. RecordValidator.reference_hints).
+        current_date: Текущая дата в формате YYYY-MM-DD. Если None, используется сегодняшняя.
+
+    Returns:
+        Текст промпта, в ответ на который LLM должен вернуть JSON-список исправленных записей.
+    """
+    if current_date is None:
+        current_date = datetime.date.today().isoformat()
+    titles = {"cultures": "КУЛЬТУРЫ", "operations": "ОПЕРАЦИИ", "departments": "ПОДРАЗДЕЛЕНИЯ"}
+    reference_lines = [
+        f"{title}: {'; '.join(references[key])}" for key, title in titles.items() if references.get(key)
+    ]
+    records = [dict(record, **{"Ошибки": problems}) for record, problems in invalid_records]
+    return REASK_PROMPT_TEMPLATE.format(
+        references="\n" + "\n".join(reference_lines) + "\n" if reference_lines else "",
+        current_date=current_date,
+        input_message=input_message,
+        records=json.dumps(records, ensure_ascii=False, indent=2)
+    )
+
+
+def plan_batches(messages: list[str], max_batch_size: int, max_prompt_tokens: int, base_prompt_tokens: int) -> list[list[int]]:
+    """Разбивает сообщения на пакеты с учетом лимита по количеству и по размеру промпта.
+
+    Сообщения идут в исходном порядке. Пакет закрывается, когда в нем max_batch_size сообщений
+    или когда следующее сообщение не помещается в бюджет max_prompt_tokens - base_prompt_tokens.
+    Слишком длинное сообщение всегда попадает в отдельный пакет.
+
+    Returns:
+        Список пакетов, каждый пакет - список индексов сообщений.
+    """
+    budget = max(max_prompt_tokens - base_prompt_tokens, 0)
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for i, message in enumerate(messages):
+        message_tokens = estimate_token_count(message) + 5 # + метка [MSG id]
+        if current_batch and (len(current_batch) >= max_batch_size or current_tokens + message_tokens > budget):
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(i)
+        current_tokens += message_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
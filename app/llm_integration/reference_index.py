@@ -0,0 +1,147 @@
+# Индекс справочников для сокращения промпта: в запрос попадают только записи,
+# которые могут относиться к терминам сообщения ("пах", "подс", "Отд 12")
+
+import json
+import logging
+import re
+
+from app.llm_integration.prompt_builder import estimate_token_count
+from app.llm_integration.rule_parser import OPERATION_ALIASES, CULTURE_ALIASES
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Слова грамматики отчета, не относящиеся к справочникам
+STOP_WORDS = {
+    "по", "пу", "попу", "под", "на", "и", "в", "с", "к", "от", "га", "ц", "отд", "вал", "день", "ночь",
+    "г", "после", "зяби", "зябь", "урож", "урожайность", "за", "всего", "итого", "начала",
+}
+MIN_PREFIX = 2 # Минимальная длина сокращения для сопоставления по началу слова
+DEPARTMENT_NUMBER_RE = re.compile(r"отд\w*\.?\s*-?\s*(\d+)")
+
+
+def _normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def _words(text: str) -> list[str]:
+    return re.findall(r"[а-яa-z]+", _normalize(text))
+
+
+class _ListIndex:
+    """Строки текстового справочника (первая строка - заголовок) с ключевыми словами."""
+
+    def __init__(self, content: str, aliases: list[tuple[str, str | None]]):
+        lines = content.splitlines()
+        self.header = lines[0] if lines else ""
+        self.entries = [line for line in lines[1:] if line.strip()]
+        self.names = [line.split("(")[0].strip() for line in self.entries]
+        self.entry_words = [set(_words(line)) for line in self.entries]
+        self.aliases = [(re.compile(pattern), name) for pattern, name in aliases if name]
+
+    def match(self, text: str, tokens: list[str]) -> tuple[set[int], set[str]]:
+        """Возвращает (номера подходящих строк, токены сообщения, которые что-то нашли)."""
+        matched = set()
+        used_tokens = set()
+        for pattern, name in self.aliases:
+            if pattern.search(text):
+                target = name.replace("{0} ", "") # "{0} Гербицидная обработка" - все номера обработки
+                matched.update(i for i, n in enumerate(self.names) if target in n)
+        for token in tokens:
+            for i, words in enumerate(self.entry_words):
+                if any(word.startswith(token) for word in words):
+                    matched.add(i)
+                    used_tokens.add(token)
+        return matched, used_tokens
+
+    def render(self, indices: set[int] | None) -> str:
+        entries = self.entries if indices is None else [self.entries[i] for i in sorted(indices)]
+        return "\n".join([self.header] + entries)
+
+
+class ReferenceIndex:
+    """Предварительно проиндексированные справочники культур, операций и подразделений.
+
+    Для сообщения подбирает кандидатов по сокращениям из текста. Если сопоставление
+    ненадежно (в сообщении много нераспознанных слов или для справочника не найдено
+    ни одного кандидата), для этого справочника используется полный список.
+    """
+
+    def __init__(self, cultures_content: str, operations_content: str, departments_content: str,
+                 max_unknown_ratio: float = 0.25):
+        self.cultures = _ListIndex(cultures_content, CULTURE_ALIASES)
+        self.operations = _ListIndex(operations_content, OPERATION_ALIASES)
+        self.departments_content = departments_content
+        self.departments = json.loads(departments_content)
+        self.max_unknown_ratio = max_unknown_ratio
+        self._department_names = {}
+        for i, entry in enumerate(self.departments):
+            for field in ("ПУ", "Подразделение"):
+                if entry.get(field):
+                    self._department_names.setdefault(_normalize(entry[field]), set()).add(i)
+        self.full_tokens = estimate_token_count(cultures_content + operations_content + departments_content)
+        self.selections = 0
+        self.full_fallbacks = 0
+        self.selected_tokens = 0 # Сумма токенов выбранных справочников по всем запросам
+
+    def _match_departments(self, text: str) -> tuple[set[int], set[str]]:
+        matched = set()
+        used_tokens = set()
+        numbers = {int(n) for n in DEPARTMENT_NUMBER_RE.findall(text)}
+        for i, entry in enumerate(self.departments):
+            if numbers & set(entry.get("Отделения") or []):
+                matched.add(i)
+        for name, indices in self._department_names.items():
+            if re.search(r"\b" + re.escape(name) + r"\b", text):
+                matched.update(indices)
+                used_tokens.update(_words(name))
+        return matched, used_tokens
+
+    def select(self, message: str) -> dict:
+        """Подбирает записи справочников для сообщения.
+
+        Returns:
+            Словарь с текстами справочников для промпта (cultures_content, operations_content,
+            departments_content), флагом pruned (False - использованы полные списки)
+            и оценкой размера справочников в токенах (tokens).
+        """
+        selection = self._select(message)
+        selection["tokens"] = estimate_token_count(
+            selection["cultures_content"] + selection["operations_content"] + selection["departments_content"]
+        )
+        self.selections += 1
+        self.selected_tokens += selection["tokens"]
+        return selection
+
+    def _select(self, message: str) -> dict:
+        text = _normalize(message)
+        tokens = [t for t in dict.fromkeys(_words(message)) if len(t) >= MIN_PREFIX and t not in STOP_WORDS]
+
+        culture_ids, culture_tokens = self.cultures.match(text, tokens)
+        operation_ids, operation_tokens = self.operations.match(text, tokens)
+        department_ids, department_tokens = self._match_departments(text)
+
+        unknown = [t for t in tokens if t not in culture_tokens | operation_tokens | department_tokens]
+        if tokens and len(unknown) / len(tokens) > self.max_unknown_ratio:
+            self.full_fallbacks += 1
+            return {
+                "cultures_content": self.cultures.render(None),
+                "operations_content": self.operations.render(None),
+                "departments_content": self.departments_content,
+                "pruned": False,
+            }
+
+        departments = [self.departments[i] for i in sorted(department_ids)] if department_ids else self.departments
+        return {
+            "cultures_content": self.cultures.render(culture_ids or None),
+            "operations_content": self.operations.render(operation_ids or None),
+            "departments_content": json.dumps(departments, ensure_ascii=False, indent=2),
+            "pruned": True,
+        }
+
+    def log_summary(self) -> None:
+        if not self.selections:
+            return
+        mean_tokens = self.selected_tokens / self.selections
+        logging.info(f"Сокращение справочников: {self.selections} запросов, полные списки в {self.full_fallbacks}; "
+                     f"справочники в среднем ~{mean_tokens:.0f} токенов вместо ~{self.full_tokens}.")
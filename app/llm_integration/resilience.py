@@ -0,0 +1,192 @@
+# Повторные попытки, экспоненциальная задержка, circuit breaker и статистика задержек для запросов к LLM
+
+import asyncio
+import collections
+import email.utils
+import logging
+import math
+import random
+import time
+
+from openai import APITimeoutError, APIConnectionError, RateLimitError, APIStatusError
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Классы ошибок
+ERROR_RATE_LIMIT = "rate_limit" # 429: повторяем, уважая Retry-After
+ERROR_TIMEOUT = "timeout" # Таймаут запроса: повторяем
+ERROR_CONNECTION = "connection" # Сетевая ошибка: повторяем
+ERROR_SERVER = "server" # 5xx: повторяем
+ERROR_FATAL = "fatal" # 4xx (кроме 408/409/429), ошибки ответа: повтор не поможет
+
+RETRYABLE_ERRORS = {ERROR_RATE_LIMIT, ERROR_TIMEOUT, ERROR_CONNECTION, ERROR_SERVER}
+
+
+def classify_error(error: Exception) -> str:
+    """Определяет класс ошибки запроса к LLM."""
+    if isinstance(error, RateLimitError):
+        return ERROR_RATE_LIMIT
+    # APITimeoutError - наследник APIConnectionError, проверяем его первым
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError, TimeoutError)):
+        return ERROR_TIMEOUT
+    if isinstance(error, APIConnectionError):
+        return ERROR_CONNECTION
+    if isinstance(error, APIStatusError):
+        if error.status_code >= 500:
+            return ERROR_SERVER
+        if error.status_code in (408, 409):
+            return ERROR_TIMEOUT
+        return ERROR_FATAL
+    return ERROR_FATAL
+
+
+def is_overload_error(error: Exception) -> bool:
+    """Ошибка означает перегрузку провайдера (429 или 5xx) - сигнал снизить параллелизм."""
+    return classify_error(error) in (ERROR_RATE_LIMIT, ERROR_SERVER)
+
+
+def get_retry_after(error: Exception) -> float | None:
+    """Возвращает задержку из заголовков Retry-After / retry-after-ms ответа провайдера (в секундах)."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # Retry-After может быть HTTP-датой
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Параметры повторных попыток: экспоненциальная задержка с полным джиттером."""
+
+    def __init__(self, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @property
+    def max_attempts(self) -> int:
+        return self.max_retries + 1
+
+    def compute_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Задержка перед повтором номер attempt (с 0).
+
+        Случайная величина из [0, base * 2^attempt] ("full jitter"), чтобы параллельные запросы
+        не повторялись синхронно. Если провайдер прислал Retry-After, ждем не меньше него.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для деградировавшего провайдера.
+
+    closed - запросы идут как обычно; после failure_threshold подряд неудачных попыток -> open.
+    open - запросы сразу отклоняются; через recovery_timeout секунд -> half_open.
+    half_open - пропускается один пробный запрос: успех -> closed, неудача -> снова open.
+    Если пробный запрос завершился без результата (отменен), release_probe() разрешает следующий.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0, name: str = "llm"):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.name = name
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        """Примет ли цепь запрос сейчас (closed или half_open без пробного запроса в работе)."""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._probe_in_flight)
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            logging.info(f"[{self.name}] Circuit breaker: пробный запрос после паузы.")
+            return True
+        return False
+
+    def is_probe(self) -> bool:
+        """True, если запрос, только что пропущенный allow_request(), - пробный (цепь в half_open)."""
+        return self._state == self.HALF_OPEN and self._probe_in_flight
+
+    def release_probe(self) -> None:
+        """Снимает отметку пробного запроса, если он завершился без record_success/record_failure."""
+        if self._state == self.HALF_OPEN and self._probe_in_flight:
+            logging.warning(f"[{self.name}] Circuit breaker: пробный запрос прерван, следующий запрос станет пробным.")
+            self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        if self._state != self.CLOSED:
+            logging.info(f"[{self.name}] Circuit breaker замкнут: провайдер снова отвечает.")
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logging.error(f"[{self.name}] Circuit breaker разомкнут после {self._consecutive_failures} ошибок подряд: "
+                              f"запросы отклоняются {self.recovery_timeout:.0f} с.")
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек успешных запросов для оценки перцентилей."""
+
+    def __init__(self, window: int = 200):
+        self._samples = collections.deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> float | None:
+        """Перцентиль q (0..1) по окну или None, если замеров нет."""
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
@@ -0,0 +1,108 @@
+# Маршрутизация сообщений между правилами, быстрой (дешевой) и сильной моделью
+#
+# Короткие типовые отчеты ("Отд 4 70/70") не требуют сильной модели, а сложные сводки
+# (несколько ПУ, уборка с валом и урожайностью, проценты) - требуют. Роутер оценивает
+# сложность сообщения и выбирает уровень обработки.
+
+import logging
+import re
+import time
+from dataclasses import dataclass
+
+from app.llm_integration.rule_parser import RuleBasedParser
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Уровни обработки
+TIER_RULES = "rules" # Разобрано правилами, LLM не нужен
+TIER_FAST = "fast" # Быстрая/дешевая модель
+TIER_STRONG = "strong" # Основная (сильная) модель
+
+# Признаки сложных сообщений: проценты, урожайность/вал, детализация по технике, остатки
+HARD_MARKERS_RE = re.compile(r"%|урож|вал\b|амазон|пневмоход|нарастающ|остаток|в т\.?\s*ч")
+
+
+@dataclass
+class RoutingDecision:
+    """Результат маршрутизации одного сообщения."""
+    tier: str
+    score: float # Оценка сложности 0..1
+    records: list | None = None # Записи, если сообщение разобрано правилами
+
+
+class MessageRouter:
+    """Выбирает уровень обработки для каждого сообщения по оценке сложности.
+
+    Оценка складывается из длины сообщения, количества строк, доли распознанных правилами
+    слов и признаков сложных отчетов. Сообщения, полностью разобранные правилами, в LLM не идут.
+    """
+
+    def __init__(self, rule_parser: RuleBasedParser, complexity_threshold: float = 0.5,
+                 use_rules: bool = True, use_fast_tier: bool = True):
+        self.rule_parser = rule_parser
+        self.complexity_threshold = complexity_threshold
+        self.use_rules = use_rules
+        self.use_fast_tier = use_fast_tier # False - быстрой модели нет, все остальное идет основной
+        self.tier_counts = {TIER_RULES: 0, TIER_FAST: 0, TIER_STRONG: 0}
+        self.tier_latencies = {TIER_RULES: [], TIER_FAST: [], TIER_STRONG: []}
+        self.escalations = 0 # Сообщения, переотправленные с быстрой модели на сильную
+
+    def score_complexity(self, message: str) -> float:
+        """Оценивает сложность сообщения от 0 (типовое) до 1 (сложное)."""
+        lines = [line for line in message.splitlines() if line.strip()]
+        length_score = min(len(message) / 600, 1.0)
+        lines_score = min(len(lines) / 15, 1.0)
+        unknown_score = 1.0 - self.rule_parser.token_coverage(message)
+        markers = len(HARD_MARKERS_RE.findall(message.lower()))
+        markers_score = min(markers / 3, 1.0)
+        score = 0.2 * length_score + 0.15 * lines_score + 0.4 * unknown_score + 0.25 * markers_score
+        return round(score, 3)
+
+    def route(self, message: str, current_date: str) -> RoutingDecision:
+        """Определяет уровень обработки сообщения.
+
+        Args:
+            message: Текст сообщения.
+            current_date: Текущая дата YYYY-MM-DD (для разбора правилами).
+
+        Returns:
+            RoutingDecision с уровнем, оценкой сложности и (для правил) готовыми записями.
+        """
+        if self.use_rules:
+            started = time.perf_counter()
+            records = self.rule_parser.parse(message, current_date)
+            if records is not None:
+                self.tier_counts[TIER_RULES] += 1
+                self.record_latency(TIER_RULES, time.perf_counter() - started)
+                return RoutingDecision(TIER_RULES, 0.0, records)
+        score = self.score_complexity(message)
+        tier = TIER_FAST if self.use_fast_tier and score < self.complexity_threshold else TIER_STRONG
+        self.tier_counts[tier] += 1
+        return RoutingDecision(tier, score)
+
+    def record_latency(self, tier: str, seconds: float) -> None:
+        self.tier_latencies[tier].append(seconds)
+
+    def record_escalation(self) -> None:
+        self.escalations += 1
+
+    def stats(self) -> dict:
+        """Количество сообщений и средняя задержка по уровням."""
+        result = {"escalations": self.escalations}
+        for tier, count in self.tier_counts.items():
+            latencies = self.tier_latencies[tier]
+            result[tier] = {
+                "messages": count,
+                "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            }
+        return result
+
+    def log_summary(self) -> None:
+        stats = self.stats()
+        parts = []
+        for tier in (TIER_RULES, TIER_FAST, TIER_STRONG):
+            tier_stats = stats[tier]
+            latency = f", средняя задержка {tier_stats['mean_latency']:.3f} с" if tier_stats["mean_latency"] is not None else ""
+            parts.append(f"{tier}: {tier_stats['messages']}{latency}")
+        logging.info(f"Маршрутизация: {'; '.join(parts)}; переотправлено на сильную модель: {stats['escalations']}")
@@ -0,0 +1,419 @@
+# Детерминированный разбор типовых сообщений без обращения к LLM
+#
+# Большинство отчетов пишутся по жесткой схеме:
+#   Пахота зяби под сах св          <- заголовок: операция + культура
+#   По Пу 26/488                    <- итог по производственному участку: за день / с начала
+#   Отд 12 26/221                   <- данные по отделению
+# Такие сообщения разбираются здесь напрямую в ту же схему записей, что возвращает LLM.
+# Если хотя бы одна строка сообщения не укладывается в грамматику или термин неоднозначен,
+# парсер возвращает None и сообщение уходит в LLM.
+
+import json
+import logging
+import re
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Сокращения операций -> полное название из operations.txt.
+# Порядок важен: более специфичные шаблоны идут раньше общих.
+OPERATION_ALIASES = [
+    (r"\b2-?(?:е|ое|e)\s*диск\w*(?:-\w+)?", "Дискование 2-е"),
+    (r"\bдиск\w*(?:-\w+)?\s*2-?(?:е|ое|e)\b", "Дискование 2-е"),
+    (r"\b3-?(?:е|ье|e)\s*диск\w*(?:-\w+)?", "Дискование 3-е"),
+    (r"\bдиск\w*(?:-\w+)?\s*3-?(?:е|ье|e)\b", "Дискование 3-е"),
+    (r"\bдиск\w*(?:-\w+)?", "Дискование"),
+    (r"\bпах\w*", "Пахота"),
+    (r"\bчиз\w*", "Чизлевание"),
+    (r"\bпредп\w*\s+культ\w*", "Предпосевная культивация"),
+    (r"\b1-?я\s+междур\w*\s+культ\w*", "1-я междурядная культивация"),
+    (r"\b2-?я\s+междур\w*\s+культ\w*", "2-я междурядная культивация"),
+    (r"\bсплошн\w*\s+культ\w*", "Сплошная культивация"),
+    (r"\bкульт\w*", "Культивация"),
+    (r"\b2-?(?:е|ое)\s+вырав\w*(?:-\w+)?", "2-е Выравнивание зяби"),
+    (r"\bвырав\w*(?:-\w+)?", "Выравнивание зяби"),
+    (r"\bприк\w*", "Прикатывание посевов"),
+    (r"\bуборк\w*", "Уборка"),
+    (r"\b(?:по)?сев(?:а)?\b", "Сев"),
+    (r"\b2-?я\s+подкормк\w*", "2-я подкормка"),
+    (r"\bподкормк\w*", "Подкормка"),
+    (r"\bвнесени\w*\s+мин\w*\s+удобр\w*", "Внесение минеральных удобрений"),
+    (r"\bборонован\w*\s+довсход\w*|\bдовсход\w*\s+боронован\w*", "Боронование довсходовое"),
+    (r"\b([1-4])-?\w*\s+гербиц\w*(?:\s+обработк\w*)?", "{0} Гербицидная обработка"),
+    (r"\bинсектиц\w*(?:\s+обработк\w*)?", "Инсектицидная обработка"),
+    (r"\bфунгиц\w*(?:\s+обработк\w*)?|\bфункиц\w*(?:\s+обработк\w*)?", "Функицидная обработка"),
+]
+
+# Сокращения культур -> полное название из cultures.txt. Значение None - термин неоднозначен
+# (например, "мн тр" - три вида многолетних трав), такое сообщение отдается LLM.
+CULTURE_ALIASES = [
+    (r"\bмн\w*\s*/?\s*тр\w*", None),
+    (r"\bсорго\w*", None),
+    (r"\bкук\w*\s*/?\s*сил\w*|\bк\.?\s*сил\w*|\bсил\w*\s+кук\w*|\bсил(?:ос)?\b", "Кукуруза кормовая"),
+    (r"\bкук\w*\s+сем\w*", "Кукуруза семенная"),
+    (r"\bкук\w*(?:\s+тов\w*)?", "Кукуруза товарная"),
+    (r"\bоз\w*\s+зел\w*\s+корм\w*|\bпш\w*\s+оз\w*\s+(?:на\s+)?зел\w*\s+корм\w*", "Пшеница озимая на зеленый корм"),
+    (r"\bоз\w*\s+пш\w*\s+сем\w*|\bпш\w*\s+оз\w*\s+сем\w*", "Пшеница озимая семенная"),
+    (r"\bоз\w*\s+пш\w*(?:\s+тов\w*)?|\bпш\w*\s+оз\w*(?:\s+тов\w*)?", "Пшеница озимая товарная"),
+    (r"\bоз\w*\s+ячм\w*\s+сем\w*", "Ячмень озимый семенной"),
+    (r"\bоз\w*\s+ячм\w*|\bячм\w*\s+оз\w*", "Ячмень озимый"),
+    (r"\bрапс\w*\s+яр\w*|\bяр\w*\s+рапс\w*", "Рапс яровой"),
+    (r"\bрапс\w*\s+оз\w*|\bоз\w*\s+рапс\w*", "Рапс озимый"),
+    (r"\bсах\w*\s*/?\s*св\w*|\bсв\w*\s+сах\w*|\bс\.?\s*св\w*|\bсв\b|\bсвекл\w*", "Свекла сахарная"),
+    (r"\bподс\w*\s+сем\w*", "Подсолнечник семенной"),
+    (r"\bподс\w*\s+конд\w*", "Подсолнечник кондитерский"),
+    (r"\bподс\w*(?:\s+тов\w*)?", "Подсолнечник товарный"),
+    (r"\bсо(?:я|и|ю|е)\s+сем\w*", "Соя семенная"),
+    (r"\bсо(?:я|и|ю|е)\b(?:\s+тов\w*)?", "Соя товарная"),
+    (r"\bгорох\w*\s+на\s+зерно", "Горох на зерно"),
+    (r"\bгорох\w*(?:\s+тов\w*)?", "Горох товарный"),
+    (r"\bов(?:ес|са|су|сом)\b", "Овес"),
+    (r"\bлюцерн\w*", "Люцерна"),
+    (r"\bпар\b|\bчист\w*\s+пар\w*", "Чистый пар"),
+]
+
+# Слова, которые могут оставаться в заголовке после распознавания операции и культуры
+HEADER_FILLER_WORDS = {"под", "после", "по", "на", "и", "в", "зяби", "зябь", "день", "ночь", "г", "га"}
+
+# Строки со служебными показателями, которые в отчет не попадают (см. "ВАЖНО" в промпте)
+IGNORED_LINE_RE = re.compile(
+    r"^(?:урож\w*|диг\w*|на\s+завод|положено|в+везено|остаток|осадки|работал\w*|бригада|оз\s*[-:]?\s*\d)"
+)
+
+NUMBER = r"\d+(?:[.,]\d+)?"
+DATE_RE = re.compile(r"(?<![\d/])(\d{1,2})\.(\d{1,2})(?:\.(\d{2,4}))?(?:\s*г\.?)?(?![\d/])")
+PAIR_RE = re.compile(rf"({NUMBER})\s*/\s*({NUMBER})")
+DEPARTMENT_RE = re.compile(r"\bотд\.?\s*-?\s*(\d+)\b")
+PU_RE = re.compile(
+    rf"(?:\bпо\s*)?\bпу\b\s*[-:]?\s*(?:\"?([а-я]+)\"?\s*[-:]?\s*)?({NUMBER})(?:\s*/\s*({NUMBER}))?\s*(?:га\b)?"
+)
+PU_JOINED_RE = re.compile(rf"\bпопу\s*[-:]?\s*({NUMBER})(?:\s*/\s*({NUMBER}))?") # "ПоПу 91/609"
+# Служебные слова грамматики отчета (для оценки доли распознанного текста)
+KEYWORDS_RE = re.compile(r"\b(?:отд\w*|по|пу|попу|вал\w*|га|ц|день|ночь|г)\b")
+GROSS_RE = re.compile(rf"^вал\w*\s*[-:]?\s*({NUMBER})(?:\s*/\s*({NUMBER}))?\s*(ц\w*)?$")
+
+
+def _normalize(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[–—]", "-", text)
+    return re.sub(r"[ \t]+", " ", text).strip()
+
+
+def _to_number(value: str | None) -> float | int | None:
+    if value is None:
+        return None
+    number = float(value.replace(",", "."))
+    return int(number) if number.is_integer() else number
+
+
+def _canonical_names(content: str) -> list[str]:
+    """Полные названия из файла справочника (без заголовка и пояснений в скобках)."""
+    names = []
+    for line in content.splitlines()[1:]:
+        name = line.split("(")[0].strip()
+        if name:
+            names.append(name)
+    return names
+
+
+class _Block:
+    """Одна комбинация (Операция, Культура, Подразделение) и ее данные."""
+
+    def __init__(self, operation: str, culture: str | None, context_department: str | None):
+        self.operation = operation
+        self.culture = culture
+        self.context_department = context_department
+        self.department_numbers = []
+        self.department_pairs = [] # Пары (за день, с начала) по отделениям
+        self.direct_pair = None # Пара без указания отделения/ПУ
+        self.pu_pair = None # (за день | None, с начала)
+        self.gross = None # (вал за день, вал с начала) в центнерах
+        self.after_ignored = False # Были служебные строки (урожайность и т.п.) - дальнейшие "По ПУ" к ним
+        self.after_gross = False
+
+
+class RuleBasedParser:
+    """Разбирает типовые сообщения по справочникам из data/mappings/."""
+
+    def __init__(self, cultures: list[str], operations: list[str], departments: list[dict]):
+        self.cultures = set(cultures)
+        self.operations = set(operations)
+        self.department_by_number = {}
+        self.department_by_name = {}
+        for entry in departments:
+            department = entry.get("Подразделение")
+            if entry.get("ПУ"):
+                self.department_by_name[_normalize(entry["ПУ"])] = department
+            if department:
+                self.department_by_name[_normalize(department)] = department
+            for number in entry.get("Отделения") or []:
+                self.department_by_number[int(number)] = department
+        self._operation_aliases = [(re.compile(p), name) for p, name in OPERATION_ALIASES]
+        self._culture_aliases = [(re.compile(p), name) for p, name in CULTURE_ALIASES]
+        # Длинные названия проверяем первыми ("сп коломейцево" раньше "мир")
+        names = sorted(self.department_by_name, key=len, reverse=True)
+        self._department_name_re = re.compile(r"\b(?:" + "|".join(re.escape(n) for n in names) + r")\b") if names else None
+        self.parsed_count = 0
+        self.deferred_count = 0
+
+    @classmethod
+    def from_contents(cls, cultures_content: str, operations_content: str, departments_content: str) -> "RuleBasedParser":
+        """Создает парсер из содержимого файлов справочников (как они загружаются в processor.py)."""
+        return cls(
+            _canonical_names(cultures_content),
+            _canonical_names(operations_content),
+            json.loads(departments_content)
+        )
+
+    def _match_operation(self, text: str) -> tuple[str | None, str]:
+        """Возвращает (операция, текст без нее). Несколько разных операций в одном заголовке - неоднозначность."""
+        found = None
+        for pattern, name in self._operation_aliases:
+            match = pattern.search(text)
+            if not match:
+                continue
+            if "{0}" in name:
+                name = name.format(match.group(1))
+            if found is not None and found != name:
+                raise ValueError(f"несколько операций в заголовке: {found}, {name}")
+            found = name
+            text = text[:match.start()] + " " + text[match.end():]
+        if found is not None and found not in self.operations:
+            raise ValueError(f"операции '{found}' нет в справочнике")
+        return found, text
+
+    def _match_culture(self, text: str) -> tuple[str | None, str]:
+        for pattern, name in self._culture_aliases:
+            match = pattern.search(text)
+            if not match:
+                continue
+            if name is None:
+                raise ValueError(f"неоднозначная культура: '{match.group(0)}'")
+            if name not in self.cultures:
+                raise ValueError(f"культуры '{name}' нет в справочнике")
+            return name, text[:match.start()] + " " + text[match.end():]
+        return None, text
+
+    def _parse_header(self, text: str) -> tuple[str, str | None]:
+        operation, rest = self._match_operation(text)
+        if operation is None:
+            raise ValueError(f"не распознана операция: '{text}'")
+        culture, rest = self._match_culture(rest)
+        leftover = [w for w in re.split(r"[^а-я0-9]+", rest) if w and w not in HEADER_FILLER_WORDS and not re.fullmatch(r"20\d\d", w)]
+        if leftover:
+            raise ValueError(f"нераспознанные слова в заголовке: {leftover}")
+        return operation, culture
+
+    def _extract_date(self, text: str, current_date: str) -> tuple[str | None, str]:
+        match = DATE_RE.search(text)
+        if not match:
+            return None, text
+        day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+        if not (1 <= day <= 31 and 1 <= month <= 12):
+            return None, text
+        if year is None:
+            year = current_date[:4]
+        elif len(year) == 2:
+            year = "20" + year
+        return f"{year}-{month:02d}-{day:02d}", text[:match.start()] + " " + text[match.end():]
+
+    def _department_for(self, block: _Block) -> str | None:
+        departments = {self.department_by_number.get(n) for n in block.department_numbers}
+        if None in departments or len(departments) > 1:
+            return None
+        if departments:
+            return departments.pop()
+        return block.context_department
+
+    def _block_to_record(self, block: _Block, report_date: str) -> dict:
+        department = self._department_for(block)
+        if department is None:
+            raise ValueError(f"не определено подразделение для '{block.operation}'")
+        if block.direct_pair and block.department_pairs:
+            raise ValueError("смешаны данные по отделениям и без отделения")
+
+        day = total = None
+        if block.department_pairs:
+            day = sum(p[0] for p in block.department_pairs)
+            total = sum(p[1] for p in block.department_pairs)
+        elif block.direct_pair:
+            day, total = block.direct_pair
+        if block.pu_pair:
+            # Данные "По ПУ" приоритетнее отделений; одно число у ПУ - только "с начала"
+            pu_day, pu_total = block.pu_pair
+            day = pu_day if pu_day is not None else day
+            total = pu_total
+        gross_day, gross_total = block.gross or (None, None)
+        if day is None and total is None and gross_day is None:
+            raise ValueError(f"нет числовых данных для '{block.operation}'")
+
+        return {
+            "Дата": report_date,
+            "Подразделение": department,
+            "Операция": block.operation,
+            "Культура": block.culture,
+            "За день, га": day,
+            "С начала операции, га": total,
+            "Вал за день, ц": gross_day,
+            "Вал с начала, ц": gross_total,
+        }
+
+    def _parse(self, message: str, current_date: str) -> list[dict]:
+        blocks = []
+        block = None
+        context_department = None
+        report_date = None
+        in_parentheses = False
+
+        for raw_line in message.splitlines():
+            line = _normalize(raw_line)
+            # Детализация по технике в скобках ("в т.ч Амазон ...") может занимать несколько строк
+            if in_parentheses:
+                if ")" not in line:
+                    continue
+                line = line.split(")", 1)[1]
+                in_parentheses = False
+            # Уточнения без чисел ("Уборка сои (семенной)") оставляем, детализацию с цифрами убираем
+            line = re.sub(r"\(([^)\d]*)\)", r" \1 ", line)
+            line = re.sub(r"\([^)]*\)", " ", line)
+            if "(" in line:
+                line, in_parentheses = line.split("(", 1)[0], True
+            line = line.strip(" .,:;-")
+            if not line:
+                continue
+
+            if IGNORED_LINE_RE.match(line):
+                if block is None:
+                    raise ValueError(f"служебная строка вне блока: '{line}'")
+                block.after_ignored = True
+                continue
+
+            gross_match = GROSS_RE.match(line)
+            if gross_match:
+                if block is None or block.gross is not None:
+                    raise ValueError(f"неожиданная строка вала: '{line}'")
+                divisor = 1 if gross_match.group(3) else 100 # По умолчанию вал в килограммах
+                gross_day = float(_to_number(gross_match.group(1))) / divisor
+                gross_total = float(_to_number(gross_match.group(2))) / divisor if gross_match.group(2) else None
+                block.gross = (gross_day, gross_total)
+                block.after_gross = True
+                continue
+
+            line_date, line = self._extract_date(line, current_date)
+            if line_date:
+                if report_date and report_date != line_date:
+                    raise ValueError(f"несколько дат в сообщении: {report_date}, {line_date}")
+                report_date = line_date
+
+            # Строка-контекст: только название ПУ/подразделения (и, возможно, дата)
+            names_removed = self._department_name_re.sub(" ", line) if self._department_name_re else line
+            if not re.sub(r"[^а-я0-9]+|\bдень\b|\bночь\b", "", names_removed):
+                name_match = self._department_name_re.search(line) if self._department_name_re else None
+                if name_match:
+                    context_department = self.department_by_name[name_match.group(0)]
+                    block = None
+                continue
+
+            # Разбор строки с данными: "ПУ ...", "Отд N", пара чисел, остальное - заголовок
+            pu_values = None
+            pu_match = PU_JOINED_RE.search(line) or PU_RE.search(line)
+            if pu_match:
+                if pu_match.re is PU_RE:
+                    pu_name = pu_match.group(1)
+                    if pu_name and pu_name not in self.department_by_name:
+                        raise ValueError(f"неизвестный ПУ: '{pu_name}'")
+                    first, second = pu_match.group(2), pu_match.group(3)
+                    if pu_name:
+                        context_department = self.department_by_name[pu_name]
+                else:
+                    first, second = pu_match.group(1), pu_match.group(2)
+                pu_values = (_to_number(first), _to_number(second)) if second else (None, _to_number(first))
+                line = line[:pu_match.start()] + " " + line[pu_match.end():]
+
+            department_matches = DEPARTMENT_RE.findall(line)
+            if len(department_matches) > 1:
+                raise ValueError(f"несколько отделений в строке: '{line}'")
+            department_number = int(department_matches[0]) if department_matches else None
+            line = DEPARTMENT_RE.sub(" ", line)
+
+            pairs = PAIR_RE.findall(line)
+            if len(pairs) > 1:
+                raise ValueError(f"несколько пар чисел в строке: '{line}'")
+            pair = (_to_number(pairs[0][0]), _to_number(pairs[0][1])) if pairs else None
+            header_text = PAIR_RE.sub(" ", line).strip(" .,:;-")
+
+            if header_text:
+                operation, culture = self._parse_header(header_text)
+                block = _Block(operation, culture, context_department)
+                blocks.append(block)
+            elif block is None:
+                raise ValueError(f"данные до заголовка: '{raw_line}'")
+            elif pu_values and (block.after_ignored or (block.after_gross and not pair and department_number is None)):
+                # "По ПУ" после урожайности/вала относится к служебным показателям
+                if block.after_gross and not block.after_ignored:
+                    raise ValueError(f"неоднозначная строка ПУ после вала: '{raw_line}'")
+                continue
+            elif block.after_ignored or block.after_gross:
+                raise ValueError(f"данные после служебных строк: '{raw_line}'")
+
+            if department_number is not None:
+                block.department_numbers.append(department_number)
+                if pair:
+                    block.department_pairs.append(pair)
+            elif pair:
+                if block.direct_pair:
+                    raise ValueError(f"повтор данных без отделения: '{raw_line}'")
+                block.direct_pair = pair
+            if pu_values:
+                if block.pu_pair:
+                    raise ValueError(f"повтор данных по ПУ: '{raw_line}'")
+                block.pu_pair = pu_values
+            if not header_text and department_number is None and not pair and not pu_values:
+                raise ValueError(f"нераспознанная строка: '{raw_line}'")
+
+        if not blocks:
+            raise ValueError("не найдено ни одного блока с операцией")
+
+        records = [self._block_to_record(b, report_date or current_date) for b in blocks]
+        keys = [(r["Операция"], r["Культура"], r["Подразделение"]) for r in records]
+        if len(set(keys)) != len(keys):
+            raise ValueError("повторяющиеся комбинации операция/культура/подразделение")
+        return records
+
+    def token_coverage(self, message: str) -> float:
+        """Доля слов сообщения, известных грамматике (операции, культуры, подразделения, служебные слова).
+
+        Используется роутером для оценки сложности сообщения, которое правила не разобрали полностью.
+        """
+        text = _normalize(message)
+        words = list(re.finditer(r"[а-яa-z]+", text))
+        if not words:
+            return 1.0
+        covered = set()
+        patterns = [p for p, _ in self._operation_aliases] + [p for p, _ in self._culture_aliases] + [KEYWORDS_RE]
+        if self._department_name_re:
+            patterns.append(self._department_name_re)
+        for pattern in patterns:
+            for match in pattern.finditer(text):
+                covered.update(range(match.start(), match.end()))
+        recognized = sum(1 for w in words if w.start() in covered or w.group(0) in HEADER_FILLER_WORDS)
+        return recognized / len(words)
+
+    def parse(self, message: str, current_date: str) -> list[dict] | None:
+        """Разбирает сообщение целиком.
+
+        Args:
+            message: Текст сообщения.
+            current_date: Текущая дата YYYY-MM-DD (если в сообщении нет своей даты).
+
+        Returns:
+            Список записей в схеме LLM или None, если сообщение не удалось разобрать полностью.
+        """
+        try:
+            records = self._parse(message, current_date)
+        except ValueError as e:
+            self.deferred_count += 1
+            logging.debug(f"Правила не разобрали сообщение ({e}), оно будет отправлено в LLM.")
+            return None
+        self.parsed_count += 1
+        return records
@@ -0,0 +1,151 @@
+# Проверка записей, извлеченных LLM: значения из справочников и правдоподобность чисел.
+# Записи с ошибками отправляются на короткий повторный запрос (только сообщение и эти записи)
+# вместо полной повторной обработки сообщения.
+
+import datetime
+import json
+import logging
+
+from app.llm_integration.constants import RECORD_FIELDS
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+AREA_FIELDS = ("За день, га", "С начала операции, га")
+GROSS_FIELDS = ("Вал за день, ц", "Вал с начала, ц")
+MAX_DAILY_AREA_HA = 5000 # Больше за день не делает ни одно подразделение
+MAX_YIELD_CENTNERS_PER_HA = 1000 # Выше - вал, скорее всего, не переведен из кг в центнеры
+MAX_REPORT_AGE_DAYS = 366 # Дата отчета старше - скорее всего, ошибка распознавания
+
+
+def _names(content: str) -> list[str]:
+    """Полные названия из файла справочника (без заголовка и пояснений в скобках)."""
+    return [name for name in (line.split("(")[0].strip() for line in content.splitlines()[1:]) if name]
+
+
+def _is_known(value, names: set[str]) -> bool:
+    return isinstance(value, str) and value in names
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class RecordValidator:
+    """Проверяет записи по справочникам и правилам правдоподобности чисел.
+
+    Ведет счетчики проверенных и ошибочных записей, повторных запросов и исправлений.
+    """
+
+    def __init__(self, cultures: list[str], operations: list[str], departments: list[str]):
+        self.cultures = cultures
+        self.operations = operations
+        self.departments = departments
+        self._cultures = set(cultures)
+        self._operations = set(operations)
+        self._departments = set(departments)
+        self.checked_records = 0
+        self.invalid_records = 0
+        self.reasks = 0
+        self.fixed_records = 0
+
+    @classmethod
+    def from_contents(cls, cultures_content: str, operations_content: str, departments_content: str) -> "RecordValidator":
+        """Создает валидатор из содержимого файлов справочников (как они загружаются в processor.py)."""
+        departments = list(dict.fromkeys(entry["Подразделение"] for entry in json.loads(departments_content)))
+        return cls(_names(cultures_content), _names(operations_content), departments)
+
+    def validate(self, record, current_date: str) -> list[str]:
+        """Проверяет одну запись.
+
+        Args:
+            record: Запись, извлеченная LLM.
+            current_date: Текущая дата YYYY-MM-DD (дата отчета не может быть позже нее).
+
+        Returns:
+            Список описаний ошибок (пустой, если запись корректна).
+        """
+        if not isinstance(record, dict):
+            return ["запись не является JSON-объектом"]
+        problems = [f"нет поля \"{field}\"" for field in RECORD_FIELDS if field not in record]
+
+        date = record.get("Дата")
+        try:
+            report_date = datetime.date.fromisoformat(date)
+            today = datetime.date.fromisoformat(current_date)
+            if report_date > today:
+                problems.append(f"дата {date} позже текущей даты {current_date}")
+            elif (today - report_date).days > MAX_REPORT_AGE_DAYS:
+                problems.append(f"дата {date} старше года")
+        except (TypeError, ValueError):
+            problems.append(f"дата {date!r} не в формате YYYY-MM-DD")
+
+        operation = record.get("Операция")
+        if operation is None:
+            problems.append("не определена операция")
+        elif not _is_known(operation, self._operations):
+            problems.append(f"операции \"{operation}\" нет в справочнике")
+        culture = record.get("Культура")
+        if culture is None:
+            problems.append("не определена культура")
+        elif not _is_known(culture, self._cultures):
+            problems.append(f"культуры \"{culture}\" нет в справочнике")
+        department = record.get("Подразделение")
+        if department is not None and not _is_known(department, self._departments):
+            problems.append(f"подразделения \"{department}\" нет в справочнике")
+
+        numbers = {}
+        for field in AREA_FIELDS + GROSS_FIELDS:
+            value = record.get(field)
+            if value is None:
+                continue
+            if not _is_number(value):
+                problems.append(f"\"{field}\" не число: {value!r}")
+            elif value < 0:
+                problems.append(f"\"{field}\" отрицательное: {value}")
+            else:
+                numbers[field] = value
+        if not any(record.get(field) is not None for field in AREA_FIELDS + GROSS_FIELDS):
+            problems.append("нет ни одного числового значения")
+
+        day_area, total_area = numbers.get(AREA_FIELDS[0]), numbers.get(AREA_FIELDS[1])
+        if day_area is not None and total_area is not None and day_area > total_area:
+            problems.append(f"за день ({day_area} га) больше, чем с начала операции ({total_area} га)")
+        if day_area is not None and day_area > MAX_DAILY_AREA_HA:
+            problems.append(f"за день {day_area} га - больше {MAX_DAILY_AREA_HA} га")
+        day_gross, total_gross = numbers.get(GROSS_FIELDS[0]), numbers.get(GROSS_FIELDS[1])
+        if day_gross is not None and total_gross is not None and day_gross > total_gross:
+            problems.append(f"вал за день ({day_gross} ц) больше, чем с начала ({total_gross} ц)")
+        if day_gross is not None and day_area and day_gross / day_area > MAX_YIELD_CENTNERS_PER_HA:
+            problems.append(f"урожайность {day_gross / day_area:.0f} ц/га - вал, вероятно, не переведен из кг в центнеры")
+        return problems
+
+    def find_invalid(self, records: list, current_date: str) -> list[tuple[int, list[str]]]:
+        """Проверяет все записи сообщения. Возвращает (номер записи, ошибки) для некорректных записей."""
+        invalid = []
+        for i, record in enumerate(records):
+            problems = self.validate(record, current_date)
+            if problems:
+                invalid.append((i, problems))
+        self.checked_records += len(records)
+        self.invalid_records += len(invalid)
+        return invalid
+
+    def reference_hints(self, records: list[dict]) -> dict:
+        """Справочники, которые нужно приложить к повторному запросу: только для полей с ошибками."""
+        def failed(field, known, allow_null=False):
+            return any(
+                not (record.get(field) is None and allow_null) and not _is_known(record.get(field), known)
+                for record in records
+            )
+        return {
+            "cultures": self.cultures if failed("Культура", self._cultures) else None,
+            "operations": self.operations if failed("Операция", self._operations) else None,
+            "departments": self.departments if failed("Подразделение", self._departments, allow_null=True) else None,
+        }
+
+    def log_summary(self) -> None:
+        if not self.checked_records:
+            return
+        logging.info(f"Проверка записей: {self.checked_records} проверено, с ошибками {self.invalid_records}, "
+                     f"повторных запросов {self.reasks}, исправлено записей {self.fixed_records}.")
@@ -1,14 +1,19 @@
+import argparse
 import logging
 # import json # Больше не нужен для вывода
 import os
 import asyncio
 import sqlite3 # Добавляем для работы с БД
-import datetime # Для отметки времени обработки
+import datetime
 
-from app.config import REPORT_OUTPUT_PATH, BASE_DIR # Импортируем путь к отчету и базовую директорию
+from app.config import REPORT_OUTPUT_PATH, BASE_DIR, LLM_PIPELINE_ENABLED # Импортируем путь к отчету и базовую директорию
 from app.utils.google_drive_uploader import upload_to_drive # Раскомментировано
+from app.utils import message_store, report_builder
 # from data.test_messages import TEST_MESSAGES # Больше не используем тестовые сообщения
-from app.llm_integration.processor import process_batch_async # Новая асинхронная функция
+from app.llm_integration.processor import process_batch_async, prepare_processing_context, log_processing_summary # Новая асинхронная функция
+from app.llm_integration.pipeline import process_stream_async, ExtractionStoreSink
+from app.llm_integration.bulk_jobs import BulkJob, run_bulk_job
+from app.ingest_daemon import IngestionDaemon
 
 # Настройка базового логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,108 +27,147 @@ def get_unprocessed_messages(date_str: str | None = None):
     Если date_str указана (в формате YYYY-MM-DD), фильтрует по дате.
     Иначе извлекает все необработанные.
     """
-    conn = None
+    if date_str:
+        logging.info(f"Поиск необработанных сообщений за {date_str}...")
+    else:
+        logging.info(f"Поиск всех необработанных сообщений...")
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        if date_str:
-            # Фильтруем по дате, используя SQLite функцию DATE()
-            # Выбираем id и text сообщений за указанную дату, где processed_at еще не установлен
-            sql = "SELECT id, text FROM messages WHERE processed_at IS NULL AND DATE(timestamp) = ?"
-            cursor.execute(sql, (date_str,))
-            logging.info(f"Поиск необработанных сообщений за {date_str}...")
-        else:
-            # Выбираем все необработанные
-            sql = "SELECT id, text FROM messages WHERE processed_at IS NULL"
-            cursor.execute(sql)
-            logging.info(f"Поиск всех необработанных сообщений...")
-            
-        messages = cursor.fetchall() # Получаем список кортежей (id, text)
-        logging.info(f"Найдено {len(messages)} сообщений.")
-        return messages
+        # Выборка за дату - диапазон timestamp по индексу (см. app/utils/message_store.py)
+        messages = [(msg_id, text) for msg_id, text, _ in message_store.fetch_unprocessed(DB_PATH, date_str)]
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка при чтении из БД {DB_PATH}: {e}")
+        return []
+    logging.info(f"Найдено {len(messages)} сообщений.")
+    return messages
+
+def get_unprocessed_messages_in_range(date_from: str, date_to: str):
+    """
+    Извлекает необработанные сообщения за период (даты YYYY-MM-DD включительно).
+    Возвращает список кортежей (id, text, дата сообщения YYYY-MM-DD).
+    """
+    logging.info(f"Поиск необработанных сообщений за {date_from} - {date_to}...")
+    try:
+        messages = message_store.fetch_unprocessed(DB_PATH, date_from, date_to)
     except sqlite3.Error as e:
         logging.error(f"Ошибка при чтении из БД {DB_PATH}: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
+    logging.info(f"Найдено {len(messages)} сообщений.")
+    return messages
+
+def report_path_for_date(date_str: str) -> str:
+    """Путь к файлу отчета за дату: папка и расширение из config.REPORT_OUTPUT_PATH, имя Отчет_ДАТА."""
+    return report_builder.report_filename(date_str)
 
 def mark_messages_as_processed(message_ids: list[str]):
     """Помечает сообщения как обработанные в базе данных."""
     if not message_ids:
         return
-    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        now = datetime.datetime.now().isoformat() # Текущее время в ISO формате
-        # Подготавливаем данные для обновления: список кортежей (время, id)
-        update_data = [(now, msg_id) for msg_id in message_ids]
-        # Используем executemany для обновления нескольких строк одним запросом
-        cursor.executemany("UPDATE messages SET processed_at = ? WHERE id = ?", update_data)
-        conn.commit() # Сохраняем изменения
+        message_store.mark_processed(DB_PATH, message_ids)
         logging.info(f"Отмечено как обработанные {len(message_ids)} сообщений.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка при обновлении БД {DB_PATH}: {e}")
-        if conn:
-            conn.rollback() # Откатываем изменения при ошибке
-    finally:
-        if conn:
-            conn.close()
 
-async def run_processing_for_date(date_str: str, google_drive_folder_url: str) -> dict:
+async def upload_report(report_path: str, google_drive_folder_url: str) -> bool:
+    """
+    Загружает отчет на Google Drive под тем же именем, что и локальный файл (Отчет_ДАТА.xlsx).
+
+    Returns:
+        True, если загрузка прошла без ошибок.
+    """
+    drive_filename = os.path.basename(report_path)
+    logging.info(f"Запуск загрузки файла {report_path} на Google Drive как '{drive_filename}' в папку {google_drive_folder_url}...")
+    try:
+        loop = asyncio.get_running_loop()
+        # Передаем локальный путь, имя файла для диска и URL папки
+        await loop.run_in_executor(None, upload_to_drive, report_path, drive_filename, google_drive_folder_url)
+        logging.info(f"Загрузка файла на Google Drive инициирована.")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при попытке запуска загрузки на Google Drive: {e}")
+        return False
+
+async def run_processing_for_date(date_str: str, google_drive_folder_url: str, context=None) -> dict:
     """
     Запускает обработку сообщений за указанную дату.
 
     Args:
         date_str: Дата в формате 'YYYY-MM-DD'.
-        google_drive_folder_url: URL папки Google Drive для загрузки отчета.
+        google_drive_folder_url: URL папки Google Drive для загрузки отчета (None - не загружать).
+        context: Общий ProcessingContext нескольких дат (см. run_processing_for_range); только для потоковой обработки.
 
     Returns:
         Словарь с результатом:
-        { 'success': bool, 'report_path': str | None, 'processed_count': int, 'message': str }
+        { 'success': bool, 'report_path': str | None, 'processed_count': int, 'record_count': int,
+          'failed_count': int, 'message': str }
+        failed_count - сообщения, обработка которых не удалась: они остаются необработанными, success=False.
     """
     logging.info(f"--- Запуск обработки для даты: {date_str} ---")
     result_status = {
         'success': False,
         'report_path': None,
         'processed_count': 0,
+        'record_count': 0,
+        'failed_count': 0,
         'message': ''
     }
 
-    unprocessed_messages = get_unprocessed_messages(date_str)
+    # Путь к выходному файлу для этой даты
+    output_filename = report_path_for_date(date_str)
 
-    if not unprocessed_messages:
+    if LLM_PIPELINE_ENABLED:
+        # Потоковая обработка: сообщения читаются из БД страницами, результат каждого сообщения сразу
+        # сохраняется в БД и сообщение отмечается обработанным. После сбоя повторный запуск досылает
+        # в LLM только оставшиеся сообщения, а отчет строится по всем сохраненным результатам даты.
+        logging.info(f"Запуск потоковой LLM обработки сообщений. Результат будет сохранен в {output_filename}")
+        try:
+            pipeline_stats = await process_stream_async(
+                message_store.iter_unprocessed(DB_PATH, date_str), ExtractionStoreSink(DB_PATH), context=context
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при работе с БД {DB_PATH}: {e}")
+            pipeline_stats = None
+        processing_ok = pipeline_stats is not None
+        message_count = pipeline_stats['messages'] if processing_ok else 0
+        record_count = pipeline_stats['records'] if processing_ok else None
+        result_status['failed_count'] = pipeline_stats['failed'] if processing_ok else 0
+        if processing_ok and message_count:
+            # Отчет строится в отдельном потоке: при обработке периода отчеты дат пишутся параллельно
+            loop = asyncio.get_running_loop()
+            report = await loop.run_in_executor(None, report_builder.build_report, DB_PATH, output_filename, date_str)
+            processing_ok = report['success']
+    else:
+        unprocessed_messages = get_unprocessed_messages(date_str)
+        message_ids = [msg[0] for msg in unprocessed_messages]
+        record_count = 0
+        processing_ok = True
+        if unprocessed_messages:
+            message_texts = [msg[1] for msg in unprocessed_messages]
+            logging.info(f"Запуск LLM обработки {len(message_texts)} сообщений. Результат будет сохранен в {output_filename}")
+            processed_data_list = await process_batch_async(
+                messages=message_texts,
+                output_filename=output_filename, # Передаем новое имя файла
+                run_quality_test=False,
+                message_ids=message_ids
+            )
+            record_count = len(processed_data_list) if isinstance(processed_data_list, list) else 'N/A'
+            processing_ok = processed_data_list is not None
+            if processing_ok:
+                mark_messages_as_processed(message_ids)
+        message_count = len(message_ids)
+
+    if processing_ok and not message_count:
         result_status['success'] = True
         result_status['message'] = f"Нет необработанных сообщений за {date_str}."
         logging.info(result_status['message'])
         return result_status
 
-    message_texts = [msg[1] for msg in unprocessed_messages]
-    message_ids = [msg[0] for msg in unprocessed_messages]
-    result_status['processed_count'] = len(message_ids)
-
-    # --- Определяем путь к выходному файлу для этой даты ---
-    # Базовая папка для отчетов берется из config (папка data/reports)
-    report_dir = os.path.dirname(REPORT_OUTPUT_PATH)
-    # Расширение файла берем из config (по умолчанию .xlsx)
-    report_ext = os.path.splitext(os.path.basename(REPORT_OUTPUT_PATH))[1]
-    # Новое имя файла
-    output_filename = os.path.join(report_dir, f"Отчет_{date_str}{report_ext}")
+    result_status['processed_count'] = message_count
+    result_status['record_count'] = record_count if isinstance(record_count, int) else 0
     result_status['report_path'] = output_filename # Сохраняем путь для возврата
-    # --- Конец определения пути --- 
-    
-    logging.info(f"Запуск LLM обработки {len(message_texts)} сообщений. Результат будет сохранен в {output_filename}")
 
-    processed_data_list = await process_batch_async(
-        messages=message_texts,
-        output_filename=output_filename, # Передаем новое имя файла
-        run_quality_test=False
-    )
-
-    if processed_data_list is not None:
-        logging.info(f"LLM обработка сообщений завершена. Получено {len(processed_data_list) if isinstance(processed_data_list, list) else 'N/A'} записей.")
-        mark_messages_as_processed(message_ids)
+    if processing_ok:
+        logging.info(f"LLM обработка сообщений завершена. Получено {record_count} записей.")
         
         report_created = os.path.exists(output_filename) and os.path.getsize(output_filename) > 0
         if report_created:
@@ -131,19 +175,10 @@ async def run_processing_for_date(date_str: str, google_drive_folder_url: str) -
             result_status['success'] = True
             result_status['message'] = f"Обработка за {date_str} завершена. Отчет сохранен: {output_filename}"
             
-            # Загрузка на Google Drive
-            # Имя файла на диске будет таким же, как локальное (Отчет_ДАТА.xlsx)
-            drive_filename = os.path.basename(output_filename) 
-            logging.info(f"Запуск загрузки файла {output_filename} на Google Drive как '{drive_filename}' в папку {google_drive_folder_url}...")
-            try:
-                loop = asyncio.get_running_loop()
-                # Передаем локальный путь, имя файла для диска и URL папки
-                await loop.run_in_executor(None, upload_to_drive, output_filename, drive_filename, google_drive_folder_url)
-                logging.info(f"Загрузка файла на Google Drive инициирована.")
-            except Exception as e:
-                 logging.error(f"Ошибка при попытке запуска загрузки на Google Drive: {e}")
-                 # Не меняем статус успеха, т.к. основная обработка прошла
-                 result_status['message'] += " (Ошибка при загрузке на Google Drive)"
+            # Загрузка на Google Drive (как у пакетной обработки и демона - только если папка указана)
+            if google_drive_folder_url and not await upload_report(output_filename, google_drive_folder_url):
+                # Не меняем статус успеха, т.к. основная обработка прошла
+                result_status['message'] += " (Ошибка при загрузке на Google Drive)"
         else:
              logging.warning("Файл отчета пуст или не создан после обработки LLM.")
              result_status['message'] = f"Обработка за {date_str} завершена, но файл отчета не создан."
@@ -151,9 +186,164 @@ async def run_processing_for_date(date_str: str, google_drive_folder_url: str) -
         logging.error(f"Асинхронная пакетная обработка сообщений за {date_str} завершилась с ошибкой.")
         result_status['message'] = f"Ошибка при LLM обработке сообщений за {date_str}."
 
+    if result_status['failed_count']:
+        # Отчет содержит успешно обработанные сообщения, неудачные будут повторены при следующем запуске
+        result_status['success'] = False
+        result_status['message'] += (f" Не обработано из-за ошибок: {result_status['failed_count']} сообщений, "
+                                     f"они будут повторены при следующем запуске.")
+        logging.warning(result_status['message'])
+
     logging.info(f"--- Завершение обработки для даты: {date_str} ---")
     return result_status
 
+async def run_processing_for_range(start_date: str, end_date: str, google_drive_folder_url: str | None = None) -> dict:
+    """
+    Обрабатывает все даты периода одновременно: у каждой даты своя потоковая обработка и свой отчет,
+    а клиенты LLM, лимитер запросов, справочники и кэш - общие (один ProcessingContext). Период занимает
+    примерно столько же, сколько самая долгая дата, а не сумму всех дат. В конце сохраняется сводка по датам.
+    При LLM_PIPELINE_ENABLED=false даты обрабатываются по очереди прежним способом.
+
+    Args:
+        start_date: Первая дата периода 'YYYY-MM-DD'.
+        end_date: Последняя дата периода 'YYYY-MM-DD' (включительно).
+        google_drive_folder_url: URL папки Google Drive для отчетов (None - не загружать). Отчеты загружаются
+                                 по очереди после обработки всех дат, а не одновременно из обработок дат.
+
+    Returns:
+        Словарь с результатом:
+        { 'success': bool, 'dates': {дата: результат run_processing_for_date}, 'processed_count': int,
+          'record_count': int, 'summary_path': str | None, 'message': str }
+    """
+    logging.info(f"--- Запуск обработки периода {start_date} - {end_date} ---")
+    result_status = {'success': False, 'dates': {}, 'processed_count': 0, 'record_count': 0,
+                     'summary_path': None, 'message': ''}
+    first, last = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    if first > last:
+        result_status['message'] = f"Начало периода {start_date} позже конца {end_date}."
+        logging.error(result_status['message'])
+        return result_status
+    dates = [(first + datetime.timedelta(days=i)).isoformat() for i in range((last - first).days + 1)]
+
+    if LLM_PIPELINE_ENABLED:
+        context = prepare_processing_context()
+        if context is None:
+            result_status['message'] = "Не удалось подготовить обработку LLM (см. лог)."
+            return result_status
+        try:
+            results = await asyncio.gather(
+                *(run_processing_for_date(date_str, None, context=context) for date_str in dates),
+                return_exceptions=True
+            )
+        finally:
+            log_processing_summary(context)
+    else:
+        results = []
+        for date_str in dates:
+            try:
+                results.append(await run_processing_for_date(date_str, None))
+            except Exception as e:
+                results.append(e)
+
+    summary_rows = []
+    for date_str, result in zip(dates, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Ошибка при обработке даты {date_str}: {result}")
+            result = {'success': False, 'report_path': None, 'processed_count': 0, 'record_count': 0,
+                      'failed_count': 0, 'message': f"Ошибка при обработке за {date_str}: {result}"}
+        if google_drive_folder_url and result['report_path'] and os.path.exists(result['report_path']):
+            # Загрузки по одной: одновременные авторизации OAuth из потоков дат конфликтуют
+            if not await upload_report(result['report_path'], google_drive_folder_url):
+                result['message'] += " (Ошибка при загрузке на Google Drive)"
+        result_status['dates'][date_str] = result
+        result_status['processed_count'] += result['processed_count']
+        result_status['record_count'] += result['record_count']
+        summary_rows.append({
+            "Дата": date_str,
+            "Сообщений обработано": result['processed_count'],
+            "Записей получено": result['record_count'],
+            "Ошибок обработки": result['failed_count'],
+            "Успешно": "да" if result['success'] else "нет",
+            "Результат": result['message'],
+        })
+
+    failed_dates = [date_str for date_str, result in result_status['dates'].items() if not result['success']]
+    summary_path = report_builder.report_filename(start_date, end_date, prefix="Сводка")
+    if report_builder.write_range_summary(summary_rows, summary_path):
+        result_status['summary_path'] = summary_path
+    result_status['success'] = not failed_dates
+    result_status['message'] = (
+        f"Обработка периода {start_date} - {end_date} завершена: дат {len(dates)}, сообщений "
+        f"{result_status['processed_count']}, записей {result_status['record_count']}"
+        + (f", с ошибкой: {', '.join(failed_dates)}." if failed_dates else ".")
+    )
+    logging.info(result_status['message'])
+    return result_status
+
+def run_bulk_backfill(date_from: str, date_to: str, job_name: str | None = None,
+                      google_drive_folder_url: str | None = None, wait: bool = True) -> dict:
+    """
+    Обрабатывает сообщения за период пакетным заданием (Batch API провайдера, см. bulk_jobs.py)
+    и сохраняет отчеты по датам. Прерванное задание продолжается повторным вызовом с тем же job_name.
+
+    Args:
+        date_from: Первая дата периода 'YYYY-MM-DD'.
+        date_to: Последняя дата периода 'YYYY-MM-DD' (включительно).
+        job_name: Имя задания (по умолчанию backfill_<date_from>_<date_to>).
+        google_drive_folder_url: URL папки Google Drive для загрузки отчетов (None - не загружать).
+        wait: False - только отправить задание/проверить статус, не дожидаясь завершения.
+
+    Returns:
+        Словарь с результатом:
+        { 'success': bool, 'reports': {дата: путь}, 'processed_count': int, 'message': str }
+    """
+    job_name = job_name or f"backfill_{date_from}_{date_to}"
+    logging.info(f"--- Пакетная обработка за {date_from} - {date_to} (задание '{job_name}') ---")
+    result_status = {'success': False, 'reports': {}, 'processed_count': 0, 'message': ''}
+
+    messages = []
+    if not BulkJob(job_name).exists:
+        messages = get_unprocessed_messages_in_range(date_from, date_to)
+        if not messages:
+            result_status['success'] = True
+            result_status['message'] = f"Нет необработанных сообщений за {date_from} - {date_to}."
+            logging.info(result_status['message'])
+            return result_status
+
+    reports = run_bulk_job(
+        job_name,
+        messages=[msg[1] for msg in messages],
+        message_ids=[msg[0] for msg in messages],
+        message_dates=[msg[2] for msg in messages],
+        db_path=DB_PATH,
+        report_path_for_date=report_path_for_date,
+        wait=wait
+    )
+    if reports is None:
+        result_status['message'] = f"Пакетное задание '{job_name}' не завершено (см. лог), его можно продолжить повторным запуском."
+        logging.info(result_status['message'])
+        return result_status
+
+    # Результаты сообщений уже сохранены в БД (и сообщения отмечены обработанными) при разборе задания
+    failed_count = 0
+    for date_str, report in reports.items():
+        failed_count += report.get('failed', 0)
+        result_status['processed_count'] += len(report['message_ids']) - report.get('failed', 0)
+        if not report['report_path']:
+            continue
+        result_status['reports'][date_str] = report['report_path']
+        if google_drive_folder_url:
+            try:
+                upload_to_drive(report['report_path'], os.path.basename(report['report_path']), google_drive_folder_url)
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке {report['report_path']} на Google Drive: {e}")
+    result_status['success'] = not failed_count
+    result_status['message'] = (f"Пакетная обработка за {date_from} - {date_to} завершена: "
+                                f"отчетов {len(result_status['reports'])}, сообщений {result_status['processed_count']}"
+                                + (f", не обработано из-за ошибок {failed_count} (будут повторены при следующем запуске)."
+                                   if failed_count else "."))
+    logging.info(result_status['message'])
+    return result_status
+
 # Старая функция main остается для возможности запуска из командной строки (обрабатывает всё)
 async def main():
     logging.info(f"Проверка базы данных на наличие ВСЕХ необработанных сообщений: {DB_PATH}...")
@@ -174,7 +364,8 @@ async def main():
     processed_data_list = await process_batch_async(
         messages=message_texts, 
         output_filename=output_file, 
-        run_quality_test=False 
+        run_quality_test=False,
+        message_ids=message_ids
     )
 
     if processed_data_list is not None:
@@ -197,7 +388,48 @@ async def main():
 if __name__ == "__main__":
     # Запуск обработки для конкретной даты (пример)
     # asyncio.run(run_processing_for_date('2025-04-18'))
-    
-    # Или запуск обработки всех необработанных сообщений (как раньше)
-    asyncio.run(main())
+
+    # Пакетный бэкфилл периода через Batch API провайдера:
+    #   python -m app.main --bulk-from 2025-07-01 --bulk-to 2025-08-31 [--bulk-no-wait]
+    # Обработка периода: все даты одновременно, отчет по каждой дате и сводка:
+    #   python -m app.main --range-from 2025-08-01 --range-to 2025-08-31 [--drive-folder URL]
+    # Непрерывная обработка новых сообщений по мере поступления (остановка - Ctrl+C):
+    #   python -m app.main --daemon [--date 2025-08-10] [--drive-folder URL] [--idle-exit 600]
+    # Отчет из уже сохраненных результатов (без LLM), срез по подразделению / операции, Excel или CSV:
+    #   python -m app.main --report-from 2025-08-01 --report-to 2025-08-10 [--department АОР] [--operation Пахота] [--output отчет.csv]
+    arg_parser = argparse.ArgumentParser(description="Обработка сообщений из базы парсера")
+    arg_parser.add_argument("--bulk-from", help="Первая дата пакетной обработки YYYY-MM-DD")
+    arg_parser.add_argument("--bulk-to", help="Последняя дата пакетной обработки YYYY-MM-DD (по умолчанию = --bulk-from)")
+    arg_parser.add_argument("--bulk-job", help="Имя пакетного задания (для продолжения прерванного)")
+    arg_parser.add_argument("--bulk-no-wait", action="store_true", help="Не ждать завершения пакетов")
+    arg_parser.add_argument("--drive-folder", help="URL папки Google Drive для отчетов (пакетная обработка, период, демон)")
+    arg_parser.add_argument("--range-from", help="Первая дата обработки периода YYYY-MM-DD (даты обрабатываются одновременно)")
+    arg_parser.add_argument("--range-to", help="Последняя дата обработки периода YYYY-MM-DD (по умолчанию = --range-from)")
+    arg_parser.add_argument("--daemon", action="store_true", help="Непрерывная обработка новых сообщений базы парсера")
+    arg_parser.add_argument("--date", help="Для --daemon: только сообщения этой даты YYYY-MM-DD")
+    arg_parser.add_argument("--idle-exit", type=float, help="Для --daemon: остановиться, если новых сообщений нет столько секунд")
+    arg_parser.add_argument("--report-from", help="Первая дата отчета из сохраненных результатов YYYY-MM-DD")
+    arg_parser.add_argument("--report-to", help="Последняя дата отчета YYYY-MM-DD (по умолчанию = --report-from)")
+    arg_parser.add_argument("--department", help="Только записи подразделения (поле 'Подразделение')")
+    arg_parser.add_argument("--operation", help="Только записи операции (поле 'Операция')")
+    arg_parser.add_argument("--output", help="Файл отчета: .xlsx или .csv (по умолчанию - в папке отчетов)")
+    args = arg_parser.parse_args()
+
+    if args.range_from:
+        asyncio.run(run_processing_for_range(args.range_from, args.range_to or args.range_from,
+                                             google_drive_folder_url=args.drive_folder))
+    elif args.daemon:
+        asyncio.run(IngestionDaemon(DB_PATH, date_str=args.date, google_drive_folder_url=args.drive_folder,
+                                    max_idle_s=args.idle_exit).run())
+    elif args.report_from:
+        output = args.output or report_builder.report_filename(args.report_from, args.report_to, args.department, args.operation)
+        report = report_builder.build_report(DB_PATH, output, args.report_from, args.report_to,
+                                             department=args.department, operation=args.operation)
+        logging.info(report['message'])
+    elif args.bulk_from:
+        run_bulk_backfill(args.bulk_from, args.bulk_to or args.bulk_from, job_name=args.bulk_job,
+                          google_drive_folder_url=args.drive_folder, wait=not args.bulk_no_wait)
+    else:
+        # Или запуск обработки всех необработанных сообщений (как раньше)
+        asyncio.run(main())
 
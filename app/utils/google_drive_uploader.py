@@ -32,7 +32,8 @@ CREDENTIALS_FILE = os.path.join(UTILS_DIR, "drive_credentials.json")
 # Путь к client_secrets.json остается прежним, так как он лежит в корне app
 CLIENT_SECRETS_FILE = os.path.join(os.path.dirname(UTILS_DIR), "client_secrets.json")
 
-def upload_to_drive(file_path: str, filename: str = None, google_drive_folder_url: str = None) -> None:
+def upload_to_drive(file_path: str, filename: str = None, google_drive_folder_url: str = None,
+                    replace_existing: bool = False) -> None:
     """
     Загружает файл на Google Drive в указанную папку.
 
@@ -40,6 +41,8 @@ def upload_to_drive(file_path: str, filename: str = None, google_drive_folder_ur
         file_path: Путь к локальному файлу.
         filename: Имя файла на Google Drive. Если не указано, берется имя исходного файла.
         google_drive_folder_url: URL папки Google Drive. Если не указан, используется значение из config.
+        replace_existing: Если в папке уже есть файл с таким именем - обновить его содержимое, а не создавать
+                          еще один (отчет, который обновляется в течение дня).
     """
     try:
         # Проверка пути к файлу
@@ -113,10 +116,21 @@ def upload_to_drive(file_path: str, filename: str = None, google_drive_folder_ur
             return
 
         # Создание и загрузка файла
-        gfile = drive.CreateFile({
-            'title': filename or os.path.basename(file_path),
-            'parents': [{'id': folder_id}]
-        })
+        title = filename or os.path.basename(file_path)
+        existing = []
+        if replace_existing:
+            escaped_title = title.replace("\\", "\\\\").replace("'", "\\'")
+            existing = drive.ListFile({
+                'q': f"title = '{escaped_title}' and '{folder_id}' in parents and trashed = false"
+            }).GetList()
+        if existing:
+            gfile = existing[0] # Новая версия того же файла - ссылка на него не меняется
+            logging.info(f"Файл {title} уже есть в папке, обновляю содержимое (ID: {gfile['id']})")
+        else:
+            gfile = drive.CreateFile({
+                'title': title,
+                'parents': [{'id': folder_id}]
+            })
         gfile.SetContentFile(file_path)
         gfile.Upload()
 
@@ -0,0 +1,455 @@
+# Локальный OpenAI-совместимый сервер-заглушка для LLM (POST /chat/completions).
+#
+# Позволяет запускать process_batch_async без ключей и сети - например, для нагрузочной проверки
+# параллелизма, повторов и пакетного режима:
+#
+#   python -m app.utils.llm_stub_server --mode synthetic --port 8765 --latency-mean 1.5 --error-rate 0.02
+#   DEEPSEEK_API_KEY=stub DEEPSEEK_API_BASE=http://127.0.0.1:8765 python -m app.main
+#
+# Режимы:
+#   synthetic - ответ генерируется из текста сообщения (разбор правилами rule_parser.py, иначе - запись
+#               с числами из сообщения); задержка - логнормальное распределение, плюс доля ошибок 5xx,
+#               периодические "всплески" 429 и лимит одновременных запросов.
+#   record    - запросы проксируются реальному провайдеру (--upstream, --api-key), ответы пишутся в --cassette.
+#   replay    - ответы берутся из --cassette по хэшу промпта (модель + сообщения); промах - 404
+#               (или синтетический ответ с --replay-fallback).
+# Кроме того, сервер реализует Batch API (POST /files, POST /batches, GET /batches/{id},
+# GET /files/{id}/content) для пакетных заданий app/llm_integration/bulk_jobs.py: запросы пакета
+# выполняются после --batch-delay по тем же правилам режима.
+# Модуль не импортирует app.config, поэтому работает без переменных окружения.
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import time
+
+import aiohttp
+from aiohttp import web
+
+from app.llm_integration.rule_parser import RuleBasedParser
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "data", "mappings")
+CHARS_PER_TOKEN = 3 # Как в prompt_builder.estimate_token_count
+
+MODE_SYNTHETIC = "synthetic"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+SINGLE_MESSAGE_RE = re.compile(r"Проанализируй следующее сообщение[^\n]*\n---\n(.*?)\n---", re.DOTALL)
+BATCH_BLOCK_RE = re.compile(r"Проанализируй следующие сообщения.*?\n---\n(.*?)\n---", re.DOTALL)
+BATCH_MESSAGE_RE = re.compile(r"\[MSG ([^\]]+)\]\n(.*?)(?=\n\n\[MSG |\Z)", re.DOTALL)
+REASK_RECORDS_RE = re.compile(r"ЗАПИСИ С ОШИБКАМИ[^\n]*\n(\[.*?\n\])\n", re.DOTALL)
+CURRENT_DATE_RE = re.compile(r"ТЕКУЩАЯ ДАТА: (\d{4}-\d{2}-\d{2})")
+PAIR_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*/\s*(\d+(?:[.,]\d+)?)")
+
+
+def prompt_hash(body: dict) -> str:
+    """Ключ записи в кассете: модель и сообщения запроса (без температуры и параметров потока)."""
+    key = json.dumps({"model": body.get("model"), "messages": body.get("messages")}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _jsonl(rows: list[dict]) -> bytes:
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode('utf-8')
+
+
+def _error_body(message: str, error_type: str, status: int) -> dict:
+    return {"error": {"message": message, "type": error_type, "code": status}}
+
+
+def _estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+class SyntheticExtractor:
+    """Строит правдоподобный ответ модели по тексту промпта (одиночный, пакетный и повторный запрос)."""
+
+    def __init__(self, mappings_dir: str = MAPPINGS_DIR):
+        with open(os.path.join(mappings_dir, "cultures.txt"), 'r', encoding='utf-8') as f:
+            cultures_content = f.read()
+        with open(os.path.join(mappings_dir, "operations.txt"), 'r', encoding='utf-8') as f:
+            operations_content = f.read()
+        with open(os.path.join(mappings_dir, "departments.json"), 'r', encoding='utf-8') as f:
+            departments_content = f.read()
+        self.parser = RuleBasedParser.from_contents(cultures_content, operations_content, departments_content)
+
+    def _records(self, message: str, current_date: str) -> list[dict]:
+        records = self.parser.parse(message, current_date)
+        if records is not None:
+            return records
+        pair = PAIR_RE.search(message)
+        return [{
+            "Дата": current_date,
+            "Подразделение": None,
+            "Операция": None,
+            "Культура": None,
+            "За день, га": float(pair.group(1).replace(",", ".")) if pair else None,
+            "С начала операции, га": float(pair.group(2).replace(",", ".")) if pair else None,
+            "Вал за день, ц": None,
+            "Вал с начала, ц": None,
+        }]
+
+    def respond(self, prompt: str, wrap_reports: bool) -> str:
+        """Текст ответа модели на пользовательскую часть промпта."""
+        date_match = CURRENT_DATE_RE.search(prompt)
+        current_date = date_match.group(1) if date_match else time.strftime("%Y-%m-%d")
+
+        reask = REASK_RECORDS_RE.search(prompt)
+        if reask:
+            try:
+                records = [{k: v for k, v in record.items() if k != "Ошибки"} for record in json.loads(reask.group(1))]
+            except (json.JSONDecodeError, AttributeError):
+                records = []
+            return json.dumps({"reports": records} if wrap_reports else records, ensure_ascii=False)
+
+        batch = BATCH_BLOCK_RE.search(prompt)
+        if batch:
+            result = {msg_id: self._records(text, current_date) for msg_id, text in BATCH_MESSAGE_RE.findall(batch.group(1))}
+            return json.dumps(result, ensure_ascii=False)
+
+        single = SINGLE_MESSAGE_RE.search(prompt)
+        records = self._records(single.group(1), current_date) if single else []
+        return json.dumps({"reports": records} if wrap_reports else records, ensure_ascii=False)
+
+
+class _UpstreamError(Exception):
+    """Ошибка реального провайдера в режиме record - передается клиенту как есть."""
+
+    def __init__(self, status: int, data: dict):
+        super().__init__(f"Провайдер вернул {status}")
+        self.status = status
+        self.data = data
+
+
+class StubLLMServer:
+    """OpenAI-совместимый сервер-заглушка (см. описание модуля)."""
+
+    def __init__(self, mode: str = MODE_SYNTHETIC, cassette_path: str | None = None, upstream: str | None = None,
+                 api_key: str | None = None, latency_mean: float = 1.0, latency_sigma: float = 0.5,
+                 error_rate: float = 0.0, burst_every: float = 0.0, burst_duration: float = 0.0,
+                 max_concurrency: int = 0, replay_fallback: bool = False, stream_chunk_chars: int = 40,
+                 batch_delay: float = 1.0, seed: int | None = None):
+        if mode not in (MODE_SYNTHETIC, MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"Неизвестный режим: {mode}")
+        if mode in (MODE_RECORD, MODE_REPLAY) and not cassette_path:
+            raise ValueError(f"Для режима {mode} нужен файл кассеты (--cassette)")
+        if mode == MODE_RECORD and not upstream:
+            raise ValueError("Для режима record нужен адрес провайдера (--upstream)")
+        self.mode = mode
+        self.cassette_path = cassette_path
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.api_key = api_key
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.burst_every = burst_every # Период всплесков 429, с (0 - без всплесков)
+        self.burst_duration = burst_duration # Длительность всплеска, с
+        self.max_concurrency = max_concurrency # Сверх этого числа одновременных запросов - 429 (0 - без лимита)
+        self.replay_fallback = replay_fallback
+        self.stream_chunk_chars = stream_chunk_chars
+        self.batch_delay = batch_delay # Время в очереди перед выполнением пакета (Batch API), с
+        self.random = random.Random(seed)
+        self.extractor = SyntheticExtractor() if mode == MODE_SYNTHETIC or replay_fallback else None
+        self.cassette = self._load_cassette() if cassette_path else {}
+        self.seen_prefixes = set() # Системные промпты, уже "закэшированные" провайдером
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self.stats = {"requests": 0, "ok": 0, "errors_5xx": 0, "rate_limited": 0, "replay_misses": 0, "peak_in_flight": 0,
+                      "batches": 0, "batch_requests": 0}
+        # Batch API: загруженные файлы и пакеты (только в памяти)
+        self.files = {}
+        self.batches = {}
+        self._batch_tasks = set()
+
+    def _load_cassette(self) -> dict:
+        cassette = {}
+        if os.path.exists(self.cassette_path):
+            with open(self.cassette_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        cassette[entry["key"]] = entry["content"]
+        logging.info(f"Кассета {self.cassette_path}: {len(cassette)} записанных ответов.")
+        return cassette
+
+    def _append_to_cassette(self, key: str, content: str) -> None:
+        self.cassette[key] = content
+        with open(self.cassette_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"key": key, "content": content}, ensure_ascii=False) + "\n")
+
+    def _latency(self) -> float:
+        if self.latency_mean <= 0:
+            return 0.0
+        # Логнормальное распределение с заданным средним: длинный хвост, как у реальных провайдеров
+        mu = math.log(self.latency_mean) - self.latency_sigma ** 2 / 2
+        return self.random.lognormvariate(mu, self.latency_sigma)
+
+    def _in_burst(self) -> bool:
+        if self.burst_every <= 0 or self.burst_duration <= 0:
+            return False
+        return (time.monotonic() - self.started) % self.burst_every < self.burst_duration
+
+    @staticmethod
+    def _error(status: int, message: str, error_type: str, headers: dict | None = None) -> web.Response:
+        return web.json_response(_error_body(message, error_type, status), status=status, headers=headers)
+
+    def _usage(self, body: dict, content: str) -> dict:
+        messages = body.get("messages") or []
+        prompt_text = "".join(str(m.get("content", "")) for m in messages)
+        system_text = "".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+        prompt_tokens = _estimate_tokens(prompt_text)
+        cached_tokens = 0
+        if system_text:
+            prefix_key = hashlib.sha256(system_text.encode('utf-8')).hexdigest()
+            if prefix_key in self.seen_prefixes:
+                cached_tokens = _estimate_tokens(system_text)
+            self.seen_prefixes.add(prefix_key)
+        completion_tokens = _estimate_tokens(content)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_cache_hit_tokens": cached_tokens, # Формат DeepSeek
+            "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}, # Формат OpenAI
+        }
+
+    async def _upstream_content(self, body: dict) -> str:
+        payload = dict(body, stream=False)
+        payload.pop("stream_options", None)
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{self.upstream}/chat/completions", json=payload, headers=headers) as response:
+                data = await response.json(content_type=None)
+                if response.status != 200:
+                    raise _UpstreamError(response.status, data)
+                return data["choices"][0]["message"]["content"]
+
+    async def _content(self, body: dict, simulate_latency: bool) -> str:
+        """Текст ответа на запрос: из кассеты, от провайдера (record) или синтетический.
+
+        Ошибки (промах в replay, синтетические 5xx, ошибки провайдера) - _UpstreamError.
+        """
+        key = prompt_hash(body)
+        if self.mode == MODE_RECORD:
+            if key not in self.cassette:
+                self._append_to_cassette(key, await self._upstream_content(body))
+            return self.cassette[key]
+        if self.mode == MODE_REPLAY and key in self.cassette:
+            return self.cassette[key]
+        if self.mode == MODE_REPLAY:
+            self.stats["replay_misses"] += 1
+            if not self.replay_fallback:
+                raise _UpstreamError(404, _error_body(f"Нет записанного ответа для промпта {key[:12]}", "not_found_error", 404))
+        if simulate_latency:
+            await asyncio.sleep(self._latency())
+        if self.random.random() < self.error_rate:
+            self.stats["errors_5xx"] += 1
+            status = self.random.choice((500, 502, 503))
+            raise _UpstreamError(status, _error_body("Synthetic upstream error", "server_error", status))
+        user_prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []) if m.get("role") == "user")
+        return self.extractor.respond(user_prompt, wrap_reports=bool(body.get("response_format")))
+
+    def _completion(self, body: dict, content: str, usage: dict) -> dict:
+        return {
+            "id": f"stub-{self.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            self.stats["rate_limited"] += 1
+            return self._error(429, "Too many concurrent requests", "rate_limit_error", {"Retry-After": "1"})
+        if self._in_burst():
+            self.stats["rate_limited"] += 1
+            return self._error(429, "Rate limit reached (burst)", "rate_limit_error", {"Retry-After": "2"})
+
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+        try:
+            try:
+                content = await self._content(body, simulate_latency=True)
+            except _UpstreamError as e:
+                return web.json_response(e.data, status=e.status)
+
+            self.stats["ok"] += 1
+            usage = self._usage(body, content)
+            if body.get("stream"):
+                return await self._stream(request, body, content, usage)
+            return web.json_response(self._completion(body, content, usage))
+        finally:
+            self.in_flight -= 1
+
+    async def _stream(self, request: web.Request, body: dict, content: str, usage: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        base = {"id": f"stub-{self.stats['requests']}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model")}
+        for start in range(0, len(content), self.stream_chunk_chars):
+            chunk = dict(base, choices=[{"index": 0, "delta": {"content": content[start:start + self.stream_chunk_chars]}, "finish_reason": None}])
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await asyncio.sleep(0) # Отдаем управление, чтобы фрагменты уходили отдельно
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _store_file(self, filename: str, purpose: str, content: bytes) -> dict:
+        file_id = f"file-stub-{len(self.files) + 1}"
+        self.files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed", "content": content,
+        }
+        return {key: value for key, value in self.files[file_id].items() if key != "content"}
+
+    async def handle_file_upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form.get("file")
+        if upload is None or not hasattr(upload, "file"):
+            return self._error(400, "Нет файла в поле 'file'", "invalid_request_error")
+        return web.json_response(self._store_file(upload.filename, form.get("purpose", "batch"), upload.file.read()))
+
+    async def handle_file_content(self, request: web.Request) -> web.Response:
+        stored = self.files.get(request.match_info["file_id"])
+        if stored is None:
+            return self._error(404, "Файл не найден", "not_found_error")
+        return web.Response(body=stored["content"], content_type="application/octet-stream")
+
+    async def handle_batch_create(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("input_file_id") not in self.files:
+            return self._error(404, f"Файл {body.get('input_file_id')} не найден", "not_found_error")
+        self.stats["batches"] += 1
+        batch_id = f"batch-stub-{len(self.batches) + 1}"
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+            "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+            "status": "validating", "output_file_id": None, "error_file_id": None,
+            "created_at": int(time.time()), "in_progress_at": None, "completed_at": None, "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": body.get("metadata"),
+        }
+        task = asyncio.create_task(self._run_batch(batch_id))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+        return web.json_response(self.batches[batch_id])
+
+    async def _run_batch(self, batch_id: str) -> None:
+        """Выполняет запросы пакета по очереди (без задержек и лимитов интерактивного режима)."""
+        batch = self.batches[batch_id]
+        lines = [line for line in self.files[batch["input_file_id"]]["content"].decode('utf-8').splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        await asyncio.sleep(self.batch_delay)
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+            return
+        batch.update(status="in_progress", in_progress_at=int(time.time()))
+        output, errors = [], []
+        for number, line in enumerate(lines):
+            if batch["status"] == "cancelling":
+                break
+            request = json.loads(line)
+            body = request.get("body") or {}
+            self.stats["batch_requests"] += 1
+            result = {"id": f"{batch_id}-req-{number}", "custom_id": request.get("custom_id"), "error": None}
+            try:
+                content = await self._content(body, simulate_latency=False)
+            except _UpstreamError as e:
+                result["response"] = {"status_code": e.status, "body": e.data}
+                errors.append(result)
+                batch["request_counts"]["failed"] += 1
+                continue
+            result["response"] = {"status_code": 200, "body": self._completion(body, content, self._usage(body, content))}
+            output.append(result)
+            batch["request_counts"]["completed"] += 1
+            await asyncio.sleep(0) # Не блокируем обработку других запросов сервера
+        if output:
+            batch["output_file_id"] = self._store_file(f"{batch_id}_output.jsonl", "batch_output", _jsonl(output))["id"]
+        if errors:
+            batch["error_file_id"] = self._store_file(f"{batch_id}_errors.jsonl", "batch_output", _jsonl(errors))["id"]
+        if batch["status"] == "cancelling":
+            batch.update(status="cancelled", cancelled_at=int(time.time()))
+        else:
+            batch.update(status="completed", completed_at=int(time.time()))
+        logging.info(f"Пакет {batch_id}: {batch['status']}, выполнено {len(output)}, с ошибкой {len(errors)}.")
+
+    async def handle_batch_get(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return self._error(404, "Пакет не найден", "not_found_error")
+        return web.json_response(batch)
+
+    async def handle_batch_cancel(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return self._error(404, "Пакет не найден", "not_found_error")
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+        return web.json_response(batch)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats, in_flight=self.in_flight, mode=self.mode))
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 * 1024) # Файлы Batch API - до 200 МБ
+        # Поддерживаем оба вида base_url: http://host:port и http://host:port/v1
+        for prefix in ("", "/v1"):
+            app.router.add_post(f"{prefix}/chat/completions", self.handle_chat)
+            app.router.add_post(f"{prefix}/files", self.handle_file_upload)
+            app.router.add_get(f"{prefix}/files/{{file_id}}/content", self.handle_file_content)
+            app.router.add_post(f"{prefix}/batches", self.handle_batch_create)
+            app.router.add_get(f"{prefix}/batches/{{batch_id}}", self.handle_batch_get)
+            app.router.add_post(f"{prefix}/batches/{{batch_id}}/cancel", self.handle_batch_cancel)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="OpenAI-совместимый сервер-заглушка LLM")
+    arg_parser.add_argument("--mode", choices=(MODE_SYNTHETIC, MODE_RECORD, MODE_REPLAY), default=MODE_SYNTHETIC)
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--cassette", help="Файл записанных ответов (JSONL) для режимов record/replay")
+    arg_parser.add_argument("--upstream", help="Адрес реального провайдера для режима record, например https://api.deepseek.com")
+    arg_parser.add_argument("--api-key", default=os.getenv("STUB_UPSTREAM_API_KEY"), help="Ключ провайдера для режима record")
+    arg_parser.add_argument("--replay-fallback", action="store_true", help="При промахе в replay отвечать синтетически")
+    arg_parser.add_argument("--latency-mean", type=float, default=1.0, help="Средняя задержка ответа, с")
+    arg_parser.add_argument("--latency-sigma", type=float, default=0.5, help="Разброс задержки (sigma логнормального распределения)")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 5xx")
+    arg_parser.add_argument("--burst-every", type=float, default=0.0, help="Период всплесков 429, с")
+    arg_parser.add_argument("--burst-duration", type=float, default=0.0, help="Длительность всплеска 429, с")
+    arg_parser.add_argument("--max-concurrency", type=int, default=0, help="Лимит одновременных запросов (сверх - 429)")
+    arg_parser.add_argument("--batch-delay", type=float, default=1.0, help="Время пакета (Batch API) в очереди до выполнения, с")
+    arg_parser.add_argument("--seed", type=int, default=None)
+    args = arg_parser.parse_args()
+
+    server = StubLLMServer(
+        mode=args.mode, cassette_path=args.cassette, upstream=args.upstream, api_key=args.api_key,
+        latency_mean=args.latency_mean, latency_sigma=args.latency_sigma, error_rate=args.error_rate,
+        burst_every=args.burst_every, burst_duration=args.burst_duration, max_concurrency=args.max_concurrency,
+        replay_fallback=args.replay_fallback, batch_delay=args.batch_delay, seed=args.seed
+    )
+    logging.info(f"Сервер-заглушка LLM ({args.mode}) на http://{args.host}:{args.port}")
+    try:
+        web.run_app(server.make_app(), host=args.host, port=args.port, print=None)
+    finally:
+        logging.info(f"Статистика сервера-заглушки: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
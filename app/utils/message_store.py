@@ -0,0 +1,453 @@
+# Доступ к базе сообщений парсера (app/parser/messages.db, схема - app/parser/db.js).
+#
+# Парсер пишет timestamp в ISO-формате UTC (toISOString: 2025-08-10T06:00:00.000Z), поэтому выборка
+# за дату - это диапазон строк [дата, следующая дата): такое условие использует индекс, в отличие
+# от DATE(timestamp) = ?, которое заставляет SQLite читать всю таблицу. Индекс по необработанным
+# сообщениям создается идемпотентной миграцией при первом обращении к базе.
+#
+# Соединение с базой одно на путь и живет весь процесс (main, GUI, бенчмарки): настройки WAL, busy_timeout
+# и synchronous применяются один раз, а подготовленные запросы остаются в кэше соединения между запусками.
+
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from app import config
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Частичный индекс: только необработанные сообщения (processed_at IS NULL), упорядоченные по времени.
+# Обработанные сообщения - почти вся таблица к концу сезона - в индекс не попадают, он остается маленьким
+UNPROCESSED_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_messages_unprocessed_timestamp "
+    "ON messages(timestamp) WHERE processed_at IS NULL"
+)
+
+# Результаты обработки сохраняются по каждому сообщению сразу после его обработки (save_message_result):
+# message_results - итог по сообщению, extractions - извлеченные записи. Отчет строится из сохраненных
+# строк, а прерванный запуск продолжается с необработанных сообщений - оплаченные ответы LLM не теряются
+RESULTS_SCHEMA_SQL = (
+    """CREATE TABLE IF NOT EXISTS message_results (
+        message_id TEXT PRIMARY KEY,
+        message_date TEXT NOT NULL, -- Дата сообщения YYYY-MM-DD (по ней строятся отчеты)
+        status TEXT NOT NULL, -- extracted / empty / duplicate / failed
+        duplicate_of TEXT, -- Для повтора - ID исходного сообщения
+        similarity REAL,
+        record_count INTEGER NOT NULL DEFAULT 0,
+        processed_at TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_message_results_date ON message_results(message_date)",
+    """CREATE TABLE IF NOT EXISTS extractions (
+        message_id TEXT NOT NULL,
+        position INTEGER NOT NULL, -- Номер записи в сообщении
+        message_date TEXT NOT NULL,
+        record TEXT NOT NULL, -- Запись в JSON
+        PRIMARY KEY (message_id, position)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_extractions_date ON extractions(message_date)",
+)
+# Срезы отчета по подразделению и операции: индексы по выражениям над JSON записи. Запрос использует
+# индекс, только если выражение в WHERE совпадает с выражением индекса - поэтому оно задано здесь один раз
+EXTRACTION_FILTER_FIELDS = {
+    "department": "json_extract(record, '$.\"Подразделение\"')",
+    "operation": "json_extract(record, '$.\"Операция\"')",
+}
+RESULTS_SCHEMA_SQL += tuple(
+    f"CREATE INDEX IF NOT EXISTS idx_extractions_{name} ON extractions({expression}, message_date)"
+    for name, expression in EXTRACTION_FILTER_FIELDS.items()
+)
+RESULT_EXTRACTED = "extracted"
+RESULT_EMPTY = "empty" # Сообщение обработано, но данные не извлечены
+RESULT_DUPLICATE = "duplicate"
+RESULT_FAILED = "failed" # Ошибка обработки: сообщение остается необработанным и повторяется при следующем запуске
+
+_connections = {} # Путь к базе -> общее соединение
+_lock = threading.RLock() # Соединение используется из разных потоков (GUI обрабатывает в фоновом потоке)
+_query_stats = {} # Имя запроса -> {"calls", "rows", "total_ms", "max_ms"}
+
+
+def date_range(date_from: str, date_to: str | None = None) -> tuple[str, str]:
+    """Границы timestamp для дат YYYY-MM-DD включительно: [date_from, date_to + 1 день)."""
+    end = datetime.date.fromisoformat(date_to or date_from) + datetime.timedelta(days=1)
+    return datetime.date.fromisoformat(date_from).isoformat(), end.isoformat()
+
+
+def ensure_schema(conn: sqlite3.Connection) -> bool:
+    """
+    Миграция базы парсера: колонка processed_at (в старых базах ее нет), индекс необработанных сообщений
+    и таблицы результатов обработки.
+
+    Returns:
+        True, если таблица messages есть и миграция выполнена.
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    if not columns:
+        return False # Таблицу создает парсер; пока ее нет - мигрировать нечего
+    if "processed_at" not in columns:
+        conn.execute("ALTER TABLE messages ADD COLUMN processed_at TEXT DEFAULT NULL")
+    conn.execute(UNPROCESSED_INDEX_SQL)
+    for sql in RESULTS_SCHEMA_SQL:
+        conn.execute(sql)
+    conn.commit()
+    return True
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    """Настройки соединения из config: ожидание блокировок, журнал, синхронизация, кэш страниц."""
+    # busy_timeout - первым: смене режима журнала нужна блокировка, которую может держать парсер
+    conn.execute(f"PRAGMA busy_timeout = {config.SQLITE_BUSY_TIMEOUT_MS}")
+    journal_mode = conn.execute(f"PRAGMA journal_mode = {config.SQLITE_JOURNAL_MODE}").fetchone()[0]
+    if journal_mode.upper() != config.SQLITE_JOURNAL_MODE:
+        # Например, база на сетевом диске: WAL там недоступен, SQLite остается в прежнем режиме
+        logging.warning(f"Режим журнала {config.SQLITE_JOURNAL_MODE} не применен, используется {journal_mode}.")
+    conn.execute(f"PRAGMA synchronous = {config.SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{config.SQLITE_CACHE_SIZE_KB}") # Отрицательное значение - в КБ
+
+
+def get_connection(db_path: str) -> sqlite3.Connection:
+    """
+    Общее соединение с базой. Создается и настраивается при первом обращении к пути.
+    Пока таблицы messages нет (парсер еще не запускался), миграция повторяется при каждом обращении.
+    """
+    with _lock:
+        entry = _connections.get(db_path)
+        if entry is None:
+            conn = sqlite3.connect(db_path, check_same_thread=False,
+                                   cached_statements=config.SQLITE_CACHED_STATEMENTS)
+            try:
+                configure_connection(conn)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            entry = _connections[db_path] = {"conn": conn, "migrated": False}
+            logging.info(f"Открыто соединение с базой сообщений: {db_path}")
+        if not entry["migrated"]:
+            entry["migrated"] = ensure_schema(entry["conn"])
+        return entry["conn"]
+
+
+def close_connections(db_path: str | None = None) -> None:
+    """Закрывает общие соединения (все или для одного пути) - например, перед удалением файла базы."""
+    with _lock:
+        paths = [db_path] if db_path is not None else list(_connections)
+        for path in paths:
+            entry = _connections.pop(path, None)
+            if entry is not None:
+                entry["conn"].close()
+                logging.info(f"Закрыто соединение с базой сообщений: {path}")
+
+
+def _timed_query(conn: sqlite3.Connection, name: str, sql: str, params: tuple = ()) -> list:
+    """Выполняет запрос и учитывает его время в статистике (get_query_stats)."""
+    started = time.perf_counter()
+    rows = conn.execute(sql, params).fetchall()
+    _record_query(name, len(rows), started)
+    return rows
+
+
+def _record_query(name: str, rows: int, started: float) -> None:
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    stats = _query_stats.setdefault(name, {"calls": 0, "rows": 0, "total_ms": 0.0, "max_ms": 0.0})
+    stats["calls"] += 1
+    stats["rows"] += rows
+    stats["total_ms"] += elapsed_ms
+    stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    logging.info(f"Запрос {name}: {rows} строк за {elapsed_ms:.1f} мс.")
+
+
+def get_query_stats() -> dict:
+    """Статистика запросов с начала процесса (или с reset_query_stats)."""
+    return {name: dict(stats, avg_ms=stats["total_ms"] / stats["calls"]) for name, stats in _query_stats.items()}
+
+
+def reset_query_stats() -> None:
+    _query_stats.clear()
+
+
+def query_plan(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> list[str]:
+    """План запроса (EXPLAIN QUERY PLAN) - для проверки, что выборка идет по индексу."""
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+UNPROCESSED_IN_RANGE_SQL = (
+    "SELECT id, text, substr(timestamp, 1, 10) FROM messages "
+    "WHERE processed_at IS NULL AND timestamp >= ? AND timestamp < ? ORDER BY timestamp"
+)
+
+
+def fetch_unprocessed(db_path: str, date_from: str | None = None, date_to: str | None = None) -> list[tuple]:
+    """
+    Необработанные сообщения, упорядоченные по времени.
+
+    Args:
+        db_path: Путь к базе парсера.
+        date_from: Первая дата YYYY-MM-DD (None - все необработанные сообщения).
+        date_to: Последняя дата YYYY-MM-DD включительно (по умолчанию = date_from).
+
+    Returns:
+        Список кортежей (id, text, дата сообщения YYYY-MM-DD).
+    """
+    with _lock:
+        conn = get_connection(db_path)
+        if date_from is None:
+            return _timed_query(
+                conn, "unprocessed_all",
+                "SELECT id, text, substr(timestamp, 1, 10) FROM messages WHERE processed_at IS NULL ORDER BY timestamp"
+            )
+        return _timed_query(conn, "unprocessed_range", UNPROCESSED_IN_RANGE_SQL, date_range(date_from, date_to))
+
+
+UNPROCESSED_PAGE_SQL = (
+    "SELECT id, text, substr(timestamp, 1, 10), timestamp FROM messages "
+    "WHERE processed_at IS NULL AND timestamp >= ? AND timestamp < ? AND (timestamp, id) > (?, ?) "
+    "ORDER BY timestamp, id LIMIT ?"
+)
+
+
+def fetch_unprocessed_page(db_path: str, bounds: tuple[str, str], after: tuple[str, str], limit: int) -> list[tuple]:
+    """Страница необработанных сообщений после позиции after = (timestamp, id): кортежи (id, text, дата, timestamp)."""
+    with _lock:
+        return _timed_query(get_connection(db_path), "unprocessed_page", UNPROCESSED_PAGE_SQL, (*bounds, *after, limit))
+
+
+def iter_unprocessed(db_path: str, date_from: str | None = None, date_to: str | None = None, page_size: int | None = None):
+    """
+    Потоковое чтение необработанных сообщений в порядке времени - страницами по page_size.
+
+    Страницы выбираются по позиции последнего прочитанного сообщения (timestamp, id), а не через OFFSET
+    или открытый курсор: чтение не держит блокировку между страницами и не сбивается, если
+    сообщения отмечаются обработанными во время обхода.
+
+    Args:
+        db_path: Путь к базе парсера.
+        date_from: Первая дата YYYY-MM-DD (None - все необработанные сообщения).
+        date_to: Последняя дата YYYY-MM-DD включительно (по умолчанию = date_from).
+        page_size: Размер страницы (по умолчанию config.SQLITE_FETCH_PAGE_SIZE).
+
+    Yields:
+        Кортежи (id, text, дата сообщения YYYY-MM-DD).
+    """
+    # Без дат - весь диапазон: timestamp в ISO-формате меньше любой строки, начинающейся с "~"
+    bounds = date_range(date_from, date_to) if date_from else ("", "~")
+    page_size = page_size or config.SQLITE_FETCH_PAGE_SIZE
+    after = ("", "")
+    while True:
+        rows = fetch_unprocessed_page(db_path, bounds, after, page_size)
+        for message_id, text, date, _ in rows:
+            yield message_id, text, date
+        if len(rows) < page_size:
+            return
+        after = (rows[-1][3], rows[-1][0])
+
+
+def data_version(db_path: str) -> int:
+    """
+    Счетчик изменений базы другими соединениями (PRAGMA data_version): меняется после каждой записи парсера.
+    Дешевая проверка без запроса к таблице - если счетчик тот же, новых сообщений нет.
+    """
+    with _lock:
+        return get_connection(db_path).execute("PRAGMA data_version").fetchone()[0]
+
+
+# "+timestamp" исключает столбец из выбора индекса: иначе планировщик берет idx_messages_unprocessed_timestamp
+# (весь день необработанных строк) и сортирует их временным B-деревом. Так запрос идет по rowid от отметки
+NEW_MESSAGES_SQL = (
+    "SELECT rowid, id, text, substr(timestamp, 1, 10) FROM messages "
+    "WHERE rowid > ? AND processed_at IS NULL AND +timestamp >= ? AND +timestamp < ? ORDER BY rowid LIMIT ?"
+)
+
+
+def fetch_new_messages(db_path: str, after_rowid: int, date_from: str | None = None,
+                       limit: int | None = None) -> list[tuple]:
+    """
+    Необработанные сообщения, добавленные после отметки after_rowid (rowid растет с каждой вставкой парсера),
+    - поиск по первичному ключу таблицы, без просмотра уже прочитанных строк.
+
+    Args:
+        db_path: Путь к базе парсера.
+        after_rowid: Отметка: rowid последнего прочитанного сообщения (0 - с начала таблицы).
+        date_from: Только сообщения этой даты YYYY-MM-DD (None - все даты).
+        limit: Не больше строк (по умолчанию config.SQLITE_FETCH_PAGE_SIZE).
+
+    Returns:
+        Кортежи (rowid, id, text, дата сообщения YYYY-MM-DD) в порядке добавления.
+    """
+    bounds = date_range(date_from) if date_from else ("", "~")
+    with _lock:
+        return _timed_query(get_connection(db_path), "new_messages", NEW_MESSAGES_SQL,
+                            (after_rowid, *bounds, limit or config.SQLITE_FETCH_PAGE_SIZE))
+
+
+def mark_processed(db_path: str, message_ids: list[str], processed_at: str | None = None) -> int:
+    """Отмечает сообщения обработанными. Возвращает количество обновленных строк."""
+    if not message_ids:
+        return 0
+    processed_at = processed_at or datetime.datetime.now().isoformat()
+    with _lock:
+        conn = get_connection(db_path)
+        try:
+            started = time.perf_counter()
+            cursor = conn.executemany("UPDATE messages SET processed_at = ? WHERE id = ?",
+                                      [(processed_at, message_id) for message_id in message_ids])
+            conn.commit()
+            _record_query("mark_processed", cursor.rowcount, started)
+            return cursor.rowcount
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def save_message_result(db_path: str, message_id: str, message_date: str, records: list | None = None,
+                        duplicate_of: str | None = None, similarity: float | None = None) -> None:
+    """
+    Сохраняет результат одного сообщения и отмечает его обработанным - одной транзакцией.
+    Повторное сохранение (сообщение обработано заново) заменяет прежние записи.
+    Если обработка не удалась (records=None), сохраняется статус failed, а processed_at сообщения не
+    заполняется: iter_unprocessed вернет его снова, и следующий запуск повторит запрос.
+
+    Args:
+        db_path: Путь к базе парсера.
+        message_id: ID сообщения.
+        message_date: Дата сообщения YYYY-MM-DD.
+        records: Извлеченные записи ([] - данных в сообщении нет, None - обработка не удалась).
+        duplicate_of: ID исходного сообщения, если это повтор (записи у повтора не сохраняются).
+        similarity: Сходство с исходным сообщением.
+    """
+    if duplicate_of is not None:
+        status = RESULT_DUPLICATE
+    elif records is None:
+        status = RESULT_FAILED
+    else:
+        status = RESULT_EXTRACTED if records else RESULT_EMPTY
+    records = records or []
+    processed_at = datetime.datetime.now().isoformat()
+    with _lock:
+        conn = get_connection(db_path)
+        try:
+            started = time.perf_counter()
+            conn.execute("DELETE FROM extractions WHERE message_id = ?", (message_id,))
+            conn.executemany(
+                "INSERT INTO extractions (message_id, position, message_date, record) VALUES (?, ?, ?, ?)",
+                [(message_id, position, message_date, json.dumps(record, ensure_ascii=False, default=str))
+                 for position, record in enumerate(records)]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO message_results "
+                "(message_id, message_date, status, duplicate_of, similarity, record_count, processed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (message_id, message_date, status, duplicate_of, similarity, len(records), processed_at)
+            )
+            if status != RESULT_FAILED:
+                conn.execute("UPDATE messages SET processed_at = ? WHERE id = ?", (processed_at, message_id))
+            conn.commit()
+            _record_query("save_message_result", len(records), started)
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def fetch_processed_messages(db_path: str, message_date: str) -> list[tuple]:
+    """
+    Уже обработанные сообщения даты, кроме повторов и неудачных: (id, text) в порядке времени.
+    Нужны для поиска повторов, когда обработка даты продолжается (после сбоя или по мере поступления).
+    """
+    with _lock:
+        return _timed_query(
+            get_connection(db_path), "processed_messages",
+            "SELECT m.id, m.text FROM message_results r JOIN messages m ON m.id = r.message_id "
+            "WHERE r.message_date = ? AND r.status IN (?, ?) ORDER BY m.timestamp, m.id",
+            (message_date, RESULT_EXTRACTED, RESULT_EMPTY)
+        )
+
+
+def _read_connection(db_path: str) -> sqlite3.Connection:
+    # Отдельное соединение только для чтения: длинный обход отчета не блокирует общее соединение,
+    # а в WAL-режиме не мешает и записи
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA busy_timeout = {config.SQLITE_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def _extractions_query(date_from: str, date_to: str | None, filters: dict) -> tuple[str, list]:
+    conditions = ["e.message_date >= ?", "e.message_date <= ?"]
+    params = [date_from, date_to or date_from]
+    for name, value in filters.items():
+        if value is not None:
+            conditions.append(f"{EXTRACTION_FILTER_FIELDS[name]} = ?") # record есть только в extractions
+            params.append(value)
+    sql = (
+        "SELECT e.message_id, e.record FROM extractions e JOIN messages m ON m.id = e.message_id "
+        f"WHERE {' AND '.join(conditions)} ORDER BY m.timestamp, m.id, e.position"
+    )
+    return sql, params
+
+
+def iter_extractions(db_path: str, date_from: str, date_to: str | None = None,
+                     department: str | None = None, operation: str | None = None):
+    """
+    Сохраненные записи за даты YYYY-MM-DD (включительно) в порядке сообщений.
+
+    Args:
+        db_path: Путь к базе парсера.
+        date_from, date_to: Период (по умолчанию - один день date_from).
+        department, operation: Только записи с таким подразделением / операцией (точное совпадение).
+
+    Yields:
+        (id сообщения, список записей) - по одному кортежу на сообщение с данными.
+    """
+    get_connection(db_path) # Миграция: в базе могут еще не быть таблиц результатов
+    sql, params = _extractions_query(date_from, date_to, {"department": department, "operation": operation})
+    conn = _read_connection(db_path)
+    started = time.perf_counter()
+    rows = 0
+    try:
+        cursor = conn.execute(sql, params)
+        message_id, records = None, []
+        for row_message_id, record in cursor:
+            rows += 1
+            if row_message_id != message_id:
+                if records:
+                    yield message_id, records
+                message_id, records = row_message_id, []
+            records.append(json.loads(record))
+        if records:
+            yield message_id, records
+    finally:
+        conn.close()
+        _record_query("extractions", rows, started)
+
+
+def extractions_plan(db_path: str, department: str | None = None, operation: str | None = None) -> list[str]:
+    """План запроса iter_extractions (EXPLAIN QUERY PLAN) - проверка, что срез идет по индексу."""
+    sql, params = _extractions_query("2000-01-01", None, {"department": department, "operation": operation})
+    with _lock:
+        return query_plan(get_connection(db_path), sql, params)
+
+
+def fetch_report_values(db_path: str, field: str, date_from: str, date_to: str | None = None) -> list[str]:
+    """Значения поля записей (department / operation) за период - для выбора среза отчета."""
+    expression = EXTRACTION_FILTER_FIELDS[field]
+    with _lock:
+        rows = _timed_query(
+            get_connection(db_path), f"{field}_values",
+            f"SELECT DISTINCT {expression} AS value FROM extractions "
+            "WHERE message_date >= ? AND message_date <= ? AND value IS NOT NULL ORDER BY value",
+            (date_from, date_to or date_from)
+        )
+    return [row[0] for row in rows]
+
+
+def fetch_duplicates(db_path: str, date_from: str, date_to: str | None = None) -> list[tuple]:
+    """Повторы за даты YYYY-MM-DD (включительно): (id сообщения, id исходного сообщения, сходство)."""
+    with _lock:
+        return _timed_query(
+            get_connection(db_path), "duplicates",
+            "SELECT r.message_id, r.duplicate_of, r.similarity FROM message_results r "
+            "JOIN messages m ON m.id = r.message_id "
+            "WHERE r.message_date >= ? AND r.message_date <= ? AND r.status = ? ORDER BY m.timestamp, m.id",
+            (date_from, date_to or date_from, RESULT_DUPLICATE)
+        )
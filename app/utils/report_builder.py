@@ -0,0 +1,225 @@
+# Отчеты из сохраненных результатов обработки (таблица extractions базы парсера, см. message_store).
+#
+# Отчет за дату, период, подразделение или операцию строится SQL-запросом по индексам - без повторной
+# обработки сообщений LLM. Формат файла определяется расширением: .csv - CSV, иначе Excel.
+
+import csv
+import logging
+import os
+import re
+import sqlite3
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+from app.config import REPORT_OUTPUT_PATH
+from app.utils import message_store
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CSV_ENCODING = "utf-8-sig" # С BOM - Excel открывает кириллицу в CSV без перекодировки
+
+
+def _excel_header(sheet, columns: list) -> list:
+    """Ячейки заголовка, оформленные как у pandas.DataFrame.to_excel."""
+    side = Side(style="thin")
+    cells = []
+    for column in columns:
+        cell = WriteOnlyCell(sheet, value=column)
+        cell.font = Font(bold=True)
+        cell.border = Border(left=side, right=side, top=side, bottom=side)
+        cell.alignment = Alignment(horizontal="center", vertical="top")
+        cells.append(cell)
+    return cells
+
+
+def _excel_value(value):
+    return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+
+def _collect_columns(iter_messages) -> tuple[list, int]:
+    # Набор колонок в порядке появления (как у DataFrame из списка словарей) и число записей
+    columns, record_count = {}, 0
+    for records in iter_messages():
+        for record in records:
+            columns.update(dict.fromkeys(record))
+            record_count += 1
+    return list(columns), record_count
+
+
+def write_records_to_excel(iter_messages, output_filename: str, duplicate_rows: list | None = None) -> bool:
+    """
+    Сохраняет записи в Excel в том же виде, что и save_results_to_excel, но построчно (режим write_only):
+    без DataFrame со всеми записями в памяти. Подходит для отчетов из базы за большой период.
+
+    Args:
+        iter_messages: Функция без аргументов, возвращающая итератор записей по сообщениям (список записей
+                       на сообщение). Вызывается дважды: набор колонок и сами строки.
+        output_filename: Путь к файлу Excel.
+        duplicate_rows: Строки листа Duplicates (повторы сообщений), если есть.
+
+    Returns:
+        True, если файл сохранен; False, если данных нет или запись не удалась.
+    """
+    try:
+        columns, record_count = _collect_columns(iter_messages)
+        if not record_count:
+            logging.warning("Нет данных для сохранения в Excel.")
+            return False
+        logging.info(f"Сохранение {record_count} записей в Excel: {output_filename}...")
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Results")
+        sheet.append(_excel_header(sheet, columns))
+        first = True
+        for records in iter_messages():
+            if not records:
+                continue
+            if not first:
+                sheet.append([]) # Пустая строка между сообщениями
+            first = False
+            for record in records:
+                sheet.append([_excel_value(record.get(column)) for column in columns])
+        if duplicate_rows:
+            duplicates = workbook.create_sheet("Duplicates")
+            duplicate_columns = list(duplicate_rows[0])
+            duplicates.append(_excel_header(duplicates, duplicate_columns))
+            for row in duplicate_rows:
+                duplicates.append([row.get(column) for column in duplicate_columns])
+
+        os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
+        workbook.save(output_filename)
+        logging.info(f"Результаты успешно сохранены в файл: {output_filename}")
+        return True
+    except sqlite3.Error:
+        raise # Ошибку чтения из БД обрабатывает build_report
+    except Exception as e:
+        logging.error(f"Ошибка при записи отчета в Excel: {e}")
+        return False
+
+
+def write_records_to_csv(iter_messages, output_filename: str) -> bool:
+    """
+    Сохраняет записи в CSV: одна строка на запись, без пустых строк между сообщениями (для выгрузки в
+    другие системы). Аргументы и результат - как у write_records_to_excel.
+    """
+    try:
+        columns, record_count = _collect_columns(iter_messages)
+        if not record_count:
+            logging.warning("Нет данных для сохранения в CSV.")
+            return False
+        logging.info(f"Сохранение {record_count} записей в CSV: {output_filename}...")
+        os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
+        with open(output_filename, "w", newline="", encoding=CSV_ENCODING) as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for records in iter_messages():
+                writer.writerows(records)
+        logging.info(f"Результаты успешно сохранены в файл: {output_filename}")
+        return True
+    except sqlite3.Error:
+        raise # Ошибку чтения из БД обрабатывает build_report
+    except Exception as e:
+        logging.error(f"Ошибка при записи отчета в CSV: {e}")
+        return False
+
+
+def report_filename(date_from: str, date_to: str | None = None, department: str | None = None,
+                    operation: str | None = None, extension: str | None = None, prefix: str = "Отчет") -> str:
+    """
+    Путь к файлу отчета по срезу: папка и расширение (по умолчанию) из config.REPORT_OUTPUT_PATH,
+    имя Отчет_ДАТА[_ДАТА][_подразделение][_операция] - для одной даты совпадает с отчетом обработки.
+    """
+    parts = [date_from]
+    if date_to and date_to != date_from:
+        parts.append(date_to)
+    parts += [re.sub(r'[\\/:*?"<>|\s]+', "-", value) for value in (department, operation) if value]
+    extension = extension or os.path.splitext(REPORT_OUTPUT_PATH)[1]
+    return os.path.join(os.path.dirname(REPORT_OUTPUT_PATH), f"{prefix}_{'_'.join(parts)}{extension}")
+
+
+def write_range_summary(rows: list[dict], output_filename: str) -> bool:
+    """
+    Сохраняет сводку обработки периода: одна строка на дату (колонки - ключи словарей) и строка итогов
+    по числовым колонкам.
+
+    Returns:
+        True, если файл сохранен.
+    """
+    if not rows:
+        return False
+    try:
+        columns = list(rows[0])
+        totals = {column: sum(row[column] for row in rows) if all(isinstance(row[column], int) for row in rows) else None
+                  for column in columns}
+        totals[columns[0]] = "Итого"
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Summary")
+        sheet.append(_excel_header(sheet, columns))
+        for row in rows + [totals]:
+            sheet.append([_excel_value(row.get(column)) for column in columns])
+        os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
+        workbook.save(output_filename)
+        logging.info(f"Сводка по периоду сохранена: {output_filename}")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при записи сводки {output_filename}: {e}")
+        return False
+
+
+def build_report(db_path: str, output_filename: str, date_from: str, date_to: str | None = None,
+                 department: str | None = None, operation: str | None = None) -> dict:
+    """
+    Строит отчет из сохраненных записей (message_store.iter_extractions), LLM не вызывается.
+
+    Args:
+        db_path: Путь к базе парсера.
+        output_filename: Путь к файлу отчета (.csv - CSV, иначе Excel).
+        date_from: Первая дата YYYY-MM-DD.
+        date_to: Последняя дата YYYY-MM-DD включительно (по умолчанию = date_from).
+        department: Только записи этого подразделения (поле "Подразделение").
+        operation: Только записи этой операции (поле "Операция").
+
+    Returns:
+        Словарь с результатом: { 'success': bool, 'report_path': str | None, 'record_count': int, 'message': str }.
+        success=True и report_path=None - чтение прошло без ошибок, но записей в срезе нет.
+    """
+    period = date_from if not date_to or date_to == date_from else f"{date_from} - {date_to}"
+    logging.info(f"Построение отчета из БД за {period} (подразделение: {department or 'все'}, "
+                 f"операция: {operation or 'все'}) -> {output_filename}")
+    result = {'success': False, 'report_path': None, 'record_count': 0, 'message': ''}
+
+    def iter_messages():
+        # Каждый проход писателя - новый запрос; число записей считается заново
+        result['record_count'] = 0
+        for _, records in message_store.iter_extractions(db_path, date_from, date_to,
+                                                         department=department, operation=operation):
+            result['record_count'] += len(records)
+            yield records
+
+    try:
+        if output_filename.lower().endswith(".csv"):
+            saved = write_records_to_csv(iter_messages, output_filename)
+        else:
+            # Повторы относятся к сообщениям целиком, а не к срезу записей - лист только в полном отчете
+            duplicate_rows = None
+            if department is None and operation is None:
+                duplicate_rows = [
+                    {"ID сообщения": message_id, "Повтор сообщения": original_id, "Сходство": similarity}
+                    for message_id, original_id, similarity in message_store.fetch_duplicates(db_path, date_from, date_to)
+                ]
+            saved = write_records_to_excel(iter_messages, output_filename, duplicate_rows)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка при чтении результатов из БД {db_path}: {e}")
+        result['message'] = f"Ошибка при чтении результатов из БД: {e}"
+        return result
+
+    if saved:
+        result.update(success=True, report_path=output_filename, message=f"Отчет за {period} сохранен: {output_filename}")
+    elif not result['record_count']:
+        result.update(success=True, message=f"Нет сохраненных записей за {period} для выбранного среза.")
+    else:
+        result['message'] = f"Не удалось записать файл отчета: {output_filename}"
+    return result
@@ -0,0 +1,383 @@
+# Генератор синтетических отчетов о полевых работах с эталонными записями.
+#
+# В data/test_messages.py несколько десятков сообщений - для бенчмарков и оценки качества этого мало.
+# Генератор собирает сообщения из справочников data/mappings/ в стиле реальных отчетов: строки
+# "По Пу"/"Отд", сокращения ("пах с св", "2-е диск", "оз пш"), вал в килограммах, даты, служебные
+# строки ("Урожайность", "Диг", "Амазон"), несколько блоков в одном сообщении. Вместе с каждым
+# сообщением возвращаются записи, которые должна извлечь модель по правилам из EXTRACTION_INSTRUCTIONS.
+#
+# Сообщение с номером N строится из собственного зерна (seed, N): генерация потоковая, не зависит
+# от количества сообщений и воспроизводит любое сообщение по номеру.
+#
+#   python -m app.utils.synthetic_reports --count 1000000 --seed 1 --output data/synthetic.jsonl
+#
+# Модуль не импортирует app.config, поэтому работает без переменных окружения.
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+from dataclasses import dataclass, field
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "data", "mappings")
+
+# Варианты написания операций в отчетах. Генерируются только операции, которые есть и здесь, и в operations.txt
+OPERATION_FORMS = {
+    "Пахота": ["Пахота", "Пахота зяби", "Пах", "пах"],
+    "Дискование": ["Диск", "Дискование", "Диск-ие"],
+    "Дискование 2-е": ["2-е диск", "2-ое диск-ие", "2-e диск", "Диск 2-е"],
+    "Дискование 3-е": ["3-е диск", "3-е дискование"],
+    "Чизлевание": ["Чизел", "Чизелевание"],
+    "Выравнивание зяби": ["Вырав-ие зяби", "Выравнивание зяби"],
+    "2-е Выравнивание зяби": ["2-е вырав-ие зяби", "2-е выравнивание зяби"],
+    "Предпосевная культивация": ["Предп культ", "Предпосевная культ", "Предп культивация"],
+    "Культивация": ["Культ", "Культивация"],
+    "Сплошная культивация": ["Сплошная культ", "Сплошная культивация"],
+    "1-я междурядная культивация": ["1-я междурядная культ", "1-я междурядная культивация"],
+    "2-я междурядная культивация": ["2-я междурядная культ", "2-я междурядная культивация"],
+    "Боронование довсходовое": ["Боронование довсходовое", "Довсходовое боронование"],
+    "Прикатывание посевов": ["Прик", "Прикат", "Прикатывание"],
+    "Сев": ["Сев"],
+    "Подкормка": ["Подкормка"],
+    "2-я подкормка": ["2-я подкормка"],
+    "Внесение минеральных удобрений": ["Внесение мин удобрений", "Внесение минеральных удобрений"],
+    "1 Гербицидная обработка": ["1-я гербицидная обработка", "1 гербицидная"],
+    "2 Гербицидная обработка": ["2-я гербицидная обработка", "2 гербицидная"],
+    "3 Гербицидная обработка": ["3-я гербицидная обработка", "3 гербицидная"],
+    "4 Гербицидная обработка": ["4-я гербицидная обработка", "4 гербицидная"],
+    "Инсектицидная обработка": ["Инсектицидная обработка", "Инсектицидная"],
+    "Функицидная обработка": ["Фунгицидная обработка", "Фунгицидная"],
+    "Уборка": ["Уборка"],
+}
+
+# Операции подготовки почвы: в заголовке "под <культура>" (культура, под которую готовят поле)
+SOIL_OPERATIONS = {
+    "Пахота", "Дискование", "Дискование 2-е", "Дискование 3-е", "Чизлевание", "Выравнивание зяби",
+    "2-е Выравнивание зяби", "Предпосевная культивация", "Культивация", "Сплошная культивация",
+    "Внесение минеральных удобрений",
+}
+HARVEST_OPERATION = "Уборка"
+# Гербицидные обработки со 2-й по 4-ю бывают только у свеклы (см. operations.txt)
+BEET_ONLY_OPERATIONS = {"2 Гербицидная обработка", "3 Гербицидная обработка", "4 Гербицидная обработка"}
+
+# Варианты написания культур. Культуры из cultures.txt без вариантов пишутся полным названием
+CULTURE_FORMS = {
+    "Свекла сахарная": ["сах св", "сах/свёклу", "с. св", "сахарную свеклу", "св сах"],
+    "Пшеница озимая товарная": ["оз пш", "оз пшеницу", "оз пш товарн", "озимую пш тов"],
+    "Пшеница озимая семенная": ["оз пш сем", "оз пшеницу семенную"],
+    "Пшеница озимая на зеленый корм": ["оз зел корм", "оз на зел корм"],
+    "Ячмень озимый": ["оз ячмень", "оз ячм"],
+    "Ячмень озимый семенной": ["оз ячмень сем"],
+    "Кукуруза кормовая": ["кук/силос", "кук сил", "к. сил"],
+    "Кукуруза товарная": ["кукурузу", "кук тов"],
+    "Кукуруза семенная": ["кук сем"],
+    "Подсолнечник товарный": ["подс", "подсолнечник"],
+    "Подсолнечник семенной": ["подс сем"],
+    "Подсолнечник кондитерский": ["подс конд"],
+    "Соя товарная": ["сою", "сои", "соя"],
+    "Соя семенная": ["сою семенную", "сои семенной"],
+    "Рапс озимый": ["оз рапс", "рапс озимый"],
+    "Рапс яровой": ["яр рапс", "рапс яровой"],
+    "Горох товарный": ["горох"],
+    "Горох на зерно": ["горох на зерно"],
+    "Овес": ["овес"],
+    "Люцерна": ["люцерну"],
+    "Чистый пар": ["чистый пар"],
+}
+# Неоднозначные в отчетах культуры (например, "мн тр" - три вида трав): не генерируются
+AMBIGUOUS_CULTURES = {
+    "Многолетние злаковые травы", "Многолетние травы прошлых лет", "Многолетние травы текущего года",
+    "Сорго", "Сорго кормовой", "Сорго-суданковый гибрид",
+}
+
+# Урожайность при уборке, ц/га (нижняя и верхняя граница)
+HARVEST_YIELDS = {
+    "Свекла сахарная": (250, 600),
+    "Пшеница озимая товарная": (40, 90),
+    "Пшеница озимая семенная": (40, 80),
+    "Ячмень озимый": (40, 80),
+    "Соя товарная": (15, 35),
+    "Соя семенная": (15, 30),
+    "Подсолнечник товарный": (20, 40),
+    "Кукуруза товарная": (50, 110),
+    "Рапс озимый": (25, 45),
+    "Горох товарный": (25, 45),
+}
+
+# Строки после вала, которые модель должна игнорировать
+HARVEST_NOISE = ["Урож {yield_day}/{yield_total}", "Урожайность {yield_day}/{yield_total}", "Урож {yield_day}"]
+BEET_NOISE = ["Диг - {digestion}", "Оз - {contamination}", "Дигестия-{digestion}"]
+EQUIPMENT = ["Амазон", "Пневмоход"]
+TRAILING_NOISE = ["Работало {units} агрегата", "Осадки: {rain} мм", "Работал 1 агрегат"]
+
+
+def _names(content: str) -> list[str]:
+    """Полные названия из файла справочника (без заголовка и пояснений в скобках)."""
+    return [name for name in (line.split("(")[0].strip() for line in content.splitlines()[1:]) if name]
+
+
+def _number(value: float) -> float | int:
+    """Число для эталонной записи: целое, если дробной части нет."""
+    value = round(value, 2)
+    return int(value) if float(value).is_integer() else value
+
+
+def _text(value: float) -> str:
+    """Число в тексте отчета (дробная часть через запятую)."""
+    value = _number(value)
+    return str(value).replace(".", ",")
+
+
+@dataclass
+class SyntheticReport:
+    """Сгенерированное сообщение и эталонные записи для него."""
+    index: int
+    date: str # Дата отправки сообщения (текущая дата при обработке), YYYY-MM-DD
+    text: str
+    records: list[dict] = field(default_factory=list)
+
+
+@dataclass
+class _Unit:
+    """Подразделение, от имени которого пишется отчет."""
+    department: str
+    pu: str | None # Производственный участок (ПУ) или None
+    numbers: list[int] # Номера отделений ПУ
+
+
+class SyntheticReportGenerator:
+    """Генерирует сообщения-отчеты и эталонные записи по справочникам.
+
+    Одинаковые seed и номер сообщения дают одинаковый результат на любой машине.
+    """
+
+    def __init__(self, cultures: list[str], operations: list[str], departments: list[dict], seed: int = 0,
+                 start_date: str = "2025-08-10", days: int = 1):
+        self.seed = seed
+        self.start_date = datetime.date.fromisoformat(start_date)
+        self.days = max(1, days)
+        self.operations = [name for name in OPERATION_FORMS if name in set(operations)]
+        self.cultures = [name for name in cultures if name not in AMBIGUOUS_CULTURES]
+        self.harvest_cultures = [name for name in HARVEST_YIELDS if name in set(cultures)]
+        self.units = [
+            _Unit(entry["Подразделение"], entry.get("ПУ"), [int(n) for n in entry.get("Отделения") or []])
+            for entry in departments if entry.get("Подразделение")
+        ]
+        if not self.operations or not self.cultures or not self.units:
+            raise ValueError("Справочники не содержат операций, культур или подразделений для генерации")
+
+    @classmethod
+    def from_contents(cls, cultures_content: str, operations_content: str, departments_content: str,
+                      **kwargs) -> "SyntheticReportGenerator":
+        """Создает генератор из содержимого файлов справочников (как они загружаются в processor.py)."""
+        return cls(_names(cultures_content), _names(operations_content), json.loads(departments_content), **kwargs)
+
+    @classmethod
+    def from_mappings_dir(cls, mappings_dir: str = MAPPINGS_DIR, **kwargs) -> "SyntheticReportGenerator":
+        """Создает генератор из файлов справочников в папке (по умолчанию data/mappings/)."""
+        with open(os.path.join(mappings_dir, "cultures.txt"), 'r', encoding='utf-8') as f:
+            cultures_content = f.read()
+        with open(os.path.join(mappings_dir, "operations.txt"), 'r', encoding='utf-8') as f:
+            operations_content = f.read()
+        with open(os.path.join(mappings_dir, "departments.json"), 'r', encoding='utf-8') as f:
+            departments_content = f.read()
+        return cls.from_contents(cultures_content, operations_content, departments_content, **kwargs)
+
+    def generate(self, index: int) -> SyntheticReport:
+        """Генерирует сообщение с номером index (не зависит от остальных сообщений)."""
+        rng = random.Random(self.seed * 1_000_000_007 + index)
+        sent_date = self.start_date + datetime.timedelta(days=rng.randrange(self.days))
+        unit = rng.choice(self.units)
+
+        # Дата в тексте: дата отправки или (ночная смена, отчет утром) предыдущий день того же года
+        report_date, date_text = sent_date, None
+        if rng.random() < 0.6:
+            if rng.random() < 0.25 and (sent_date - datetime.timedelta(days=1)).year == sent_date.year:
+                report_date = sent_date - datetime.timedelta(days=1)
+            date_text = rng.choice(["{d:02d}.{m:02d}", "{d:02d}.{m:02d}", "{d:02d}.{m:02d} день", "{d:02d}.{m:02d}.{y}"]).format(
+                d=report_date.day, m=report_date.month, y=report_date.year % 100
+            )
+
+        # Первая строка: дата и/или название ПУ/подразделения. Без номеров отделений название обязательно,
+        # иначе подразделение не определить
+        named_header = not unit.numbers or rng.random() < 0.4
+        header_parts = [date_text] if date_text else []
+        if named_header:
+            if unit.pu:
+                header_parts.append(rng.choice(["ПУ {0}", "{0}", "ПУ \"{0}\""]).format(unit.pu))
+            else:
+                header_parts.append(unit.department)
+
+        blocks, records = [], []
+        used = set()
+        for _ in range(rng.choices([1, 2, 3, 4, 5], weights=[30, 25, 20, 15, 10])[0]):
+            operation, culture = self._pick_combination(rng)
+            if (operation, culture) in used:
+                continue
+            used.add((operation, culture))
+            lines, values = self._block(rng, unit, operation, culture)
+            blocks.append("\n".join(lines))
+            records.append({
+                "Дата": report_date.isoformat(),
+                "Подразделение": unit.department,
+                "Операция": operation,
+                "Культура": culture,
+                **values,
+            })
+
+        text = "\n\n".join(blocks)
+        if header_parts:
+            text = " ".join(header_parts) + "\n" + text
+        if rng.random() < 0.15:
+            text += "\n\n" + rng.choice(TRAILING_NOISE).format(units=rng.randint(2, 4), rain=rng.randint(1, 30))
+        return SyntheticReport(index=index, date=sent_date.isoformat(), text=text, records=records)
+
+    def iter_reports(self, count: int, start: int = 0):
+        """Генерирует сообщения с номерами start..start+count-1 по одному (без хранения в памяти)."""
+        for index in range(start, start + count):
+            yield self.generate(index)
+
+    def _pick_combination(self, rng: random.Random) -> tuple[str, str]:
+        operation = rng.choice(self.operations)
+        if operation == HARVEST_OPERATION and self.harvest_cultures:
+            return operation, rng.choice(self.harvest_cultures)
+        if operation in BEET_ONLY_OPERATIONS and "Свекла сахарная" in self.cultures:
+            return operation, "Свекла сахарная"
+        if operation == HARVEST_OPERATION or operation in BEET_ONLY_OPERATIONS:
+            operation = "Пахота" if "Пахота" in self.operations else self.operations[0]
+        return operation, rng.choice(self.cultures)
+
+    def _header(self, rng: random.Random, operation: str, culture: str) -> str:
+        operation_text = rng.choice(OPERATION_FORMS[operation])
+        culture_text = rng.choice(CULTURE_FORMS.get(culture) or [culture.lower()])
+        if operation in SOIL_OPERATIONS:
+            return f"{operation_text} под {culture_text}"
+        return f"{operation_text} {culture_text}"
+
+    def _block(self, rng: random.Random, unit: _Unit, operation: str, culture: str) -> tuple[list[str], dict]:
+        """Строки одного блока (операция + культура) и эталонные значения для него."""
+        header = self._header(rng, operation, culture)
+        separator = rng.choice(["/", "/", "/", " / "])
+
+        def pair(day, total):
+            return f"{_text(day)}{separator}{_text(total)}"
+
+        if not unit.numbers:
+            # Подразделение без отделений: одна пара чисел в заголовке, на следующей строке или прозой
+            day, total = self._area(rng)
+            style = rng.random()
+            if style < 0.4:
+                lines = [f"{header} {pair(day, total)}"]
+            elif style < 0.7:
+                lines = [header, f"По ПУ {pair(day, total)}" if unit.pu else pair(day, total)]
+            else:
+                percent = rng.randint(10, 99)
+                rest = round(total * (100 - percent) / percent)
+                lines = [f"{header} {_text(day)} га день, {_text(total)} га от начала, {percent}%, остаток {rest} га."]
+            values = {"За день, га": _number(day), "С начала операции, га": _number(total)}
+        else:
+            numbers = rng.sample(unit.numbers, k=min(len(unit.numbers), rng.choices([1, 2, 3], weights=[50, 30, 20])[0]))
+            departments = [self._area(rng, decimals=False) for _ in numbers]
+            day_sum = sum(day for day, _ in departments)
+            total_sum = sum(total for _, total in departments)
+            # По ПУ больше суммы отделений, если часть отделений в сообщение не попала
+            pu_day = day_sum + (rng.randint(0, day_sum) if rng.random() < 0.3 else 0)
+            pu_total = total_sum + (pu_day - day_sum) + (rng.randint(0, total_sum) if rng.random() < 0.5 else 0)
+            style = rng.random()
+            if len(numbers) == 1 and style < 0.2:
+                # "Диск к. Сил отд 7. 32/352" + "Пу- 484": за день - по отделению, с начала - по ПУ
+                day, total = departments[0]
+                number_text = rng.choice(["отд {0}", "отд {0}.", "отд{0}"]).format(numbers[0])
+                lines = [f"{header} {number_text} {pair(day, total)}", rng.choice(["Пу- {0}", "По пу {0} га", "пу-{0}га"]).format(pu_total)]
+                values = {"За день, га": day, "С начала операции, га": pu_total}
+            else:
+                lines = [header]
+                with_pu = rng.random() < 0.75
+                if with_pu:
+                    lines.append(rng.choice(["По Пу", "По ПУ", "ПоПу", "по пу"]) + f" {pair(pu_day, pu_total)}")
+                    if operation not in SOIL_OPERATIONS and operation != HARVEST_OPERATION and rng.random() < 0.2:
+                        # Детализация по технике - служебные строки
+                        first_day = rng.randint(0, pu_day)
+                        first_total = rng.randint(first_day, pu_total - (pu_day - first_day))
+                        lines.append(f"(в т.ч {EQUIPMENT[0]}-{first_day}/{first_total}")
+                        lines.append(f"{EQUIPMENT[1]}-{pu_day - first_day}/{pu_total - first_total})")
+                for number, (day, total) in zip(numbers, departments):
+                    label = rng.choice(["Отд {0}", "Отд {0}", "Отд{0}", "Отд {0}-", "отд {0}"]).format(number)
+                    lines.append(f"{label} {pair(day, total)}")
+                if with_pu:
+                    values = {"За день, га": pu_day, "С начала операции, га": pu_total}
+                else:
+                    values = {"За день, га": day_sum, "С начала операции, га": total_sum}
+
+        gross_day, gross_total = None, None
+        if operation == HARVEST_OPERATION:
+            lines, gross_day, gross_total = self._harvest_lines(rng, lines, culture, values)
+        values["Вал за день, ц"] = gross_day
+        values["Вал с начала, ц"] = gross_total
+        return lines, values
+
+    def _area(self, rng: random.Random, decimals: bool = True) -> tuple[float, float]:
+        """Площадь за день и с начала операции, га."""
+        day = rng.randint(5, 300)
+        if decimals and rng.random() < 0.05:
+            day += rng.randint(1, 9) / 10
+        total = day + rng.choice([0, rng.randint(1, 500), rng.randint(100, 3000)])
+        return day, total
+
+    def _harvest_lines(self, rng: random.Random, lines: list[str], culture: str, values: dict):
+        """Строки вала (в кг, иногда в центнерах) и служебные строки уборки."""
+        low, high = HARVEST_YIELDS.get(culture, (20, 60))
+        yield_day = rng.uniform(low, high)
+        yield_total = rng.uniform(low, high)
+        gross_day_kg = round(values["За день, га"] * yield_day * 10) * 10
+        gross_total_kg = max(gross_day_kg, round(values["С начала операции, га"] * yield_total * 10) * 10)
+        gross_total = _number(gross_total_kg / 100)
+        with_total = rng.random() < 0.8
+        if rng.random() < 0.1:
+            # Вал уже в центнерах
+            text = f"Вал {_text(gross_day_kg / 100)}/{_text(gross_total_kg / 100)} ц" if with_total else f"Вал {_text(gross_day_kg / 100)} ц"
+        else:
+            text = f"Вал {gross_day_kg}/{gross_total_kg}" if with_total else f"Вал {gross_day_kg}"
+        lines = lines + [text]
+        noise = rng.choice(HARVEST_NOISE).format(yield_day=_text(round(yield_day, 1)), yield_total=_text(round(yield_total, 1)))
+        if rng.random() < 0.7:
+            lines.append(noise)
+        if culture == "Свекла сахарная" and rng.random() < 0.6:
+            lines.append(rng.choice(BEET_NOISE).format(digestion=_text(round(rng.uniform(14, 20), 2)),
+                                                         contamination=_text(round(rng.uniform(3, 13), 2))))
+        return lines, _number(gross_day_kg / 100), gross_total if with_total else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетических отчетов с эталонными записями (JSONL)")
+    parser.add_argument("--count", type=int, default=1000, help="Количество сообщений")
+    parser.add_argument("--start", type=int, default=0, help="Номер первого сообщения")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start-date", default="2025-08-10", help="Дата отправки первых сообщений, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=1, help="Сколько дней, начиная с --start-date, покрывают сообщения")
+    parser.add_argument("--mappings-dir", default=MAPPINGS_DIR)
+    parser.add_argument("--output", help="Файл JSONL (по умолчанию - stdout)")
+    args = parser.parse_args()
+
+    generator = SyntheticReportGenerator.from_mappings_dir(
+        args.mappings_dir, seed=args.seed, start_date=args.start_date, days=args.days
+    )
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for report in generator.iter_reports(args.count, args.start):
+            output.write(json.dumps({"index": report.index, "date": report.date, "text": report.text,
+                                     "records": report.records}, ensure_ascii=False) + "\n")
+    finally:
+        if args.output:
+            output.close()
+            logging.info(f"Сгенерировано {args.count} сообщений: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+# Сквозной бенчмарк конвейера обработки: run_processing_for_date на синтетической базе сообщений
+# против локального сервера-заглушки LLM (app/utils/llm_stub_server.py).
+#
+# Запуск из корня проекта:
+#   python -m benchmarks.pipeline_benchmark --sizes 50,500,5000
+#   python -m benchmarks.pipeline_benchmark --sizes 50000 --latency-mean 0.5 --compare benchmarks/results/<прошлый>.json
+#
+# Для каждого размера создается messages.db в схеме парсера (app/parser/db.js), затем в отдельном
+# процессе (чтобы пиковая память считалась для каждого размера отдельно) выполняется полный путь:
+# чтение из SQLite, построение промптов, запросы к LLM, извлечение JSON, запись Excel, отметка
+# обработанных сообщений. Загрузка на Google Drive отключается. Результаты сохраняются в JSON
+# (benchmarks/results/) для сравнения между коммитами.
+
+import argparse
+import asyncio
+import datetime
+import functools
+import gc
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BASE_DIR, "benchmarks", "results")
+BENCHMARK_DATE = "2025-08-10" # Дата, за которую создаются сообщения и запускается обработка
+
+sys.path.insert(0, BASE_DIR)
+
+
+def build_messages(count: int, seed: int) -> list[str]:
+    """Сообщения для бенчмарка: синтетические отчеты (app/utils/synthetic_reports.py) за BENCHMARK_DATE."""
+    from app.utils.synthetic_reports import SyntheticReportGenerator
+    generator = SyntheticReportGenerator.from_mappings_dir(seed=seed, start_date=BENCHMARK_DATE)
+    return [report.text for report in generator.iter_reports(count)]
+
+
+def create_messages_db(db_path: str, messages: list[str]) -> None:
+    """Создает базу сообщений в схеме парсера (app/parser/db.js)."""
+    # Без app.utils.message_store: его импорт читает app.config, которому в этом процессе не заданы ключи API
+    for path in (db_path, db_path + "-wal", db_path + "-shm"): # Файлы WAL-журнала прошлого прогона
+        if os.path.exists(path):
+            os.remove(path)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                chat TEXT,
+                text TEXT,
+                timestamp TEXT,
+                processed_at TEXT DEFAULT NULL
+            )
+        """)
+        start = datetime.datetime.fromisoformat(BENCHMARK_DATE + "T06:00:00")
+        rows = [
+            (f"bench-{i}", f"chat-{i % 20}", text, (start + datetime.timedelta(seconds=i % 50000)).isoformat() + ".000Z")
+            for i, text in enumerate(messages)
+        ]
+        conn.executemany("INSERT INTO messages (id, chat, text, timestamp) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class StageTimer:
+    """Замеряет время этапов, подменяя функции модулей обертками на время прогона.
+
+    Для каждого этапа считаются число вызовов, суммарное время вызовов и интервал от начала
+    первого до конца последнего вызова (для параллельных запросов к LLM сумма больше реального времени).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._patches = []
+
+    def _record(self, stage: str, started: float, finished: float) -> None:
+        entry = self.stages.setdefault(stage, {"calls": 0, "total_s": 0.0, "first": started, "last": finished})
+        entry["calls"] += 1
+        entry["total_s"] += finished - started
+        entry["first"] = min(entry["first"], started)
+        entry["last"] = max(entry["last"], finished)
+
+    def wrap(self, owner, name: str, stage: str) -> None:
+        original = getattr(owner, name)
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self._record(stage, started, time.perf_counter())
+        else:
+            @functools.wraps(original)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self._record(stage, started, time.perf_counter())
+        setattr(owner, name, wrapper)
+        self._patches.append((owner, name, original))
+
+    def restore(self) -> None:
+        for owner, name, original in reversed(self._patches):
+            setattr(owner, name, original)
+        self._patches = []
+
+    def report(self) -> dict:
+        return {
+            stage: {"calls": e["calls"], "total_s": round(e["total_s"], 4), "span_s": round(e["last"] - e["first"], 4)}
+            for stage, e in self.stages.items()
+        }
+
+
+def run_one(db_path: str, count: int, trace_allocations: bool) -> dict:
+    """Один прогон run_processing_for_date (выполняется в дочернем процессе)."""
+    import openpyxl
+    from app import main
+    from app.llm_integration import client, processor, pipeline
+    from app.utils import message_store
+
+    main.DB_PATH = db_path
+    main.upload_to_drive = lambda *args, **kwargs: None # Загрузка на Google Drive в бенчмарке не нужна
+    timer = StageTimer()
+    timer.wrap(main, "get_unprocessed_messages", "sqlite_read")
+    timer.wrap(message_store, "fetch_unprocessed_page", "sqlite_read") # Потоковая обработка читает страницами
+    timer.wrap(main, "mark_messages_as_processed", "mark_processed")
+    timer.wrap(message_store, "save_message_result", "mark_processed") # Потоковая обработка: результат и отметка по сообщению
+    for module in (processor, pipeline):
+        for name in ("build_message_prompt", "build_batch_message_prompt", "build_pruned_message_prompt",
+                     "build_pruned_batch_message_prompt", "build_reask_prompt"):
+            if hasattr(module, name):
+                timer.wrap(module, name, "prompt_build")
+        timer.wrap(module, "extract_json_list", "extraction")
+        timer.wrap(module, "extract_json_dict_by_id", "extraction")
+    timer.wrap(client.BaseLLMClient, "generate_response_async", "llm_calls")
+    timer.wrap(client.BaseLLMClient, "generate_response_stream_async", "llm_calls")
+    timer.wrap(processor.pd.DataFrame, "to_excel", "excel_write")
+    timer.wrap(openpyxl.Workbook, "save", "excel_write")
+
+    gc.collect()
+    gc_before = [stats["collections"] for stats in gc.get_stats()]
+    blocks_before = sys.getallocatedblocks()
+    if trace_allocations:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        status = asyncio.run(main.run_processing_for_date(BENCHMARK_DATE, google_drive_folder_url=""))
+    finally:
+        wall = time.perf_counter() - started
+        timer.restore()
+    traced_peak = None
+    if trace_allocations:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "messages": count,
+        "success": status.get("success"),
+        "wall_s": round(wall, 3),
+        "messages_per_sec": round(count / wall, 2) if wall else None,
+        "stages": timer.report(),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # ru_maxrss в КБ (Linux)
+        "allocated_blocks_delta": sys.getallocatedblocks() - blocks_before,
+        "gc_collections": [after - before for before, after in zip(gc_before, (s["collections"] for s in gc.get_stats()))],
+        "traced_peak_mb": round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None,
+    }
+
+
+def _fetch_stub_stats(port: int) -> dict | None:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=1) as response:
+            return json.loads(response.read())
+    except OSError:
+        return None
+
+
+def start_stub_server(args) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "app.utils.llm_stub_server", "--port", str(args.stub_port),
+        "--latency-mean", str(args.latency_mean), "--latency-sigma", str(args.latency_sigma),
+        "--error-rate", str(args.error_rate), "--seed", str(args.seed)
+    ]
+    if args.stub_max_concurrency:
+        command += ["--max-concurrency", str(args.stub_max_concurrency)]
+    server = subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        if _fetch_stub_stats(args.stub_port) is not None:
+            return server
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"Сервер-заглушка LLM не запустился на порту {args.stub_port}")
+
+
+def _format_stage(stage: str, stats: dict) -> str:
+    if stage == "llm_calls":
+        # Запросы идут параллельно (и ждут слот лимитера) - показываем интервал, а не сумму
+        return f"{stage} {stats['span_s']:.2f} с ({stats['calls']} запросов)"
+    return f"{stage} {stats['total_s']:.2f} с"
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(current: dict, previous_path: str) -> None:
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    previous_runs = {run["messages"]: run for run in previous.get("runs", [])}
+    print(f"\nСравнение с {previous_path} (коммит {previous.get('commit')}):")
+    for run in current["runs"]:
+        old = previous_runs.get(run["messages"])
+        if not old or not old.get("messages_per_sec") or not run.get("messages_per_sec"):
+            continue
+        change = (run["messages_per_sec"] / old["messages_per_sec"] - 1) * 100
+        print(f"  {run['messages']:>7} сообщений: {old['messages_per_sec']:>9.1f} -> {run['messages_per_sec']:>9.1f} сообщ/с "
+              f"({change:+.1f}%), пик RSS {old['peak_rss_mb']} -> {run['peak_rss_mb']} МБ")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Сквозной бенчмарк конвейера обработки сообщений")
+    arg_parser.add_argument("--sizes", default="50,500,5000", help="Количества сообщений через запятую")
+    arg_parser.add_argument("--seed", type=int, default=42)
+    arg_parser.add_argument("--stub-port", type=int, default=8799)
+    arg_parser.add_argument("--latency-mean", type=float, default=0.2, help="Средняя задержка сервера-заглушки, с")
+    arg_parser.add_argument("--latency-sigma", type=float, default=0.5)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--stub-max-concurrency", type=int, default=0)
+    arg_parser.add_argument("--trace-allocations", action="store_true", help="Включить tracemalloc (замедляет прогон)")
+    arg_parser.add_argument("--output", help="Файл результатов (по умолчанию benchmarks/results/pipeline_<время>_<коммит>.json)")
+    arg_parser.add_argument("--compare", help="Файл результатов предыдущего прогона для сравнения")
+    arg_parser.add_argument("--run-one", help=argparse.SUPPRESS) # Служебный режим: путь к БД для дочернего процесса
+    arg_parser.add_argument("--count", type=int, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.count, args.trace_allocations)))
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    commit = _git_commit()
+    results = {
+        "benchmark": "pipeline",
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "latency_mean": args.latency_mean, "latency_sigma": args.latency_sigma, "error_rate": args.error_rate,
+            "stub_max_concurrency": args.stub_max_concurrency, "seed": args.seed,
+            "env": {key: value for key, value in os.environ.items() if key.startswith(("LLM_", "MESSAGE_", "RULE_", "RECORD_"))},
+        },
+        "runs": [],
+    }
+
+    server = start_stub_server(args)
+    try:
+        with tempfile.TemporaryDirectory(prefix="agro-bench-") as workdir:
+            env = dict(
+                os.environ,
+                PRIMARY_LLM_PROVIDER="deepseek",
+                DEEPSEEK_API_KEY="stub",
+                DEEPSEEK_API_BASE=f"http://127.0.0.1:{args.stub_port}",
+                LLM_FAILOVER_ENABLED="false",
+                LLM_CACHE_ENABLED="false", # Каждый прогон должен реально обращаться к LLM
+                REPORT_OUTPUT_PATH=os.path.join(workdir, "processing_results.xlsx"),
+            )
+            for size in sizes:
+                db_path = os.path.join(workdir, f"messages_{size}.db")
+                create_messages_db(db_path, build_messages(size, args.seed))
+                stub_before = _fetch_stub_stats(args.stub_port) or {}
+                print(f"Прогон: {size} сообщений...", flush=True)
+                command = [sys.executable, "-m", "benchmarks.pipeline_benchmark", "--run-one", db_path, "--count", str(size)]
+                if args.trace_allocations:
+                    command.append("--trace-allocations")
+                completed = subprocess.run(command, cwd=BASE_DIR, env=env, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stderr[-3000:], file=sys.stderr)
+                    raise RuntimeError(f"Прогон на {size} сообщений завершился с ошибкой")
+                run = json.loads(completed.stdout.strip().splitlines()[-1])
+                stub_after = _fetch_stub_stats(args.stub_port) or {}
+                run["llm_stub"] = {key: stub_after.get(key, 0) - stub_before.get(key, 0)
+                                   for key in ("requests", "ok", "errors_5xx", "rate_limited")}
+                results["runs"].append(run)
+                print(f"  {run['wall_s']} с, {run['messages_per_sec']} сообщ/с, пик RSS {run['peak_rss_mb']} МБ, "
+                      f"этапы: " + ", ".join(_format_stage(stage, stats) for stage, stats in run["stages"].items()))
+    finally:
+        server.terminate()
+        server.wait()
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"pipeline_{datetime.datetime.now():%Y%m%d-%H%M%S}_{commit or 'nogit'}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()